@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+
+# pylint: disable=W0105
+
+"""
+This module defines a structured representation of the cards of the decks, as
+an alternative to the text of their MTGO files (see download_decks.update_deck).
+
+The cards of a deck are represented as a dictionary {"main": board, "side":
+board}, where each board is a tuple of pairs (count, card_id). The card ids are
+indices into a table of card names shared by all the decks (see CardTable), so
+each name is stored only once, however many decks contain the card. The pairs
+are shared too, since most of them (e.g., 4 copies of Lightning Bolt) are
+repeated across many decks. Thus, the decks take less memory and less space
+once serialized, and the cards can be analyzed without parsing text.
+
+For example, the text
+
+    "4 Lightning Bolt\\r;\\n2 Fire//Ice\\r;\\nSideboard\\r;\\n3 Blood Moon\\r;\\n"
+
+is represented as
+
+    {"main": ((4, 0), (2, 1)), "side": ((3, 2),)}
+
+with the card table ["Lightning Bolt", "Fire//Ice", "Blood Moon"].
+"""
+
+# line of the MTGO files that separates the mainboard from the sideboard
+SIDEBOARD_LINE = "Sideboard"
+
+
+class CardTable:
+
+    """
+    This class holds the names of the cards, interning each one the first time
+    it is seen. The card id of a name is its position in the table, so the ids
+    depend on the order in which the decks are structured, and a table must be
+    kept (e.g., serialized) together with the decks that refer to it.
+    """
+
+    def __init__(self, names=None):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        names: list of strings
+            The names of the cards of an existing table (e.g., loaded with the
+            decks that refer to it). If None, the table is empty
+        """
+
+        self.names = list()
+        self.ids = dict()
+        self.pairs = dict()
+
+        for name in names or list():
+            self.intern(name)
+
+    def __len__(self):
+
+        return len(self.names)
+
+    def intern(self, name):
+
+        """
+        Get the id of a card, adding it to the table if it is not there.
+
+        Parameters
+        ----------
+        name: string
+            The name of the card
+
+        Returns
+        -------
+        int
+            The card id
+        """
+
+        card_id = self.ids.get(name)
+        if card_id is None:
+            card_id = len(self.names)
+            name = sys.intern(name)
+            self.names.append(name)
+            self.ids[name] = card_id
+
+        return card_id
+
+    def pair(self, count, name):
+
+        """
+        Get the pair (count, card_id) of a number of copies of a card. The same
+        tuple is returned for equal pairs, so they are stored only once.
+
+        Parameters
+        ----------
+        count: int
+            The number of copies
+        name: string
+            The name of the card
+
+        Returns
+        -------
+        tuple
+            The pair (count, card_id)
+        """
+
+        pair = (count, self.intern(name))
+
+        return self.pairs.setdefault(pair, pair)
+
+
+def parse_cards(content, card_table):
+
+    """
+    Parse the cards of a deck into their structured representation.
+
+    Parameters
+    ----------
+    content: bytes or string
+        The content of the MTGO file with the deck's cards, or the text stored
+        in deck["cards"] by download_decks.update_deck
+    card_table: CardTable
+        The table where the card names are interned
+
+    Returns
+    -------
+    dictionary
+        The cards, as {"main": board, "side": board} (see the module's
+        documentation)
+    """
+
+    if isinstance(content, bytes):
+        content = content.decode(encoding="ISO-8859-1").replace("/", "//")
+
+    boards = {"main": list(), "side": list()}
+    board = boards["main"]
+
+    for line in content.replace("\r", "").splitlines():
+        line = line.rstrip(";").strip()
+
+        # the sideboard starts after a "Sideboard" line or, in some exports,
+        # after an empty line
+        if line.rstrip(":") == SIDEBOARD_LINE or (line == "" and board):
+            board = boards["side"]
+            continue
+        if line == "":
+            continue
+
+        count, name = line.split(" ", 1)
+        board.append(card_table.pair(int(count), name.strip()))
+
+    return {k: tuple(v) for k, v in boards.items()}
+
+
+def format_cards(cards, card_table):
+
+    """
+    Format the structured cards of a deck as the text stored in deck["cards"]
+    by download_decks.update_deck, i.e., the inverse of parse_cards.
+
+    Parameters
+    ----------
+    cards: dictionary
+        The cards, as returned by parse_cards
+    card_table: CardTable
+        The table of the card ids
+
+    Returns
+    -------
+    string
+        The text of the cards
+    """
+
+    lines = ["{} {}".format(n, card_table.names[i]) for n, i in cards["main"]]
+    if len(cards["side"]) > 0:
+        lines.append(SIDEBOARD_LINE)
+        lines += ["{} {}".format(n, card_table.names[i]) for n, i in cards["side"]]
+
+    return "".join(line + "\r;\n" for line in lines)
+
+
+def structure_decks(deck_list, card_table):
+
+    """
+    Replace the text of the cards of several decks by their structured
+    representation.
+
+    Parameters
+    ----------
+    deck_list: list of dictionaries
+        The decks, as returned by download_decks.download_decks_in_search_results.
+        They are updated during this function call. If None (e.g., an empty
+        results page), nothing is done
+    card_table: CardTable
+        The table where the card names are interned
+
+    Returns
+    -------
+    list of ints
+        The ids of the cards that were added to the table, i.e., that had not
+        been seen in previous calls
+    """
+
+    n_cards = len(card_table)
+
+    for deck in deck_list or list():
+        if isinstance(deck.get("cards"), str):
+            deck["cards"] = parse_cards(deck["cards"], card_table)
+
+    return list(range(n_cards, len(card_table)))
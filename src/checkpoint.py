@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import fcntl
+import hashlib
+
+# pylint: disable=W0105
+
+"""
+This module defines an append-only journal that keeps track of the progress of
+a crawl, so that an interrupted crawl can be resumed without downloading again
+the results pages and decks that were already downloaded.
+"""
+
+
+def page_key(payload):
+
+    """
+    Compute a key that identifies a results page in the journal. It is a hash
+    of the whole payload, so the pages with the same number but a different
+    format or date range (e.g., in a crawl of several formats) have different
+    keys.
+
+    Parameters
+    ----------
+    payload: dictionary
+        The payload of the results page
+
+    Returns
+    -------
+    String
+        The key
+    """
+
+    payload_str = json.dumps(payload, sort_keys=True)
+
+    return hashlib.sha224(str.encode(payload_str)).hexdigest()
+
+
+class CheckpointJournal:
+
+    """
+    This class provides methods to record and load the progress of a crawl.
+
+    The journal is a file with a JSON record per line. The first record holds
+    the payloads of all the results pages of the crawl. Then, a record is
+    appended with each downloaded deck and another one with each finished
+    results page, identified by its key (see page_key). The records are
+    appended under an exclusive lock, so the journal can be written by several
+    processes at the same time. Only the
+    file path is kept in the object, so it can be passed to joblib workers.
+    """
+
+    def __init__(self, path):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        path: string
+            The journal file
+        """
+
+        self.path = path
+
+    def _append(self, record):
+
+        line = json.dumps(record) + "\n"
+
+        with open(self.path, "a", encoding="utf-8") as journal_file:
+            fcntl.flock(journal_file, fcntl.LOCK_EX)
+            try:
+                journal_file.write(line)
+                journal_file.flush()
+            finally:
+                fcntl.flock(journal_file, fcntl.LOCK_UN)
+
+        return
+
+    def start(self, payload_list):
+
+        """
+        Start a new journal, removing the previous one if it exists.
+
+        Parameters
+        ----------
+        payload_list: list of dictionaries
+            The payloads of the results pages of the crawl
+        """
+
+        with open(self.path, "w", encoding="utf-8"):
+            pass
+
+        self._append({"type": "payloads", "payloads": payload_list})
+
+        return
+
+    def add_deck(self, payload, position, deck):
+
+        """
+        Record a downloaded deck.
+
+        Parameters
+        ----------
+        payload: dictionary
+            The payload of the deck's results page
+        position: int
+            The position of the deck within its results page
+        deck: dictionary
+            The deck
+        """
+
+        self._append(
+            {
+                "type": "deck",
+                "page": page_key(payload),
+                "position": position,
+                "deck": deck,
+            }
+        )
+
+        return
+
+    def add_page(self, payload):
+
+        """
+        Record a finished results page, i.e., one whose decks were all recorded.
+
+        Parameters
+        ----------
+        payload: dictionary
+            The payload of the results page
+        """
+
+        self._append({"type": "page", "page": page_key(payload)})
+
+        return
+
+    def load(self):
+
+        """
+        Load the journal.
+
+        Returns
+        -------
+        Tuple
+            The payloads of the crawl (None if the journal does not exist or it
+            was not started), the set of keys of the finished results pages and
+            a dictionary {page key: {position: deck}} with the recorded decks
+            (see page_key)
+        """
+
+        payload_list = None
+        pages = set()
+        decks = dict()
+
+        if not os.path.isfile(self.path):
+            return payload_list, pages, decks
+
+        with open(self.path, "rb+") as journal_file:
+            fcntl.flock(journal_file, fcntl.LOCK_EX)
+            try:
+                lines = journal_file.readlines()
+
+                # the last record might be incomplete if the crawl was interrupted
+                # while writing it. It is removed so that new records are not
+                # appended to it
+                if len(lines) > 0 and not lines[-1].endswith(b"\n"):
+                    journal_file.truncate(journal_file.tell() - len(lines.pop()))
+            finally:
+                fcntl.flock(journal_file, fcntl.LOCK_UN)
+
+        for line in lines:
+            record = json.loads(line)
+
+            if record["type"] == "payloads":
+                payload_list = record["payloads"]
+            elif record["type"] == "deck":
+                decks.setdefault(record["page"], dict())
+                decks[record["page"]][record["position"]] = record["deck"]
+            elif record["type"] == "page":
+                pages.add(record["page"])
+
+        return payload_list, pages, decks
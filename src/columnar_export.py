@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import uuid
+import datetime
+from urllib.parse import urlparse, parse_qs
+
+from card_list import CardTable, parse_cards
+
+# pylint: disable=W0105, I1101
+
+"""
+This module defines an export sink that writes the downloaded decks as columnar
+files (Parquet or Arrow IPC), which are much faster to load for analytics than
+the JSON output. It requires pyarrow (see requirements.txt), which is imported
+only when a sink is created (see load_pyarrow), so importing this module is
+cheap, e.g., for the AWS Lambda functions, which do not use it.
+
+The decks are written in two tables: "decks", with a row per deck and its
+metadata, and "cards", with a row per card of each deck (i.e., deck_id, board,
+count, card_id and card). Both are partitioned by format and month of the
+event, in directories format=<format>/month=<yyyy-mm> (i.e., Hive
+partitioning), so the analytics queries read only the partitions and columns
+they need, e.g.:
+
+    import pyarrow.dataset as ds
+    cards = ds.dataset("export/cards", partitioning="hive")
+    table = cards.to_table(columns=["card", "count"], filter=ds.field("format") == "MO")
+
+The rows of the results pages are buffered by partition, and written as a row
+group of the file of their partition when the buffer reaches a number of rows
+(see DEFAULT_ROW_GROUP_SIZE), so the row groups are large enough for the
+columnar layout to pay off, and the memory does not grow with the number of
+pages.
+
+The files are written under a hidden name (.part-<id>...), which the readers of
+datasets (e.g., pyarrow.dataset) skip, and renamed when the sink is closed,
+once their footers are written. Thus, the files of a sink that did not finish
+(e.g., after a crash) are never read, and a resumed run, which writes new
+files, does not leave unreadable files next to them.
+
+The card ids are those of the card table of the sink (see card_list.CardTable),
+which is shared by all the decks and partitions written by the sink, and which
+is written when the sink is closed as a third table, card_table/part-<id>,
+with the columns card_id and card. Its files have the same name as the files of
+the sink in the partitions of the other tables, so several sinks can write to
+the same directory.
+"""
+
+# the columns of the deck metadata written to the "decks" table, besides the
+# format and the month, which are the partition keys
+DECK_COLUMNS = [
+    "id",
+    "link",
+    "name",
+    "type",
+    "player",
+    "event",
+    "result",
+    "date",
+    "date_download",
+]
+
+# the number of rows buffered for a partition of a table before they are
+# written as a row group
+DEFAULT_ROW_GROUP_SIZE = 65536
+
+# the file extension of each file format
+EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# the pyarrow modules, imported by load_pyarrow
+pa = None
+ipc = None
+pq = None
+
+
+def load_pyarrow():
+
+    """
+    Import the pyarrow modules used by this module, if they were not imported.
+    """
+
+    # pylint: disable=W0603
+    global pa, ipc, pq
+
+    if pa is not None:
+        return
+
+    try:
+        import pyarrow
+        from pyarrow import ipc as pyarrow_ipc
+        from pyarrow import parquet as pyarrow_parquet
+    except ImportError as e:
+        raise ImportError("the columnar export requires pyarrow") from e
+
+    pa, ipc, pq = pyarrow, pyarrow_ipc, pyarrow_parquet
+
+    return
+
+
+def deck_partition(deck):
+
+    """
+    Get the partition of a deck, i.e., its format and the month of its event.
+
+    Parameters
+    ----------
+    deck: dictionary
+        The deck
+
+    Returns
+    -------
+    Tuple
+        The format (e.g., "MO", taken from the deck's link) and the month
+        (e.g., "2021-09", taken from the deck's date)
+    """
+
+    query = parse_qs(urlparse(deck["link"]).query)
+    deck_format = query.get("f", ["unknown"])[0]
+
+    date = parse_date(deck["date"])
+    month = "unknown" if date is None else date.strftime("%Y-%m")
+
+    return deck_format, month
+
+
+def parse_date(date):
+
+    """
+    Parse a date of the website (dd/mm/yy).
+
+    Parameters
+    ----------
+    date: string
+        The date
+
+    Returns
+    -------
+    datetime.date
+        The date, or None if it could not be parsed
+    """
+
+    try:
+        return datetime.datetime.strptime(date.strip(), "%d/%m/%y").date()
+    except ValueError:
+        return None
+
+
+class ColumnarSink:
+
+    """
+    This class writes the decks of the results pages to the partitioned
+    "decks" and "cards" tables (see the module's documentation). Each object
+    writes its own file in each partition, so several objects (e.g., in
+    different processes or runs) can write to the same directory.
+    """
+
+    def __init__(
+        self, root, file_format="parquet", card_table=None, row_group_size=None
+    ):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        root: string
+            The directory where the tables are written
+        file_format: string
+            "parquet" or "arrow" (Arrow IPC file)
+        card_table: card_list.CardTable
+            The table of the card ids, which must be given if the cards of the
+            decks are structured (see card_list.structure_decks). The cards
+            given as text are added to it. If None, a new table is created
+        row_group_size: int
+            The number of rows buffered for a partition of a table before they
+            are written as a row group. If None, DEFAULT_ROW_GROUP_SIZE
+        """
+
+        load_pyarrow()
+        assert file_format in EXTENSIONS
+
+        self.root = root
+        self.file_format = file_format
+        self.card_table = card_table if card_table is not None else CardTable()
+        self.file_id = uuid.uuid4().hex
+        self.row_group_size = row_group_size or DEFAULT_ROW_GROUP_SIZE
+        self.writers = dict()
+        # the paths of the files, by their hidden path while they are written
+        self.paths = dict()
+        # the tables of the rows not written yet, by table and partition
+        self.buffers = dict()
+        self.n_decks = 0
+
+        self.schemas = {
+            "decks": pa.schema(
+                [(c, pa.date32() if c == "date" else pa.string()) for c in DECK_COLUMNS]
+            ),
+            "cards": pa.schema(
+                [
+                    ("deck_id", pa.string()),
+                    ("board", pa.dictionary(pa.int8(), pa.string())),
+                    ("count", pa.int16()),
+                    ("card_id", pa.int32()),
+                    ("card", pa.string()),
+                ]
+            ),
+            "card_table": pa.schema([("card_id", pa.int32()), ("card", pa.string())]),
+        }
+
+    def _open_writer(self, table_name, directory):
+
+        os.makedirs(directory, exist_ok=True)
+        filename = "part-{}{}".format(self.file_id, EXTENSIONS[self.file_format])
+        path = os.path.join(directory, "." + filename)
+        self.paths[path] = os.path.join(directory, filename)
+
+        schema = self.schemas[table_name]
+        if self.file_format == "parquet":
+            return pq.ParquetWriter(path, schema)
+
+        return ipc.new_file(path, schema)
+
+    def _write(self, key, tables):
+
+        table = pa.concat_tables(tables).combine_chunks()
+        self._writer(*key).write_table(table, self.row_group_size)
+
+    def _writer(self, table_name, partition):
+
+        key = (table_name, partition)
+        if key not in self.writers:
+            directory = os.path.join(
+                self.root,
+                table_name,
+                "format={}".format(partition[0]),
+                "month={}".format(partition[1]),
+            )
+            self.writers[key] = self._open_writer(table_name, directory)
+
+        return self.writers[key]
+
+    def _card_rows(self, deck):
+
+        cards = deck.get("cards")
+        if cards is None:
+            return
+
+        if isinstance(cards, str):
+            cards = parse_cards(cards, self.card_table)
+
+        for board in ("main", "side"):
+            for count, card_id in cards[board]:
+                yield deck["id"], board, count, card_id, self.card_table.names[card_id]
+
+    def add_page(self, deck_list):
+
+        """
+        Add the decks of a results page to the buffers of their partitions, and
+        write the buffers that reached the row group size.
+
+        Parameters
+        ----------
+        deck_list : list of dictionaries
+            The decks. If None (e.g., an empty results page), nothing is written
+        """
+
+        partitions = dict()
+        for deck in deck_list or list():
+            partitions.setdefault(deck_partition(deck), list()).append(deck)
+
+        for partition, decks in partitions.items():
+            deck_rows = {c: [deck.get(c) for deck in decks] for c in DECK_COLUMNS}
+            deck_rows["date"] = [parse_date(d) for d in deck_rows["date"]]
+
+            card_rows = [row for deck in decks for row in self._card_rows(deck)]
+            card_columns = zip(*card_rows) if card_rows else [[]] * 5
+
+            for table_name, columns in [
+                ("decks", deck_rows),
+                ("cards", dict(zip(self.schemas["cards"].names, card_columns))),
+            ]:
+                table = pa.Table.from_pydict(columns, self.schemas[table_name])
+                tables = self.buffers.setdefault((table_name, partition), list())
+                tables.append(table)
+                if sum(t.num_rows for t in tables) >= self.row_group_size:
+                    self._write((table_name, partition), tables)
+                    del self.buffers[(table_name, partition)]
+
+            self.n_decks += len(decks)
+
+        return
+
+    def close(self):
+
+        """
+        Write the buffered rows and the card table, and close the files, which
+        writes their footers and gives them their names. The files are not
+        read until they are closed.
+        """
+
+        for key, tables in self.buffers.items():
+            self._write(key, tables)
+        self.buffers = dict()
+
+        if len(self.writers) > 0:
+            names = self.card_table.names
+            table = pa.Table.from_pydict(
+                {"card_id": list(range(len(names))), "card": names},
+                self.schemas["card_table"],
+            )
+            writer = self._open_writer(
+                "card_table", os.path.join(self.root, "card_table")
+            )
+            writer.write_table(table)
+            writer.close()
+
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = dict()
+
+        for path, final_path in self.paths.items():
+            os.replace(path, final_path)
+        self.paths = dict()
+
+        return
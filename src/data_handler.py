@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
 import os
-from io import StringIO
-import boto3
+import json
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from io import StringIO, BytesIO
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # pylint: disable=W0105
 
@@ -11,47 +18,410 @@ import boto3
 This module defines classes that allow to write and read files
 in a system-independent manner. The class DataHandler is used if the operations are performed on the local file system. The class DataHandlerS3 
 is used if the operations are performed on AWS S3 buckets.
+
+Besides reading and writing whole files as string streams, the files can be
+streamed (see BaseDataHandler.open_read and BaseDataHandler.open_write), so
+large files are never held fully in memory. The files whose names end with .gz
+or .zst are compressed and decompressed transparently (zstd with zstandard,
+which is imported only when it is used).
+
+The class CachedDataHandlerS3 keeps a cache of the objects read from AWS S3, in
+memory or in the local file system, so the objects read repeatedly (e.g., the
+index of known decks) are downloaded only when they change.
 """
 
+# the compression of the files, by the suffix of their names
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+
+# size of the chunks in which the streams are copied, in bytes
+CHUNK_SIZE = 1024 * 1024
+
+# size of the parts of the S3 multipart uploads, in bytes (at least 5 MiB). The
+# objects smaller than a part are written with a single request
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+# default number of concurrent requests of DataHandlerS3.read_many and
+# DataHandlerS3.write_many (the size of the connection pool of the boto3
+# clients)
+DEFAULT_MAX_WORKERS = 10
+
+# default maximum size of the cache of CachedDataHandlerS3, in MiB
+DEFAULT_OBJECT_CACHE_SIZE = 256
 
-class DataHandler:
+
+def infer_compression(filename):
 
     """
-    This class provides methods to read and write files in the local file system.
+    Get the compression of a file from the suffix of its name.
+
+    Parameters
+    ----------
+    filename: string
+        The file name
+
+    Returns
+    -------
+    string
+        "gzip", "zstd" or None if the file is not compressed
     """
 
-    def __init__(self, root):
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(filename)[1])
+
+
+def load_zstandard():
+
+    """
+    Import zstandard, which is needed for the zstd compression.
+
+    Returns
+    -------
+    module
+        The zstandard module
+    """
+
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("the zstd compression requires zstandard") from e
+
+    return zstandard
+
+
+def copy_data(data, outfile):
+
+    """
+    Write data to a binary stream, encoding the strings as UTF-8.
+
+    Parameters
+    ----------
+    data: StringIO, BytesIO, string, bytes, file-like object or iterable
+        The data. The file-like objects are read in chunks, and the iterables
+        (e.g., a generator) must yield strings or bytes
+    outfile: file-like object
+        The binary stream
+    """
+
+    if hasattr(data, "getvalue"):
+        data = data.getvalue()
+
+    if isinstance(data, (str, bytes)):
+        chunks = [data]
+    elif hasattr(data, "read"):
+        chunks = iter(lambda: data.read(CHUNK_SIZE), data.read(0))
+    else:
+        chunks = data
+
+    for chunk in chunks:
+        outfile.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+
+    return
+
+
+class LocalFileWriter(io.BufferedIOBase):
+
+    """
+    This class writes a file of the local file system. The data is written to
+    a temporary file, which replaces the file when it is closed, so the file is
+    never left half-written.
+    """
+
+    def __init__(self, path):
 
         """
         Initialize the object.
 
         Parameters
         ----------
-        root: string
-            The root directory, with respect to which relative file paths are defined.
+        path: string
+            The path of the file
         """
 
-        self.root = root
+        super().__init__()
+        self.path = path
+        self.tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        self.outfile = open(self.tmp_path, "wb")
+
+    def writable(self):
+
+        return True
+
+    def write(self, b):
+
+        return self.outfile.write(b)
+
+    def close(self):
+
+        if not self.closed:
+            self.outfile.close()
+            os.replace(self.tmp_path, self.path)
+        super().close()
+
+    def abort(self):
+
+        """
+        Close the object discarding the written data.
+        """
+
+        self.outfile.close()
+        os.remove(self.tmp_path)
+        super().close()
+
+
+class S3ObjectWriter(io.BufferedIOBase):
+
+    """
+    This class writes an object of an AWS S3 bucket. The data is uploaded in
+    parts of MULTIPART_CHUNK_SIZE bytes as it is written (i.e., a multipart
+    upload), so only a part is held in memory. The objects smaller than a part
+    are written with a single request when the object is closed.
+    """
+
+    def __init__(self, client, bucket_name, key, part_size=MULTIPART_CHUNK_SIZE):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        client: botocore.client.BaseClient
+            The S3 client
+        bucket_name: string
+            The bucket name
+        key: string
+            The key of the object
+        part_size: int
+            The size of the parts of the multipart upload, in bytes
+        """
+
+        super().__init__()
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = list()
+
+    def writable(self):
+
+        return True
+
+    def _upload_part(self, data):
+
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key
+            )["UploadId"]
+
+        part_number = len(self.parts) + 1
+        res = self.client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(data),
+        )
+        self.parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+
+    def write(self, b):
+
+        if self.closed:
+            raise ValueError("write to closed file")
+
+        self.buffer += b
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(self.buffer[: self.part_size])
+            del self.buffer[: self.part_size]
+
+        return len(b)
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        if self.upload_id is None:
+            self.client.put_object(
+                Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer)
+            )
+        else:
+            if len(self.buffer) > 0:
+                self._upload_part(self.buffer)
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        self.buffer = bytearray()
+        super().close()
+
+    def abort(self):
+
+        """
+        Close the object discarding the written data (and the uploaded parts).
+        """
+
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id
+            )
+        self.buffer = bytearray()
+        super().close()
+
+
+class BaseDataHandler:
+
+    """
+    This class provides the methods shared by DataHandler and DataHandlerS3,
+    which are built on the streams opened by their methods _open_raw_read and
+    _open_raw_write.
+    """
 
-    def write(self, iostr, filename):
+    # number of concurrent operations of read_many and write_many
+    max_workers = 1
+
+    def _open_raw_read(self, filename):
+
+        raise NotImplementedError
+
+    def _open_raw_write(self, filename):
+
+        raise NotImplementedError
+
+    @contextmanager
+    def open_read(self, filename, mode="rb", compression="infer"):
+
+        """
+        Open a file for reading it as a stream, e.g.:
+
+            with data_handler.open_read("decks.json.gz", "r") as infile:
+                for line in infile:
+                    ...
+
+        Parameters
+        ----------
+        filename: string
+            The source file, including its relative path.
+        mode: string
+            "rb" to read bytes or "r" to read strings (UTF-8)
+        compression: string
+            "gzip", "zstd", None (no compression) or "infer" (from the suffix
+            of the file name, see COMPRESSION_SUFFIXES)
+
+        Yields
+        ------
+        file-like object
+            The stream
+        """
+
+        if compression == "infer":
+            compression = infer_compression(filename)
+
+        raw = self._open_raw_read(filename)
+        streams = [raw]
+        try:
+            if compression == "gzip":
+                streams.append(gzip.GzipFile(fileobj=raw, mode="rb"))
+            elif compression == "zstd":
+                # the files can be made of several frames (see deck_bundle)
+                decompressor = load_zstandard().ZstdDecompressor()
+                streams.append(
+                    decompressor.stream_reader(
+                        raw, read_across_frames=True, closefd=False
+                    )
+                )
+            if mode == "r":
+                streams.append(io.TextIOWrapper(streams[-1], encoding="utf-8"))
+
+            yield streams[-1]
+        finally:
+            for stream in reversed(streams):
+                stream.close()
+
+    @contextmanager
+    def open_write(self, filename, mode="wb", compression="infer"):
+
+        """
+        Open a file for writing it as a stream, e.g.:
+
+            with data_handler.open_write("decks.json.gz", "w") as outfile:
+                for deck in deck_list:
+                    outfile.write(json.dumps(deck) + "\n")
+
+        The file is written only if the block exits normally and the streams
+        are closed without errors. Otherwise, the written data is discarded
+        (e.g., the multipart upload of an S3 object is aborted).
+
+        Parameters
+        ----------
+        filename: string
+            The destination file, including its relative path.
+        mode: string
+            "wb" to write bytes or "w" to write strings (UTF-8)
+        compression: string
+            "gzip", "zstd", None (no compression) or "infer" (from the suffix
+            of the file name, see COMPRESSION_SUFFIXES)
+
+        Yields
+        ------
+        file-like object
+            The stream
+        """
+
+        if compression == "infer":
+            compression = infer_compression(filename)
+
+        raw = self._open_raw_write(filename)
+        streams = [raw]
+        try:
+            if compression == "gzip":
+                streams.append(gzip.GzipFile(fileobj=raw, mode="wb"))
+            elif compression == "zstd":
+                compressor = load_zstandard().ZstdCompressor()
+                streams.append(compressor.stream_writer(raw, closefd=False))
+            if mode == "w":
+                streams.append(io.TextIOWrapper(streams[-1], encoding="utf-8"))
+
+            yield streams[-1]
+
+            # the outer streams flush their data into the inner ones when closed
+            for stream in reversed(streams):
+                stream.close()
+        except BaseException:
+            try:
+                raw.abort()
+            finally:
+                # the outer streams are closed now, instead of being flushed
+                # into the aborted writer when they are garbage collected
+                for stream in reversed(streams[1:]):
+                    try:
+                        stream.close()
+                    except (OSError, ValueError):
+                        pass
+            raise
+
+    def write(self, data, filename):
 
         """
         Write a file.
 
         Parameters
         ----------
-        iostr: StringIO
-            The string stream with the data to be written.
+        data: StringIO, BytesIO, string, bytes, file-like object or iterable
+            The data to be written (see copy_data). The file-like objects and
+            the iterables are written as they are read, without holding them
+            fully in memory.
         filename: string
             The destination file, including its relative path.
         """
 
-        with open(self.root + "/" + filename, "w", encoding="utf-8") as outfile:
-            outfile.write(iostr.getvalue())
+        with self.open_write(filename) as outfile:
+            copy_data(data, outfile)
 
         return
 
-    def read(self, filename):
+    def read(self, filename, binary=False):
 
         """
         Read a file.
@@ -60,15 +430,140 @@ class DataHandler:
         ----------
         filename: string
             The source file, including its relative path.
+        binary: bool
+            Whether to return bytes instead of strings.
+
+        Returns
+        -------
+        StringIO or BytesIO
+            A string stream (or a bytes stream, if binary) with the read data.
+        """
+
+        with self.open_read(filename, "rb" if binary else "r") as infile:
+            data = infile.read()
+
+        return BytesIO(data) if binary else StringIO(data)
+
+    def read_many(self, filenames, binary=False):
+
+        """
+        Read several files, concurrently if the object allows it (see
+        max_workers).
+
+        Parameters
+        ----------
+        filenames: list of strings
+            The source files, including their relative paths.
+        binary: bool
+            Whether to return bytes instead of strings.
+
+        Returns
+        -------
+        dictionary
+            The streams with the read data (see read), by file name.
+        """
+
+        filenames = list(filenames)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            streams = executor.map(lambda f: self.read(f, binary), filenames)
+            return dict(zip(filenames, streams))
+
+    def write_many(self, files):
+
+        """
+        Write several files, concurrently if the object allows it (see
+        max_workers).
+
+        Parameters
+        ----------
+        files: dictionary
+            The data to be written (see write), by destination file.
+        """
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # consume the results, so the exceptions are raised
+            list(executor.map(lambda item: self.write(item[1], item[0]), files.items()))
+
+        return
+
+
+class DataHandler(BaseDataHandler):
+
+    """
+    This class provides methods to read and write files in the local file system.
+    """
+
+    def __init__(self, root):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        root: string
+            The root directory, with respect to which relative file paths are defined.
+        """
+
+        self.root = root
+
+    def _open_raw_read(self, filename):
+
+        return open(self.root + "/" + filename, "rb")
+
+    def _open_raw_write(self, filename):
+
+        return LocalFileWriter(self.root + "/" + filename)
+
+    def read_range(self, filename, offset, length):
+
+        """
+        Read a range of bytes of a file, as stored (i.e., without
+        decompressing it).
+
+        Parameters
+        ----------
+        filename: string
+            The source file, including its relative path.
+        offset: int
+            The position of the first byte
+        length: int
+            The number of bytes
+
+        Returns
+        -------
+        bytes
+            The read bytes.
+        """
+
+        with open(self.root + "/" + filename, "rb") as infile:
+            infile.seek(offset)
+            return infile.read(length)
+
+    def list_files(self, prefix=""):
+
+        """
+        List the files whose relative paths start with a prefix.
+
+        Parameters
+        ----------
+        prefix: string
+            The prefix (e.g., a directory followed by "/")
 
         Returns
         -------
-        StringIO
-            A string stream with the read data.
+        list of strings
+            The relative paths of the files, sorted.
         """
 
-        with open(self.root + "/" + filename, "r", encoding="utf-8") as infile:
-            return StringIO(infile.read())
+        filenames = list()
+        for dirpath, _, files in os.walk(self.root):
+            relpath = os.path.relpath(dirpath, self.root)
+            for f in files:
+                filename = f if relpath == "." else relpath + "/" + f
+                if filename.startswith(prefix):
+                    filenames.append(filename)
+
+        return sorted(filenames)
 
     def file_exists(self, filename):
 
@@ -92,14 +587,39 @@ class DataHandler:
             and os.stat(self.root + "/" + filename).st_size > 0
         )
 
+    def write_new(self, iostr, filename):
+
+        """
+        Write a file only if it does not exist. The check and the write are a
+        single atomic operation, so only one of several concurrent writers of
+        the same file succeeds.
+
+        Parameters
+        ----------
+        iostr: StringIO
+            The string stream with the data to be written.
+        filename: string
+            The destination file, including its relative path.
+
+        Raises
+        ------
+        FileExistsError
+            If the file already exists.
+        """
+
+        with open(self.root + "/" + filename, "x", encoding="utf-8") as outfile:
+            outfile.write(iostr.getvalue())
+
+        return
+
 
-class DataHandlerS3:
+class DataHandlerS3(BaseDataHandler):
 
     """
     This class provides methods to read and write files in an AWS S3 bucket.
     """
 
-    def __init__(self, bucket_name):
+    def __init__(self, bucket_name, client=None, max_workers=DEFAULT_MAX_WORKERS):
 
         """
         Initiallize the object.
@@ -108,15 +628,121 @@ class DataHandlerS3:
         ----------
         bucket_name : string
             The AWS S3ucket name
+        client : botocore.client.BaseClient
+            The S3 client. If None, a new one is created
+        max_workers : int
+            Number of concurrent requests of read_many and write_many
         """
 
+        if client is None:
+            # boto3 is imported here, so that it is not loaded by the users of
+            # DataHandler only
+            import boto3
+
+            client = boto3.client("s3")
+
         self.bucket_name = bucket_name
-        self.client = boto3.client("s3")
+        self.client = client
+        self.max_workers = max_workers
+
+    def _open_raw_read(self, filename):
 
-    def write(self, iostr, key):
+        return self.client.get_object(Bucket=self.bucket_name, Key=filename)["Body"]
+
+    def _open_raw_write(self, filename):
+
+        return S3ObjectWriter(self.client, self.bucket_name, filename)
+
+    def read_range(self, key, offset, length):
 
         """
-        Write a file.
+        Read a range of bytes of an object, as stored (i.e., without
+        decompressing it), with a ranged request.
+
+        Parameters
+        ----------
+        key: string
+            The key of the object in the S3 bucket.
+        offset: int
+            The position of the first byte
+        length: int
+            The number of bytes
+
+        Returns
+        -------
+        bytes
+            The read bytes.
+        """
+
+        res = self.client.get_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            Range="bytes={}-{}".format(offset, offset + length - 1),
+        )
+        with res["Body"] as body:
+            return body.read()
+
+    def list_files(self, prefix=""):
+
+        """
+        List the objects whose keys start with a prefix.
+
+        Parameters
+        ----------
+        prefix: string
+            The prefix (e.g., a "directory" followed by "/")
+
+        Returns
+        -------
+        list of strings
+            The keys of the objects, sorted.
+        """
+
+        keys = list()
+        kwargs = {"Bucket": self.bucket_name, "Prefix": prefix}
+        while True:
+            res = self.client.list_objects_v2(**kwargs)
+            keys += [obj["Key"] for obj in res.get("Contents", list())]
+            if not res.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = res["NextContinuationToken"]
+
+        return sorted(keys)
+
+    def file_exists(self, key):
+
+        """
+        Check if a file exists. It returns False if the file does not exist or if it
+        exists but has a size of 0 bytes.
+
+        Parameters
+        ----------
+        key: string
+            The key of the object in the S3 bucket.
+
+        Returns
+        -------
+        Bool
+            Whether the file exists or not.
+        """
+
+        from botocore.exceptions import ClientError
+
+        try:
+            res = self.client.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise e
+
+        return res["ContentLength"] > 0
+
+    def write_new(self, iostr, key):
+
+        """
+        Write a file only if it does not exist, using a conditional write
+        (If-None-Match), so only one of several concurrent writers of the same
+        key succeeds.
 
         Parameters
         ----------
@@ -124,26 +750,313 @@ class DataHandlerS3:
             The string stream with the data to be written.
         key: string
             The key of the object that is to be written in the S3 bucket.
+
+        Raises
+        ------
+        FileExistsError
+            If the object already exists.
         """
 
-        self.client.put_object(Bucket=self.bucket_name, Key=key, Body=iostr.getvalue())
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=iostr.getvalue(),
+                IfNoneMatch="*",
+            )
+        except ClientError as e:
+            # 409 is returned if a concurrent conditional write is in progress
+            if e.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                raise FileExistsError(key) from e
+            raise e
+
         return
 
-    def read(self, key):
+
+class ObjectCache:
+
+    """
+    This class implements a cache of the objects of S3 buckets, together with
+    their ETags, kept in memory or in the local file system. When the cache
+    exceeds its maximum size, the least recently used objects are evicted.
+
+    In the local file system, each object is stored in its own file, written
+    atomically, so the cache can be shared by several processes (e.g.,
+    consecutive runs of the command-line interface).
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_OBJECT_CACHE_SIZE * 2**20):
 
         """
-        Read a file.
+        Initialize the object.
+
+        Parameters
+        ----------
+        directory: string
+            The directory where the objects are stored. If None, they are kept
+            in memory
+        max_bytes: int
+            The maximum size of the cache, in bytes
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (etag, data) of each object, in order of last access, if the cache
+        # is kept in memory
+        self.objects = OrderedDict()
+        self.size = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.size = sum(size for _, _, size in self._entries())
+
+    def _path(self, bucket_name, key):
+
+        name = hashlib.sha256(str.encode(bucket_name + "/" + key)).hexdigest()
+
+        return os.path.join(self.directory, name[:2], name)
+
+    def _entries(self):
+
+        # (path, last access time, size) of each cached object
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                # skip the objects being written by other threads or processes
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, bucket_name, key):
+
+        """
+        Get a cached object.
 
         Parameters
         ----------
+        bucket_name: string
+            The bucket name
         key: string
-            The key of the object that is to be loaded from the S3 bucket.
+            The key of the object
 
         Returns
         -------
-        StringIO
-            A string stream with the loaded data.
+        Tuple
+            The ETag and the data (bytes) of the object, or None if it is not
+            cached
+        """
+
+        if self.directory is None:
+            with self.lock:
+                if (bucket_name, key) not in self.objects:
+                    return None
+                self.objects.move_to_end((bucket_name, key))
+                return self.objects[(bucket_name, key)]
+
+        path = self._path(bucket_name, key)
+        try:
+            with open(path, "rb") as infile:
+                meta = json.loads(infile.readline())
+                data = infile.read()
+            # the modification time keeps track of the last access for the LRU
+            # eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        return meta["etag"], data
+
+    def put(self, bucket_name, key, etag, data):
+
+        """
+        Store an object. The objects larger than the cache are not stored.
+
+        Parameters
+        ----------
+        bucket_name: string
+            The bucket name
+        key: string
+            The key of the object
+        etag: string
+            The ETag of the object
+        data: bytes
+            The data of the object
+        """
+
+        if len(data) > self.max_bytes:
+            return
+
+        if self.directory is None:
+            with self.lock:
+                old = self.objects.pop((bucket_name, key), None)
+                self.size -= 0 if old is None else len(old[1])
+                self.objects[(bucket_name, key)] = (etag, data)
+                self.size += len(data)
+                if self.size > self.max_bytes:
+                    self.evict()
+            return
+
+        path = self._path(bucket_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file and move it, so other processes never read
+        # a partially written object
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(str.encode(json.dumps({"key": key, "etag": etag}) + "\n"))
+            outfile.write(data)
+        size = os.path.getsize(tmp_path)
+        with self.lock:
+            # the object might replace an older version of it
+            try:
+                size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
+
+        return
+
+    def invalidate(self, bucket_name, key):
+
+        """
+        Remove an object from the cache, if it is cached.
+
+        Parameters
+        ----------
+        bucket_name: string
+            The bucket name
+        key: string
+            The key of the object
+        """
+
+        if self.directory is None:
+            with self.lock:
+                old = self.objects.pop((bucket_name, key), None)
+                self.size -= 0 if old is None else len(old[1])
+            return
+
+        path = self._path(bucket_name, key)
+        with self.lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                return
+            self.size -= size
+
+        return
+
+    def evict(self):
+
+        """
+        Remove the least recently used objects until the cache takes less than
+        90% of its maximum size. The caller must hold the lock.
+        """
+
+        if self.directory is None:
+            while self.size > 0.9 * self.max_bytes:
+                _, (_, data) = self.objects.popitem(last=False)
+                self.size -= len(data)
+            return
+
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.size = sum(size for _, _, size in entries)
+
+        for path, _, size in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+        return
+
+
+class CachedDataHandlerS3(DataHandlerS3):
+
+    """
+    This class reads and writes files in an AWS S3 bucket like DataHandlerS3,
+    keeping a read-through cache of the objects (see ObjectCache). A cached
+    object is revalidated with a conditional request (If-None-Match with its
+    ETag), which does not download the object again if it did not change. The
+    objects written through the object are removed from the cache.
+    """
+
+    def __init__(
+        self, bucket_name, cache=None, client=None, max_workers=DEFAULT_MAX_WORKERS
+    ):
+
         """
+        Initiallize the object.
+
+        Parameters
+        ----------
+        bucket_name : string
+            The AWS S3 bucket name
+        cache : ObjectCache
+            The cache, which can be shared by several objects. If None, a new
+            cache is kept in memory
+        client : botocore.client.BaseClient
+            The S3 client. If None, a new one is created
+        max_workers : int
+            Number of concurrent requests of read_many and write_many
+        """
+
+        super().__init__(bucket_name, client, max_workers)
+        self.cache = ObjectCache() if cache is None else cache
+
+    def _open_raw_read(self, filename):
+
+        from botocore.exceptions import ClientError
+
+        kwargs = {"Bucket": self.bucket_name, "Key": filename}
+        cached = self.cache.get(self.bucket_name, filename)
+        if cached is not None:
+            kwargs["IfNoneMatch"] = cached[0]
+
+        try:
+            res = self.client.get_object(**kwargs)
+        except ClientError as e:
+            if cached is not None and e.response["Error"]["Code"] in (
+                "304",
+                "NotModified",
+            ):
+                return BytesIO(cached[1])
+            raise e
+
+        # the objects that do not fit in the cache are streamed
+        if res["ContentLength"] > self.cache.max_bytes:
+            return res["Body"]
+
+        with res["Body"] as body:
+            data = body.read()
+        self.cache.put(self.bucket_name, filename, res["ETag"], data)
+
+        return BytesIO(data)
+
+    def _open_raw_write(self, filename):
+
+        self.cache.invalidate(self.bucket_name, filename)
+
+        return super()._open_raw_write(filename)
+
+    def write_new(self, iostr, key):
+
+        self.cache.invalidate(self.bucket_name, key)
 
-        res = self.client.get_object(Bucket=self.bucket_name, Key=key)["Body"].read()
-        return StringIO(res.decode("utf-8"))
+        return super().write_new(iostr, key)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import uuid
+import threading
+from contextlib import ExitStack
+
+from data_handler import load_zstandard
+
+# pylint: disable=W0105
+
+"""
+This module defines a writer that bundles the downloaded decks into compressed
+shards, i.e., files with a deck per line (NDJSON) of up to a number of decks or
+bytes, instead of writing an object or sending a message per deck. Thus, the
+decks are written, listed and scanned with a few requests.
+
+Each shard is a sequence of independently compressed blocks (zstd frames or
+gzip members), so it can be read whole as a regular compressed NDJSON file
+(e.g., with data_handler.DataHandler.open_read), and it has a sidecar index
+<shard>.idx.json with the position of the blocks and the block and line of each
+deck. Thus, a single deck is read with a ranged request of its block (see
+read_deck):
+
+    {
+    "shard": "decks/shard-<id>-00000.ndjson.zst",
+    "compression": "zstd",
+    "n_decks": 2,
+    "blocks": [[0, 1210]],
+    "decks": {"<deck id>": [0, 0], "<deck id>": [0, 1]}
+    }
+
+The index is written after its shard, so the shards with an index are
+complete.
+"""
+
+# the compression of the shards, and the suffixes of their names
+COMPRESSION_SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+# default compression of the shards
+DEFAULT_COMPRESSION = "zstd"
+
+# default maximum number of decks of a shard
+DEFAULT_MAX_DECKS = 10000
+
+# default maximum size of a shard, in bytes (compressed)
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# default size of the blocks, in bytes (uncompressed). The larger the blocks,
+# the better the compression, and the more bytes read to get a single deck
+DEFAULT_BLOCK_BYTES = 64 * 1024
+
+
+def compress_block(data, compression):
+
+    """
+    Compress a block of a shard.
+
+    Parameters
+    ----------
+    data: bytes
+        The block
+    compression: string
+        "zstd" or "gzip"
+
+    Returns
+    -------
+    bytes
+        The compressed block
+    """
+
+    if compression == "zstd":
+        return load_zstandard().ZstdCompressor().compress(data)
+
+    return gzip.compress(data, mtime=0)
+
+
+def decompress_block(data, compression):
+
+    """
+    Decompress a block of a shard (see compress_block).
+
+    Parameters
+    ----------
+    data: bytes
+        The compressed block
+    compression: string
+        "zstd" or "gzip"
+
+    Returns
+    -------
+    bytes
+        The block
+    """
+
+    if compression == "zstd":
+        return load_zstandard().ZstdDecompressor().decompress(data)
+
+    return gzip.decompress(data)
+
+
+def index_name(shard):
+
+    """
+    Get the name of the index of a shard.
+
+    Parameters
+    ----------
+    shard: string
+        The name of the shard
+
+    Returns
+    -------
+    string
+        The name of the index
+    """
+
+    return shard + ".idx.json"
+
+
+def read_deck(data_handler, shard, deck_id, index=None):
+
+    """
+    Read a deck of a shard, with a ranged read of its block.
+
+    Parameters
+    ----------
+    data_handler: DataHandler or DataHandlerS3
+        The object used to read the shard
+    shard: string
+        The name of the shard
+    deck_id: string
+        The id of the deck
+    index: dictionary
+        The index of the shard, if it was already read. If None, it is read
+
+    Returns
+    -------
+    dictionary
+        The deck
+
+    Raises
+    ------
+    KeyError
+        If the deck is not in the shard
+    """
+
+    if index is None:
+        index = json.load(data_handler.read(index_name(shard)))
+
+    block, line = index["decks"][deck_id]
+    offset, length = index["blocks"][block]
+    data = decompress_block(
+        data_handler.read_range(shard, offset, length), index["compression"]
+    )
+
+    return json.loads(data.splitlines()[line])
+
+
+class BundleWriter:
+
+    """
+    This class writes decks to shards (see the module's documentation). The
+    blocks are written as they are filled, so a shard is never held fully in
+    memory, and a new shard is started when the current one reaches its
+    maximum number of decks or bytes. The decks can be added from several
+    threads.
+    """
+
+    def __init__(
+        self,
+        data_handler,
+        prefix="",
+        compression=DEFAULT_COMPRESSION,
+        max_decks=DEFAULT_MAX_DECKS,
+        max_bytes=DEFAULT_MAX_BYTES,
+        block_bytes=DEFAULT_BLOCK_BYTES,
+    ):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        data_handler: DataHandler or DataHandlerS3
+            The object used to write the shards and their indices
+        prefix: string
+            The directory where the shards are written (or the prefix of the
+            keys of the objects, if they are written in S3)
+        compression: string
+            "zstd" (requires zstandard) or "gzip"
+        max_decks: int
+            The maximum number of decks of a shard
+        max_bytes: int
+            The maximum size of a shard, in bytes (compressed)
+        block_bytes: int
+            The size of the blocks, in bytes (uncompressed)
+        """
+
+        assert compression in COMPRESSION_SUFFIXES
+        if compression == "zstd":
+            load_zstandard()
+
+        self.data_handler = data_handler
+        self.prefix = prefix
+        self.compression = compression
+        self.max_decks = max_decks
+        self.max_bytes = max_bytes
+        self.block_bytes = block_bytes
+        self.file_id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+
+        # the names of the complete shards
+        self.shards = list()
+        self.n_decks = 0
+
+        # the shard being written
+        self.shard = None
+        self.stack = None
+        self.outfile = None
+        self.index = None
+        self.offset = 0
+
+        # the block being filled, and the ids of its decks
+        self.block = bytearray()
+        self.block_ids = list()
+
+    def _open_shard(self):
+
+        name = "shard-{}-{:05d}.ndjson{}".format(
+            self.file_id, len(self.shards), COMPRESSION_SUFFIXES[self.compression]
+        )
+        self.shard = self.prefix + "/" + name if self.prefix else name
+
+        # the blocks are compressed by this object, not by the data handler
+        self.stack = ExitStack()
+        self.outfile = self.stack.enter_context(
+            self.data_handler.open_write(self.shard, compression=None)
+        )
+        self.index = {
+            "shard": self.shard,
+            "compression": self.compression,
+            "n_decks": 0,
+            "blocks": list(),
+            "decks": dict(),
+        }
+        self.offset = 0
+
+    def _flush_block(self):
+
+        if len(self.block_ids) == 0:
+            return
+
+        data = compress_block(bytes(self.block), self.compression)
+        self.outfile.write(data)
+
+        n_block = len(self.index["blocks"])
+        self.index["blocks"].append([self.offset, len(data)])
+        for line, deck_id in enumerate(self.block_ids):
+            self.index["decks"][deck_id] = [n_block, line]
+        self.index["n_decks"] += len(self.block_ids)
+        self.offset += len(data)
+
+        self.block = bytearray()
+        self.block_ids = list()
+
+    def _close_shard(self):
+
+        if self.shard is None:
+            return
+
+        self._flush_block()
+        self.stack.close()
+        self.data_handler.write(
+            json.dumps(self.index, separators=(",", ":")), index_name(self.shard)
+        )
+
+        self.shards.append(self.shard)
+        self.shard = None
+
+    def add(self, deck):
+
+        """
+        Add a deck.
+
+        Parameters
+        ----------
+        deck: dictionary
+            The deck
+        """
+
+        line = str.encode(json.dumps(deck, separators=(",", ":")) + "\n")
+
+        with self.lock:
+            if self.shard is None:
+                self._open_shard()
+
+            self.block += line
+            self.block_ids.append(deck["id"])
+            self.n_decks += 1
+            if len(self.block) >= self.block_bytes:
+                self._flush_block()
+
+            n_decks = self.index["n_decks"] + len(self.block_ids)
+            if n_decks >= self.max_decks or self.offset >= self.max_bytes:
+                self._close_shard()
+
+        return
+
+    def add_page(self, deck_list):
+
+        """
+        Add the decks of a results page.
+
+        Parameters
+        ----------
+        deck_list : list of dictionaries
+            The decks. If None (e.g., an empty results page), nothing is added
+        """
+
+        for deck in deck_list or list():
+            self.add(deck)
+
+        return
+
+    def close(self):
+
+        """
+        Write the current shard and its index.
+
+        Returns
+        -------
+        list of strings
+            The names of all the shards written by the object
+        """
+
+        with self.lock:
+            self._close_shard()
+
+        return self.shards
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import uuid
+from io import StringIO
+
+# pylint: disable=W0105
+
+"""
+This module defines a persistent index of the decks that were already
+downloaded, identified by their keys (see download_decks.make_deck_key). It is
+stored through the classes of the module data_handler, so it can be kept in the
+local file system or in an AWS S3 bucket.
+"""
+
+
+class DeckIndex:
+
+    """
+    This class provides methods to check, add and save the keys of the known
+    decks. It can be passed as the argument skip_ids of
+    download_decks.download_decks_in_search_results, so that only the decks
+    that are not in the index are downloaded.
+
+    The index is stored as a set of text files, <name>-<unique id>.txt, with a
+    deck key per line. Each save writes the decks added since the previous one
+    to a new file with a conditional write (see DataHandler.write_new), so the
+    files are never rewritten and concurrent saves (e.g., by concurrent AWS Lambda
+    functions) cannot drop each other's decks. The files are read only once by
+    each object, and those written by others since then are read by refresh().
+    """
+
+    def __init__(self, data_handler, name):
+
+        """
+        Initialize the object, loading the index if it exists.
+
+        Parameters
+        ----------
+        data_handler: DataHandler or DataHandlerS3
+            The object used to read and write the index
+        name: string
+            The prefix of the index files (or of the keys of the objects if it
+            is stored in S3)
+        """
+
+        self.data_handler = data_handler
+        self.name = name
+        self.ids = set()
+        self.new_ids = set()
+        self.files = set()
+        self.refresh()
+
+    def _is_index_file(self, filename):
+
+        return filename.startswith(self.name + "-") and filename.endswith(".txt")
+
+    def refresh(self):
+
+        """
+        Load the index files that were written since the index was loaded (e.g.,
+        by other AWS Lambda functions).
+        """
+
+        filenames = [
+            f
+            for f in self.data_handler.list_files(self.name + "-")
+            if self._is_index_file(f) and f not in self.files
+        ]
+
+        for stream in self.data_handler.read_many(filenames).values():
+            self.ids |= set(stream.getvalue().split())
+        self.files |= set(filenames)
+
+        return
+
+    def __contains__(self, deck_id):
+
+        return deck_id in self.ids
+
+    def __len__(self):
+
+        return len(self.ids)
+
+    def add(self, deck_ids):
+
+        """
+        Add decks to the index. They are not saved until save() is called.
+
+        Parameters
+        ----------
+        deck_ids: iterable
+            The keys of the decks
+        """
+
+        deck_ids = set(deck_ids) - self.ids
+        self.ids |= deck_ids
+        self.new_ids |= deck_ids
+
+        return
+
+    def save(self):
+
+        """
+        Save the decks added since the previous save, if any, to a new index
+        file.
+        """
+
+        if len(self.new_ids) == 0:
+            return
+
+        filename = "{}-{}.txt".format(self.name, uuid.uuid4().hex)
+        self.data_handler.write_new(StringIO("\n".join(sorted(self.new_ids))), filename)
+        self.files.add(filename)
+        self.new_ids = set()
+
+        return
@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import json
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urljoin, parse_qs
 import argparse
-from progressbar import progressbar
-from joblib import Parallel, delayed
 import hashlib
+import datetime
 
 from helpers import LOG
+from metrics import METRICS, with_metrics
+from checkpoint import CheckpointJournal, page_key
+from card_list import CardTable, structure_decks
+from columnar_export import ColumnarSink, EXTENSIONS as EXPORT_FORMATS
+from columnar_export import load_pyarrow
+from deck_bundle import BundleWriter
+from scheduler import parse_formats, FormatScheduler
+from data_handler import DataHandler
+from parsers import get_parser, configure_parser
+from request_handler import send_request, configure_rate_limit, configure_cache
+from request_handler import configure_resilience, get_session, get_resilience
+from request_handler import canonical_url
+from request_handler import DEFAULT_CACHE_SIZE, DEFAULT_RESILIENCE
 
 # pylint: disable=W0105
 
@@ -21,6 +37,78 @@ into other scripts using the function download_decks_in_search_results, or
 deployed as a serverless application in AWS Lamba.
 """
 
+# the website's URL, with respect to which the relative links are defined, and
+# the URL of its search engine. Both can be changed with the environment
+# variable MTGTOP8_BASE_URL (e.g., to use a local replay server for testing,
+# see the module replay_server)
+BASE_URL = "https://www.mtgtop8.com/"
+SEARCH_URL = "https://www.mtgtop8.com/search"
+
+# default maximum number of concurrent requests per host of the asyncio engine
+DEFAULT_MAX_PER_HOST = 4
+
+# default number of results pages probed concurrently by discover_search_pages
+DEFAULT_N_PROBES = 4
+
+# default maximum number of results pages of the date windows in which the
+# search is split by discover_date_windows
+DEFAULT_MAX_WINDOW_PAGES = 50
+
+# format of the dates of the search payloads
+PAYLOAD_DATE_FORMAT = "%d/%m/%Y"
+
+
+def configure_base_url(base_url):
+
+    """
+    Set the website's URL used by this process and by the child processes started
+    afterwards.
+
+    Parameters
+    ----------
+    base_url: string
+        The URL (e.g., "http://localhost:8080/"). If None, www.mtgtop8.com is used
+    """
+
+    os.environ["MTGTOP8_BASE_URL"] = base_url or ""
+
+    return
+
+
+def get_base_url():
+
+    """
+    Get the website's URL, with respect to which the relative links are defined.
+
+    Returns
+    -------
+    String
+        The URL, ending in "/"
+    """
+
+    base_url = os.environ.get("MTGTOP8_BASE_URL")
+    if not base_url:
+        return BASE_URL
+
+    return base_url.rstrip("/") + "/"
+
+
+def get_search_url():
+
+    """
+    Get the URL of the website's search engine.
+
+    Returns
+    -------
+    String
+        The URL
+    """
+
+    if not os.environ.get("MTGTOP8_BASE_URL"):
+        return SEARCH_URL
+
+    return urljoin(get_base_url(), "search")
+
 
 def make_deck_hash(deck):
 
@@ -51,6 +139,39 @@ def make_deck_hash(deck):
     return deck_hash
 
 
+def make_deck_key(deck):
+
+    """
+    Compute a key that identifies a deck without collisions, to tell which decks
+    were already downloaded (see deck_index.DeckIndex). The id of make_deck_hash
+    is too short for that: with millions of decks, some of them share it.
+
+    The key is the id of the deck in mtgtop8.com (the parameter d of its link),
+    or the full hash of its player, date and event if the link has none.
+
+    Parameters
+    ----------
+    deck: dictionary
+        A deck with at least the keys 'link', 'player', 'date' and 'event'
+
+    Returns
+    -------
+    String
+        The deck key
+    """
+
+    deck_ids = parse_qs(urlparse(deck["link"]).query).get("d")
+    if deck_ids:
+        return "d" + deck_ids[0]
+
+    x = deck["player"].strip(" ").replace("\r", "").replace("\n", "")
+    y = deck["date"]
+    z = deck["event"].strip(" ").replace("\r", "").replace("\n", "")
+    deck_str_id = "{}|{}|{}".format(x, y, z)
+
+    return hashlib.sha224(str.encode(deck_str_id)).hexdigest()
+
+
 def get_list(session_requests, payload):
 
     """
@@ -81,55 +202,45 @@ def get_list(session_requests, payload):
         be found)
     """
 
-    url = "http://mtgtop8.com/search"
+    url = get_search_url()
 
     # request a list of decks from the search form
-    deck_list_web = session_requests.post(url, data=payload)
+    with METRICS.timer("search_request"):
+        deck_list_web = send_request(session_requests, "POST", url, data=payload)
     deck_list_web.raise_for_status()
 
-    # parse the html reponse
-    deck_list_soup = BeautifulSoup(deck_list_web.content, features="lxml")
+    return parse_list(deck_list_web.content)
 
-    # main table with the deck list
-    table = deck_list_soup.findAll("tr", {"class": "hover_tr"})
-
-    # relative links to the decks
-    rel_links = [
-        td.find_all("td", {"class": "S12"})[0].find("a")["href"] for td in table
-    ]
 
-    # name of the decks
-    names = [td.find_all("td", {"class": "S12"})[0].find("a").getText() for td in table]
+def parse_list(content):
 
-    # name of the player
-    players = [td.find("td", {"class": "G12"}).getText() for td in table]
-
-    # name of the event
-    events = [td.find("td", {"class": "S11"}).getText() for td in table]
+    """
+    Parse the list of decks returned by the search engine
 
-    # make the absolute link to the deck
-    links = ["https://www.mtgtop8.com/" + ref for ref in rel_links]
+    Parameters
+    ----------
+    content : bytes
+        The html response of the search engine
 
-    # results of the decks in the competitions
-    results = [td.find_all("td", {"class": "S12"})[1].getText() for td in table]
+    Returns
+    -------
+    List of dictionaries
+        Each dictionary in the list corresponds to the metadata of each deck,
+        including the link to its page (see get_list)
+    """
 
-    # date of the competition in which the deck was played
-    dates = [td.find_all("td", {"class": "S11"})[1].getText() for td in table]
+    deck_list = list()
 
-    deck_list = [
-        {
-            "link": x[0],
-            "result": x[1],
-            "date": x[2],
-            "player": x[3],
-            "event": x[4],
-            "name": x[5],
-        }
-        for x in zip(links, results, dates, players, events, names)
-    ]
+    # the html is parsed by the selected parser (see the module parsers)
+    with METRICS.timer("parse_list"):
+        rows = get_parser().parse_list(content)
 
-    for deck in deck_list:
+    for row in rows:
+        # make the absolute link to the deck
+        deck = {"link": get_base_url() + row.pop("rel_link")}
+        deck.update(row)
         deck["id"] = make_deck_hash(deck)
+        deck_list.append(deck)
 
     return deck_list
 
@@ -155,29 +266,68 @@ def get_composition(session_requests, deck):
     """
 
     # request a specific deck's website
-    deck_web = session_requests.get(deck["link"])
+    with METRICS.timer("deck_request"):
+        deck_web = send_request(session_requests, "GET", deck["link"])
     deck_web.raise_for_status()
 
-    # parse the html reponse
-    deck_web_soup = BeautifulSoup(deck_web.content, features="lxml")
+    download_rel_link, deck_type = parse_deck_page(deck_web.content)
 
-    # the div with the download link has ' MTGO' on its text, and the next div
-    # is the one with the deck type. We create a generator of divs to find
-    # the one with the text, and then get and keep the next one
-    div_list = (d for d in deck_web_soup.find_all("div", {"class": "S14"}))
-    div = None
+    # download the deck's list of cards
+    download_abs_link = get_base_url() + download_rel_link
+    with METRICS.timer("export_request"):
+        deck_cards = send_request(
+            session_requests, "GET", download_abs_link, allow_redirects=True
+        )
+    deck_cards.raise_for_status()
 
-    for div in div_list:
-        if " MTGO" in div.getText():
-            break
+    return update_deck(deck, deck_cards.content, deck_type)
 
-    # download the deck's list of cards
-    assert div is not None
-    div_link = div
-    download_rel_link = div_link.find("a")["href"]
-    download_abs_link = "https://www.mtgtop8.com/" + download_rel_link
-    deck_cards = session_requests.get(download_abs_link, allow_redirects=True)
-    deck["cards"] = deck_cards.content.decode(encoding="ISO-8859-1")
+
+def parse_deck_page(content):
+
+    """
+    Parse a deck's page to find the link to the MTGO file with the cards and
+    the deck's type
+
+    Parameters
+    ----------
+    content : bytes
+        The html response of the deck's page
+
+    Returns
+    -------
+    Tuple
+        The relative link to the MTGO file and the deck type (None if the
+        deck type could not be parsed)
+    """
+
+    with METRICS.timer("parse_deck_page"):
+        return get_parser().parse_deck_page(content)
+
+
+def update_deck(deck, cards_content, deck_type):
+
+    """
+    Update a deck's metadata with its cards and type
+
+    Parameters
+    ----------
+    deck: dictionary
+        A deck's metadata. This dictionary is updated during this function call.
+
+    cards_content : bytes
+        The content of the MTGO file with the deck's cards
+
+    deck_type : string
+        The deck type, as returned by parse_deck_page
+
+    Returns
+    -------
+    dictionary
+        The input deck, updated with the cards that compose it and the deck type
+    """
+
+    deck["cards"] = cards_content.decode(encoding="ISO-8859-1")
 
     # better for parsing csv
     deck["cards"] = deck["cards"].replace("\n", ";\n")
@@ -185,12 +335,9 @@ def get_composition(session_requests, deck):
     # make the split cards names to have the same double slash format
     deck["cards"] = deck["cards"].replace("/", "//")
 
-    try:
-        div_type = next(div_list)
-        deck_type = div_type.find("a").getText().replace(" decks", "")
+    if deck_type is not None:
         deck["type"] = deck_type
-
-    except StopIteration:
+    else:
         # sometimes the deck type is missing, which results in StopIteration exception.
         # This problem seems to occur whenever the deck type is given as mana symbols
         # instead of as words
@@ -200,6 +347,8 @@ def get_composition(session_requests, deck):
         )
         deck["type"] = "unkown"
 
+    METRICS.count("decks")
+
     return deck
 
 
@@ -242,7 +391,7 @@ def make_search_payloads(payload):
         The list of payloads corresponding to individual result pages.
     """
 
-    session_requests = requests.session()
+    session_requests = get_session()
 
     n = 1
     payload["current_page"] = n
@@ -286,7 +435,260 @@ def make_search_payloads(payload):
     return payload_list
 
 
-def download_decks_in_search_results(payload):
+def search_hint_key(payload):
+
+    """
+    Make the key under which the number of results pages of a template payload
+    is remembered (see discover_search_pages). Payloads with the same search
+    filters share the key regardless of their dates, since the number of pages
+    of a date range is a good starting point for the next similar one.
+
+    Parameters
+    ----------
+    payload : dictionary
+        A template payload for the search engine
+
+    Returns
+    -------
+    String
+        The key
+    """
+
+    filters = {
+        k: v
+        for k, v in payload.items()
+        if k not in ("current_page", "date_start", "date_end")
+    }
+
+    return json.dumps(filters, sort_keys=True)
+
+
+def discover_search_pages(
+    payload, hint=None, n_probes=DEFAULT_N_PROBES, allow_empty=False
+):
+
+    """
+    Make the payloads needed for querying the search engine, like
+    make_search_payloads, but probing several results pages concurrently and
+    keeping the decks of the probed pages so they do not need to be
+    downloaded again.
+
+    The search first probes pages 1, 2, 4, 8... (or pages around the hint, if
+    given) until an empty page is found, and then probes n_probes pages evenly
+    distributed between the last non-empty page and the first empty one, until
+    they are consecutive.
+
+    Parameters
+    ----------
+    payload : dictionary
+        A template payload for the search engine (see make_search_payloads)
+
+    hint : int
+        The expected number of results pages (e.g., the number found the last
+        time, see search_hint_key). If None, the search starts from scratch
+
+    n_probes : int
+        Number of results pages probed concurrently
+
+    allow_empty : bool
+        Whether the search can have no results (e.g., a short date range). If
+        False, an empty first page is an error
+
+    Returns
+    -------
+    Tuple
+        The list of payloads corresponding to individual result pages, and a
+        dictionary {current_page: deck_list} with the decks of the results
+        pages that were downloaded during the search (see get_list)
+    """
+
+    session_requests = get_session()
+    deck_lists = dict()
+    empty_pages = set()
+
+    def probe(pages):
+        pages = sorted(set(pages) - set(deck_lists) - empty_pages)
+        with ThreadPoolExecutor(max_workers=n_probes) as executor:
+            results = executor.map(
+                lambda n: get_list(session_requests, dict(payload, current_page=n)),
+                pages,
+            )
+            for n, deck_list in zip(pages, results):
+                if len(deck_list) > 0:
+                    deck_lists[n] = deck_list
+                else:
+                    empty_pages.add(n)
+
+        # last non-empty page and first empty page found so far
+        nmax = min(empty_pages) if len(empty_pages) > 0 else None
+        nmin = max((n for n in deck_lists if nmax is None or n < nmax), default=0)
+
+        return nmin, nmax
+
+    # the first page must never be empty, otherwise we are searching wrongly, so
+    # it is always probed in the first round (its decks are not wasted anyway)
+    first_round = [1]
+    if hint is not None and hint > 1:
+        first_round += [hint, hint + 1]
+    while len(first_round) < n_probes:
+        first_round.append(2 * max(first_round))
+
+    nmin, nmax = probe(first_round)
+    if allow_empty and 1 not in deck_lists:
+        return list(), dict()
+    assert 1 in deck_lists
+
+    # look for an empty page by doubling the last non-empty one
+    while nmax is None:
+        nmin, nmax = probe([nmin * 2**i for i in range(1, n_probes + 1)])
+
+    # narrow the interval between the last non-empty page and the first empty
+    # one by probing evenly distributed pages within it. When nmax == nmin+1,
+    # nmin is the last page with valid search results that we are looking for
+    while nmax != nmin + 1:
+        step = (nmax - nmin) / (n_probes + 1)
+        nmin, nmax = probe(
+            [
+                min(nmin + max(1, round(step * i)), nmax - 1)
+                for i in range(1, n_probes + 1)
+            ]
+        )
+
+    payload_list = [dict(payload, current_page=n) for n in range(1, nmax)]
+    deck_lists = {n: deck_list for n, deck_list in deck_lists.items() if n < nmax}
+
+    return payload_list, deck_lists
+
+
+def split_date_window(payload):
+
+    """
+    Split the date range of a payload into two halves.
+
+    Parameters
+    ----------
+    payload : dictionary
+        A template payload for the search engine, with the dates in
+        PAYLOAD_DATE_FORMAT (e.g., 25/09/2021)
+
+    Returns
+    -------
+    Tuple
+        The payloads of the first and the second half of the date range, which
+        do not overlap, or None if the range is a single day or the payload
+        does not have a date range
+    """
+
+    try:
+        start = datetime.datetime.strptime(payload["date_start"], PAYLOAD_DATE_FORMAT)
+        end = datetime.datetime.strptime(payload["date_end"], PAYLOAD_DATE_FORMAT)
+    except (KeyError, ValueError):
+        return None
+
+    if end <= start:
+        return None
+
+    middle = start + (end - start) // 2
+    first = dict(payload, date_end=middle.strftime(PAYLOAD_DATE_FORMAT))
+    second = dict(
+        payload,
+        date_start=(middle + datetime.timedelta(days=1)).strftime(PAYLOAD_DATE_FORMAT),
+    )
+
+    return first, second
+
+
+def discover_date_windows(
+    payload, max_pages=DEFAULT_MAX_WINDOW_PAGES, hint=None, n_probes=DEFAULT_N_PROBES
+):
+
+    """
+    Find the payloads of the results pages of a search, splitting its date
+    range into windows of at most max_pages results pages each. The date range
+    is halved recursively until each window has at most max_pages results
+    pages (or it is a single day), probing the windows of each round
+    concurrently, and then the results pages of the windows are discovered
+    concurrently too (see discover_search_pages).
+
+    Thus, long date ranges (e.g., a backfill of several years) are not
+    searched by deep pagination, which is slow to discover, and the payloads
+    of a window are not shifted by the decks added to later windows during the
+    crawl.
+
+    Parameters
+    ----------
+    payload : dictionary
+        A template payload for the search engine (see make_search_payloads)
+
+    max_pages : int
+        Maximum number of results pages of each window
+
+    hint : int
+        The expected number of results pages of the search, if it is not split
+        (see discover_search_pages)
+
+    n_probes : int
+        Number of windows probed concurrently, and of results pages probed
+        concurrently within each window
+
+    Returns
+    -------
+    Tuple
+        The list of payloads corresponding to individual result pages, a list
+        with the decks of each of those results pages (or None if they were not
+        downloaded during the search), and the list of template payloads of the
+        windows
+    """
+
+    session_requests = get_session()
+
+    # a window is too large if it has a results page after max_pages
+    def too_large(window):
+        probe = dict(window, current_page=max_pages + 1)
+        return len(get_list(session_requests, probe)) > 0
+
+    windows = list()
+    pending = [payload]
+    with ThreadPoolExecutor(max_workers=n_probes) as executor:
+        while len(pending) > 0:
+            halves = [
+                split_date_window(window) if large else None
+                for window, large in zip(pending, executor.map(too_large, pending))
+            ]
+            windows += [w for w, h in zip(pending, halves) if h is None]
+            pending = [w for h in halves if h is not None for w in h]
+
+        # the hint is the number of pages of the whole date range
+        if windows != [payload]:
+            hint = None
+            windows.sort(
+                key=lambda w: datetime.datetime.strptime(
+                    w["date_start"], PAYLOAD_DATE_FORMAT
+                )
+            )
+
+        results = list(
+            executor.map(
+                lambda w: discover_search_pages(w, hint, n_probes, len(windows) > 1),
+                windows,
+            )
+        )
+
+    # the windows are sorted by date, as their results pages
+    payload_list = list()
+    deck_lists = list()
+    for window_payloads, window_deck_lists in results:
+        payload_list += window_payloads
+        deck_lists += [
+            window_deck_lists.get(p["current_page"]) for p in window_payloads
+        ]
+
+    return payload_list, deck_lists, windows
+
+
+def download_decks_in_search_results(
+    payload, skip_ids=None, on_deck=None, deck_list=None, stop=None
+):
 
     """
     Download the decks returned by the search engine when queried with the payload.
@@ -305,30 +707,554 @@ def download_decks_in_search_results(payload):
                   'date_end': '01/01/2020'
                   }
 
+    skip_ids : container
+        Keys (see make_deck_key) of decks that must not be downloaded. They are
+        left out of the returned list
+
+    on_deck : function
+        A function called as on_deck(position, deck) after each deck is
+        downloaded, with the position of the deck within the results page
+
+    deck_list : list of dictionaries
+        The decks of the results page, if they were already downloaded (see
+        discover_search_pages). If None, they are downloaded
+
+    stop : function
+        A function called as stop() before each deck is downloaded. If it
+        returns True, the remaining decks are not downloaded (e.g., when a time
+        budget runs out)
+
     Returns
     -------
     List of dictionaries
         The list of payloads corresponding to individual result pages.
     """
 
-    session_requests = requests.session()
+    session_requests = get_session()
+    METRICS.count("pages")
 
-    deck_list = get_list(session_requests, payload)
+    if deck_list is None:
+        deck_list = get_list(session_requests, payload)
     if len(deck_list) == 0:
         return
 
-    for deck in deck_list:
+    downloaded = list()
+
+    for position, deck in enumerate(deck_list):
+        if skip_ids is not None and make_deck_key(deck) in skip_ids:
+            continue
+        if stop is not None and stop():
+            break
+
         # this call updates the input deck dictionary with extra data
         deck = get_composition(session_requests, deck)
+        downloaded.append(deck)
+
+        if on_deck is not None:
+            on_deck(position, deck)
+
+    return downloaded
+
+
+def download_decks_with_journal(payload, journal, skip_ids=None, deck_list=None):
+
+    """
+    Download the decks returned by the search engine when queried with the
+    payload, recording each downloaded deck and the finished results page in a
+    checkpoint journal.
+
+    Parameters
+    ----------
+    payload : dictionary
+        A payload for the search engine (see download_decks_in_search_results)
+
+    journal : checkpoint.CheckpointJournal
+        The journal
+
+    skip_ids : container
+        Keys of the decks of the page that were already recorded in the journal
+
+    deck_list : list of dictionaries
+        The decks of the results page, if they were already downloaded
+
+    Returns
+    -------
+    List of dictionaries
+        The downloaded decks
+    """
+
+    deck_list = download_decks_in_search_results(
+        payload,
+        skip_ids,
+        lambda position, deck: journal.add_deck(payload, position, deck),
+        deck_list,
+    )
+    journal.add_page(payload)
 
     return deck_list
 
 
+def count_page_requests(deck_list, searched):
+
+    """
+    Count the requests needed to download the decks of a results page (e.g., to
+    charge them to the format of the page, see scheduler.FormatScheduler).
+
+    Parameters
+    ----------
+    deck_list : list of dictionaries
+        The downloaded decks of the results page (None if there are none)
+
+    searched : bool
+        Whether the results page was requested, i.e., its decks were not
+        already downloaded (see discover_search_pages)
+
+    Returns
+    -------
+    int
+        The number of requests: the search request, if any, and the requests
+        of the page and the MTGO file of each deck
+    """
+
+    return int(searched) + 2 * len(deck_list or list())
+
+
+class HostLimiter:
+
+    """
+    This class bounds the number of concurrent requests sent to each host by
+    the asyncio engine. The blocking requests calls are run in a thread pool
+    large enough to keep every host busy up to its limit.
+
+    The requests are also bounded by the concurrency controller of their host
+    and by the connection pool of the session, whose size is the maximum
+    number of concurrent requests of the controller (see
+    request_handler.configure_resilience), so it must be at least
+    max_per_host.
+    """
+
+    def __init__(self, max_per_host=DEFAULT_MAX_PER_HOST):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        max_per_host: int
+            Maximum number of concurrent requests per host
+        """
+
+        self.max_per_host = max_per_host
+        self.semaphores = dict()
+        # room for two hosts (e.g., the website and a local replay server)
+        self.executor = ThreadPoolExecutor(max_workers=2 * max_per_host)
+
+        max_concurrency = get_resilience()["max_concurrency"]
+        if max_per_host > max_concurrency:
+            LOG.warning(
+                "At most %d concurrent requests per host are sent, not %d (see "
+                "request_handler.configure_resilience)",
+                max_concurrency,
+                max_per_host,
+            )
+
+    def semaphore(self, url):
+
+        """
+        Get the semaphore of the host of a URL.
+
+        Parameters
+        ----------
+        url: string
+            The URL
+
+        Returns
+        -------
+        asyncio.Semaphore
+            The semaphore bounding the concurrent requests to the URL's host
+        """
+
+        # the hosts of the website are normalized, as in send_request
+        host = urlparse(canonical_url(url)).netloc
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.max_per_host)
+
+        return self.semaphores[host]
+
+    async def request(self, session_requests, method, url, **kwargs):
+
+        """
+        Send a request without blocking the event loop, waiting first until the
+        URL's host has a free slot (see request_handler.send_request).
+
+        Parameters
+        ----------
+        session_requests : requests.Session object
+            A Session objects from the requests module
+        method: string
+            The HTTP method
+        url: string
+            The URL
+        kwargs:
+            Extra arguments for requests.Session.request
+
+        Returns
+        -------
+        requests.Response object
+            The response
+        """
+
+        loop = asyncio.get_running_loop()
+        call = functools.partial(send_request, session_requests, method, url, **kwargs)
+
+        async with self.semaphore(url):
+            return await loop.run_in_executor(self.executor, call)
+
+    def close(self):
+
+        """
+        Shut down the thread pool.
+        """
+
+        self.executor.shutdown(wait=False)
+
+
+async def async_get_list(session_requests, limiter, payload):
+
+    """
+    Asyncio version of get_list.
+
+    Parameters
+    ----------
+    session_requests : requests.Session object
+        A Session objects from the requests module
+
+    limiter : HostLimiter
+        The limiter bounding the concurrent requests per host
+
+    payload : dictionary
+        A payload for the search engine (see get_list)
+
+    Returns
+    -------
+    List of dictionaries
+        The metadata of each deck (see get_list)
+    """
+
+    url = get_search_url()
+
+    with METRICS.timer("search_request"):
+        deck_list_web = await limiter.request(
+            session_requests, "POST", url, data=payload
+        )
+    deck_list_web.raise_for_status()
+
+    return parse_list(deck_list_web.content)
+
+
+async def async_get_composition(session_requests, limiter, deck):
+
+    """
+    Asyncio version of get_composition.
+
+    Parameters
+    ----------
+    session_requests : requests.Session object
+        A Session objects from the requests module
+
+    limiter : HostLimiter
+        The limiter bounding the concurrent requests per host
+
+    deck: dictionary
+        A deck's metadata, including the link to its page. This dictionary
+        is updated during this function call.
+
+    Returns
+    -------
+    dictionary
+        The input deck, updated with the cards that compose it and the deck type
+    """
+
+    with METRICS.timer("deck_request"):
+        deck_web = await limiter.request(session_requests, "GET", deck["link"])
+    deck_web.raise_for_status()
+
+    download_rel_link, deck_type = parse_deck_page(deck_web.content)
+
+    download_abs_link = get_base_url() + download_rel_link
+    with METRICS.timer("export_request"):
+        deck_cards = await limiter.request(
+            session_requests, "GET", download_abs_link, allow_redirects=True
+        )
+    deck_cards.raise_for_status()
+
+    return update_deck(deck, deck_cards.content, deck_type)
+
+
+async def async_download_decks_in_search_results(
+    payload,
+    session_requests=None,
+    limiter=None,
+    skip_ids=None,
+    on_deck=None,
+    deck_list=None,
+):
+
+    """
+    Asyncio version of download_decks_in_search_results. The pages and MTGO
+    files of all the decks in the results page are downloaded concurrently.
+
+    Parameters
+    ----------
+    payload : dictionary
+        A payload for the search engine (see download_decks_in_search_results)
+
+    session_requests : requests.Session object
+        A Session objects from the requests module. If None, a new one is created.
+
+    limiter : HostLimiter
+        The limiter bounding the concurrent requests per host. If None, a new
+        one is created with the default limit. Share it between calls to
+        bound the requests of several results pages downloaded concurrently.
+
+    skip_ids : container
+        Keys of decks that must not be downloaded (see download_decks_in_search_results)
+
+    on_deck : function
+        A function called as on_deck(position, deck) after each deck is
+        downloaded (see download_decks_in_search_results)
+
+    deck_list : list of dictionaries
+        The decks of the results page, if they were already downloaded (see
+        discover_search_pages). If None, they are downloaded
+
+    Returns
+    -------
+    List of dictionaries
+        The decks in the results page (empty if the page has no results)
+    """
+
+    async def download_deck(position, deck):
+        # this call updates the input deck dictionary with extra data
+        await async_get_composition(session_requests, limiter, deck)
+        if on_deck is not None:
+            on_deck(position, deck)
+
+    if session_requests is None:
+        session_requests = get_session()
+    METRICS.count("pages")
+
+    own_limiter = limiter is None
+    if own_limiter:
+        limiter = HostLimiter()
+
+    try:
+        if deck_list is None:
+            deck_list = await async_get_list(session_requests, limiter, payload)
+
+        if skip_ids is not None:
+            positions = [
+                (position, deck)
+                for position, deck in enumerate(deck_list)
+                if make_deck_key(deck) not in skip_ids
+            ]
+        else:
+            positions = list(enumerate(deck_list))
+
+        await asyncio.gather(
+            *[download_deck(position, deck) for position, deck in positions]
+        )
+    finally:
+        if own_limiter:
+            limiter.close()
+
+    return [deck for _, deck in positions]
+
+
+async def async_download_decks(
+    payload_list,
+    max_per_host=DEFAULT_MAX_PER_HOST,
+    journal=None,
+    skip_ids=None,
+    deck_lists=None,
+    on_page=None,
+    format_scheduler=None,
+):
+
+    """
+    Download concurrently the decks of several results pages, sharing the
+    same session and the same limit of concurrent requests per host.
+
+    Parameters
+    ----------
+    payload_list : list of dictionaries
+        The payloads of the results pages (see make_search_payloads)
+
+    max_per_host : int
+        Maximum number of concurrent requests per host
+
+    journal : checkpoint.CheckpointJournal
+        A journal where the downloaded decks and finished results pages are
+        recorded (see download_decks_with_journal). If None, nothing is recorded
+
+    skip_ids : dictionary
+        Keys of the decks that must not be downloaded, for each results page
+        (i.e., {page key: deck keys}, see checkpoint.page_key)
+
+    deck_lists : dictionary
+        The decks of the results pages that were already downloaded, for each
+        results page (i.e., {page key: deck_list}, see discover_search_pages
+        and checkpoint.page_key)
+
+    on_page : function
+        A function called as on_page(deck_list) as soon as the decks of each
+        results page are downloaded. If given, the decks are not kept after
+        the call, so that the memory does not grow with the number of pages
+
+    format_scheduler : scheduler.FormatScheduler
+        A scheduler holding the results pages of payload_list. If given, the
+        results pages are taken from it as they can be downloaded (at most
+        max_per_host at a time), and charged the requests they needed, so the
+        requests are split between the formats of the pages by the scheduler.
+        Otherwise, all of them are started at once
+
+    Returns
+    -------
+    List of lists of dictionaries
+        The decks of each results page, in the same order as payload_list (None
+        if on_page is given)
+    """
+
+    session_requests = get_session()
+    limiter = HostLimiter(max_per_host)
+    skip_ids = skip_ids or dict()
+    deck_lists = deck_lists or dict()
+
+    async def download_page(payload):
+        on_deck = None
+        if journal is not None:
+            on_deck = lambda position, deck: journal.add_deck(payload, position, deck)
+
+        deck_list = await async_download_decks_in_search_results(
+            payload,
+            session_requests,
+            limiter,
+            skip_ids.get(page_key(payload)),
+            on_deck,
+            deck_lists.get(page_key(payload)),
+        )
+
+        if journal is not None:
+            journal.add_page(payload)
+
+        if format_scheduler is not None:
+            searched = page_key(payload) not in deck_lists
+            format_scheduler.done(payload, count_page_requests(deck_list, searched))
+
+        if on_page is not None:
+            on_page(deck_list)
+            return None
+
+        return deck_list
+
+    # the results pages taken from the scheduler, by page key
+    results = dict()
+
+    async def download_scheduled_pages():
+        for payload in iter(format_scheduler.take, None):
+            results[page_key(payload)] = await download_page(payload)
+
+    try:
+        if format_scheduler is None:
+            deck_double_list = await asyncio.gather(
+                *[download_page(payload) for payload in payload_list]
+            )
+        else:
+            await asyncio.gather(
+                *[download_scheduled_pages() for _ in range(max_per_host)]
+            )
+            deck_double_list = [results[page_key(p)] for p in payload_list]
+    finally:
+        limiter.close()
+
+    if on_page is not None:
+        return None
+
+    return deck_double_list
+
+
+def serialize_decks(deck_double_list, card_table=None):
+
+    """
+    Serialize the decks of several results pages as a JSON object {index: deck},
+    with the decks indexed in the order of the results pages.
+
+    Parameters
+    ----------
+    deck_double_list : list of lists of dictionaries
+        The decks of each results page
+
+    card_table : card_list.CardTable
+        The table of the card ids, if the cards of the decks are structured
+        (see card_list.structure_decks). If given, the JSON object is
+        {"cards": card_names, "decks": {index: deck}}
+
+    Returns
+    -------
+    String
+        The JSON object
+    """
+
+    decks_flat = dict()
+    n = 0
+    for sublist in deck_double_list:
+        for deck in sublist:
+            decks_flat[n] = deck
+            n += 1
+
+    if card_table is not None:
+        return json.dumps({"cards": card_table.names, "decks": decks_flat})
+
+    return json.dumps(decks_flat)
+
+
+def print_ndjson(deck_list, card_table=None):
+
+    """
+    Print decks to stdout as newline-delimited JSON, i.e., a deck per line.
+
+    Parameters
+    ----------
+    deck_list : list of dictionaries
+        The decks. If None (e.g., an empty results page), nothing is printed
+
+    card_table : card_list.CardTable
+        If given, the cards of the decks are structured (see
+        card_list.structure_decks) and each card is printed as a line
+        {"card_id": card_id, "name": name} before the first deck containing it
+    """
+
+    if card_table is not None:
+        for card_id in structure_decks(deck_list, card_table):
+            line = {"card_id": card_id, "name": card_table.names[card_id]}
+            sys.stdout.write(json.dumps(line) + "\n")
+
+    for deck in deck_list or list():
+        sys.stdout.write(json.dumps(deck) + "\n")
+    sys.stdout.flush()
+
+    return
+
+
 def main():
 
     """
     Download decks from www.mtgtop8.com. The results are printed to stdout in
-    JSON format.
+    JSON format, either as a single JSON object {index: deck} printed at the end
+    or as newline-delimited JSON (a deck per line) printed as soon as the decks
+    of each results page are downloaded. Alternatively, they are written as
+    Parquet or Arrow files (see columnar_export.py). At the end, a summary of
+    the metrics of the run (see metrics.py) is logged to stderr.
 
     Command-line interface:
 
@@ -336,19 +1262,76 @@ def main():
       -p PAYLOAD, --payload PAYLOAD
                             Payload for the search form. Example: '{"format":
                             "MO", "date_start": "25/09/2021", "date_end":
-                            "27/09/2021"}'
+                            "27/09/2021"}' (not needed when resuming a crawl)
       -n N, --n N           Number of parallel processes (warning: a high number may
                             cause the server to blacklist the IP address)
+      -c MAX_PER_HOST, --max-per-host MAX_PER_HOST
+                            Use the asyncio engine instead of parallel processes,
+                            with at most this number of concurrent requests per
+                            host (warning: a high number may cause the server to
+                            blacklist the IP address)
+      -r RATE, --rate RATE  Maximum number of requests per second, shared by all
+                            the parallel processes and concurrent requests
+      -b BURST, --burst BURST
+                            Maximum number of requests sent in a burst when the
+                            rate is limited
+      --cache CACHE         Directory of a persistent cache of the downloaded
+                            pages, which avoids downloading them again in later
+                            runs
+      --cache-size CACHE_SIZE
+                            Maximum size of the cache in MB (the least recently
+                            used pages are evicted)
+      --journal JOURNAL     Checkpoint journal file where the progress of the
+                            crawl is recorded
+      --resume              Resume the crawl recorded in the journal, skipping
+                            the results pages and decks already downloaded
+      --format {json,ndjson,bundle,arrow,parquet}
+                            Output format: a JSON object with all the decks
+                            printed at the end (json), a deck per line printed
+                            while downloading (ndjson), zstd-compressed shards of
+                            decks with an index written to the --output
+                            directory while downloading (bundle, see
+                            deck_bundle.py), or tables of decks and cards
+                            written as Parquet or Arrow files to the --output
+                            directory while downloading (parquet, arrow)
+      --output OUTPUT       Directory where the shards or the tables are written
+                            with --format bundle, parquet or arrow (the tables
+                            are partitioned by format and month, see
+                            columnar_export.py)
+      --parser {bs4,lxml}   Parser of the html pages: BeautifulSoup (bs4) or
+                            compiled XPath over lxml (lxml), which is faster and
+                            produces the same results
+      --base-url BASE_URL   URL of the website, if it is not www.mtgtop8.com (e.g.,
+                            a local replay server, see replay_server.py)
+      --max-retries MAX_RETRIES
+                            Number of retries of the requests that fail with a
+                            connection error or an HTTP error 429 or 5xx
+      --cards {text,structured}
+                            Representation of the cards of the decks: the text
+                            of their MTGO files (text), or lists of (count,
+                            card_id) with a shared table of card names
+                            (structured, see card_list.py). The tables of
+                            --format parquet and arrow have both, and --format
+                            bundle supports only text
+      --formats FORMATS     Formats to crawl with the payload, which share the
+                            requests according to their weights and backlogs
+                            of results pages. Example: "MO:2,LE,PI" (see
+                            scheduler.py)
 
     """
 
+    # only needed by the command-line interface, so they are not loaded when
+    # the module is imported (e.g., by the AWS Lambda handlers)
+    from progressbar import progressbar
+    from joblib import Parallel, delayed
+
     parser = argparse.ArgumentParser(description="Download decks from www.mtgtop8.com")
     parser.add_argument(
         "-p",
         "--payload",
         type=str,
-        help='Payload for the search form. Example: \'{"format": "MO", "date_start": "25/09/2021", "date_end": "27/09/2021"}\'',
-        required=True,
+        help='Payload for the search form. Example: \'{"format": "MO", "date_start": "25/09/2021", "date_end": "27/09/2021"}\' (not needed when resuming a crawl)',
+        default=None,
     )
     parser.add_argument(
         "-n",
@@ -357,28 +1340,306 @@ def main():
         help="Number of parallel processes (warning: a high number may cause the server to blacklist the IP address)",
         default=1,
     )
+    parser.add_argument(
+        "-c",
+        "--max-per-host",
+        type=int,
+        help="Use the asyncio engine instead of parallel processes, with at most this number of concurrent requests per host (warning: a high number may cause the server to blacklist the IP address)",
+        default=None,
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        help="Maximum number of requests per second, shared by all the parallel processes and concurrent requests",
+        default=None,
+    )
+    parser.add_argument(
+        "-b",
+        "--burst",
+        type=int,
+        help="Maximum number of requests sent in a burst when the rate is limited",
+        default=1,
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        help="Directory of a persistent cache of the downloaded pages, which avoids downloading them again in later runs",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=float,
+        help="Maximum size of the cache in MB (the least recently used pages are evicted)",
+        default=DEFAULT_CACHE_SIZE,
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        help="Checkpoint journal file where the progress of the crawl is recorded",
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the crawl recorded in the journal, skipping the results pages and decks already downloaded",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "ndjson", "bundle"] + sorted(EXPORT_FORMATS),
+        help="Output format: a JSON object with all the decks printed at the end (json), a deck per line printed while downloading (ndjson), zstd-compressed shards of decks with an index written to the --output directory while downloading (bundle, see deck_bundle.py), or tables of decks and cards written as Parquet or Arrow files to the --output directory while downloading (parquet, arrow)",
+        default="json",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="Directory where the shards or the tables are written with --format bundle, parquet or arrow (the tables are partitioned by format and month, see columnar_export.py)",
+        default=None,
+    )
+    parser.add_argument(
+        "--parser",
+        choices=["bs4", "lxml"],
+        help="Parser of the html pages: BeautifulSoup (bs4) or compiled XPath over lxml (lxml), which is faster and produces the same results",
+        default="bs4",
+    )
+    parser.add_argument(
+        "--base-url",
+        type=str,
+        help="URL of the website, if it is not www.mtgtop8.com (e.g., a local replay server, see replay_server.py)",
+        default=None,
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        help="Number of retries of the requests that fail with a connection error or an HTTP error 429 or 5xx",
+        default=DEFAULT_RESILIENCE["max_retries"],
+    )
+    parser.add_argument(
+        "--cards",
+        choices=["text", "structured"],
+        help="Representation of the cards of the decks: the text of their MTGO files (text), or lists of (count, card_id) with a shared table of card names (structured, see card_list.py). The tables of --format parquet and arrow have both, and --format bundle supports only text",
+        default="text",
+    )
+    parser.add_argument(
+        "--formats",
+        type=str,
+        help='Formats to crawl with the payload, which share the requests according to their weights and backlogs of results pages. Example: "MO:2,LE,PI" (see scheduler.py)',
+        default=None,
+    )
     args = vars(parser.parse_args())
 
-    # the input payload will be used as a template, from which a different payload
-    # for each results page of the search form can be fetched
-    template_payload = json.loads(args["payload"])
-    payload_list = make_search_payloads(template_payload)
+    configure_parser(args["parser"])
 
-    n = args["n"]
-    deck_double_list = Parallel(n)(
-        delayed(download_decks_in_search_results)(payload)
-        for payload in progressbar(payload_list)
-    )
+    if args["base_url"] is not None:
+        configure_base_url(args["base_url"])
 
-    decks_flat = dict()
-    n = 0
-    for sublist in deck_double_list:
-        for deck in sublist:
-            decks_flat[n] = deck
-            n += 1
+    if args["rate"] is not None:
+        configure_rate_limit(args["rate"], args["burst"])
 
-    return json.dumps(decks_flat)
+    if args["cache"] is not None:
+        configure_cache(args["cache"], args["cache_size"])
+
+    # the concurrency controllers and the connection pools must allow the
+    # concurrent requests of the asyncio engine
+    if args["max_per_host"] is not None:
+        configure_resilience(
+            max_retries=args["max_retries"], max_concurrency=args["max_per_host"]
+        )
+    else:
+        configure_resilience(max_retries=args["max_retries"])
+
+    journal = None
+    payload_list = None
+    deck_lists = dict()
+    finished_pages = set()
+    recorded_decks = dict()
+
+    if args["journal"] is not None:
+        journal = CheckpointJournal(args["journal"])
+        if args["resume"]:
+            payload_list, finished_pages, recorded_decks = journal.load()
+    elif args["resume"]:
+        parser.error("--resume requires --journal")
+
+    if args["format"] in ["bundle"] + list(EXPORT_FORMATS) and args["output"] is None:
+        parser.error("--format {} requires --output".format(args["format"]))
+
+    # the shards of the bundles have no card table to resolve the card ids
+    if args["cards"] == "structured" and args["format"] == "bundle":
+        parser.error("--cards structured cannot be used with --format bundle")
+
+    # fail before the crawl if the export cannot be written
+    if args["format"] in EXPORT_FORMATS:
+        try:
+            load_pyarrow()
+        except ImportError as e:
+            parser.error("--format {}: {}".format(args["format"], e))
+
+    if payload_list is None:
+        if args["payload"] is None:
+            parser.error("a payload is needed unless a crawl is resumed")
+
+        # the input payload will be used as a template, from which a different payload
+        # for each results page of the search form can be fetched
+        template_payload = json.loads(args["payload"])
+        if args["formats"] is None:
+            template_payloads = [template_payload]
+        else:
+            template_payloads = [
+                dict(template_payload, format=f) for f in parse_formats(args["formats"])
+            ]
+
+        # the decks of the probed pages are kept, so they are not downloaded
+        # again
+        payload_list = list()
+        for payload in template_payloads:
+            search_payloads, search_deck_lists = discover_search_pages(payload)
+            payload_list += search_payloads
+            deck_lists.update(
+                {
+                    page_key(p): search_deck_lists[p["current_page"]]
+                    for p in search_payloads
+                    if p["current_page"] in search_deck_lists
+                }
+            )
+
+        if journal is not None:
+            journal.start(payload_list)
+
+    # when resuming, skip the finished pages and the decks already recorded
+    pending_payloads = [
+        payload for payload in payload_list if page_key(payload) not in finished_pages
+    ]
+    skip_ids = {
+        page: {make_deck_key(deck) for deck in decks.values()}
+        for page, decks in recorded_decks.items()
+    }
+
+    # the results pages of several formats are taken from a scheduler while
+    # they are downloaded, which splits the requests between the formats
+    format_scheduler = None
+    if args["formats"] is not None:
+        weights = parse_formats(args["formats"])
+        payload_lists = {f: list() for f in weights}
+        for payload in pending_payloads:
+            payload_lists.setdefault(payload.get("format"), list()).append(payload)
+        format_scheduler = FormatScheduler(payload_lists, weights)
+
+    card_table = CardTable() if args["cards"] == "structured" else None
+
+    # with ndjson, the decks are printed as soon as each page is downloaded and
+    # they are not kept in memory. The same goes for the bundles and the
+    # columnar formats, whose files are written a results page at a time
+    on_page = None
+    sink = None
+    if args["format"] == "ndjson":
+        on_page = functools.partial(print_ndjson, card_table=card_table)
+    elif args["format"] == "bundle":
+        os.makedirs(args["output"], exist_ok=True)
+        sink = BundleWriter(DataHandler(args["output"]))
+        on_page = sink.add_page
+    elif args["format"] in EXPORT_FORMATS:
+        sink = ColumnarSink(args["output"], args["format"], card_table)
+        on_page = sink.add_page
+
+    # the decks downloaded before resuming are output first
+    if on_page is not None:
+        for decks in recorded_decks.values():
+            on_page([decks[k] for k in sorted(decks)])
+
+    try:
+        if args["max_per_host"] is not None:
+            deck_double_list = asyncio.run(
+                async_download_decks(
+                    pending_payloads,
+                    args["max_per_host"],
+                    journal,
+                    skip_ids,
+                    deck_lists,
+                    on_page,
+                    format_scheduler,
+                )
+            )
+        else:
+            # the jobs are taken from the scheduler as the workers need them,
+            # and the results come back in the same order
+            if format_scheduler is not None:
+                payloads = iter(format_scheduler.take, None)
+            else:
+                payloads = iter(pending_payloads)
+            taken = list()
+
+            def take_payloads():
+                for payload in progressbar(payloads, max_value=len(pending_payloads)):
+                    taken.append(payload)
+                    yield payload
+
+            if journal is not None:
+                jobs = (
+                    delayed(with_metrics)(
+                        download_decks_with_journal,
+                        payload,
+                        journal,
+                        skip_ids.get(page_key(payload)),
+                        deck_lists.get(page_key(payload)),
+                    )
+                    for payload in take_payloads()
+                )
+            else:
+                jobs = (
+                    delayed(with_metrics)(
+                        download_decks_in_search_results,
+                        payload,
+                        deck_list=deck_lists.get(page_key(payload)),
+                    )
+                    for payload in take_payloads()
+                )
+
+            # the metrics recorded by the worker processes are collected with
+            # the results of their jobs
+            results = dict()
+            for position, (deck_list, snapshot) in enumerate(
+                Parallel(args["n"], return_as="generator")(jobs)
+            ):
+                METRICS.merge(snapshot)
+                payload = taken[position]
+                if format_scheduler is not None:
+                    searched = page_key(payload) not in deck_lists
+                    format_scheduler.done(
+                        payload, count_page_requests(deck_list, searched)
+                    )
+                if on_page is not None:
+                    on_page(deck_list)
+                else:
+                    results[page_key(payload)] = deck_list
+            if on_page is None:
+                deck_double_list = [results[page_key(p)] for p in pending_payloads]
+    finally:
+        if sink is not None:
+            sink.close()
+
+        # the end-of-run summary of the metrics (see metrics.py)
+        METRICS.emit()
+
+    if on_page is not None:
+        return
+
+    # the journal has all the decks, including those downloaded before resuming
+    if journal is not None:
+        _, _, recorded_decks = journal.load()
+        deck_double_list = list()
+        for payload in payload_list:
+            decks = recorded_decks.get(page_key(payload), dict())
+            deck_double_list.append([decks[k] for k in sorted(decks)])
+
+    if card_table is not None:
+        for deck_list in deck_double_list:
+            structure_decks(deck_list, card_table)
+
+    print(serialize_decks(deck_double_list, card_table))
+
+    return
 
 
 if __name__ == "__main__":
-    print(main())
+    main()
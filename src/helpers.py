@@ -1,8 +1,11 @@
-import boto3
 import json
+import time
 import logging
+import threading
 from pythonjsonlogger import jsonlogger
 
+from metrics import METRICS
+
 # pylint: disable=W0105
 
 LOG = logging.getLogger()
@@ -16,8 +19,93 @@ LOG.propagate = False
 # the AWS region
 REGION = "eu-central-1"
 
-SQS = boto3.client("sqs", region_name=REGION)
-S3 = boto3.client("s3", region_name=REGION)
+# the boto3 clients, by service name. They are created on their first use,
+# since creating them takes a significant part of the cold start of the AWS
+# Lambda functions, and not all of them use every client. The lock serializes
+# their creation, since the default boto3 session is not thread-safe (e.g., the
+# threads of deck_consumer send their first SQS messages at the same time)
+_CLIENTS = dict()
+_CLIENTS_LOCK = threading.Lock()
+
+# limits of the SQS SendMessageBatch operation: number of messages and total
+# size of the messages (bodies and attributes), in bytes
+SQS_BATCH_SIZE = 10
+SQS_BATCH_BYTES = 256 * 1024
+
+# the URLs of the SQS queues, by queue name
+_QUEUE_URLS = dict()
+
+
+def get_client(service):
+
+    """
+    Get the boto3 client of an AWS service, creating it on the first call.
+    Parameters
+    ----------
+    service : string
+        The service name (e.g., "sqs" or "s3")
+    Returns
+    -------
+    botocore.client.BaseClient
+        The client
+    """
+
+    if service not in _CLIENTS:
+        with _CLIENTS_LOCK:
+            if service not in _CLIENTS:
+                import boto3
+
+                _CLIENTS[service] = boto3.client(service, region_name=REGION)
+
+    return _CLIENTS[service]
+
+
+def get_queue_url(queue_name):
+
+    """
+    Get the URL of an AWS SQS queue. It is requested only the first time, and
+    then it is kept for the next calls (e.g., for the next invocations of a
+    warm Lambda function).
+    Parameters
+    ----------
+    queue_name : string
+        The queue name
+    Returns
+    -------
+    String
+        The queue URL
+    """
+
+    if queue_name not in _QUEUE_URLS:
+        response = get_client("sqs").get_queue_url(QueueName=queue_name)
+        _QUEUE_URLS[queue_name] = response["QueueUrl"]
+
+    return _QUEUE_URLS[queue_name]
+
+
+def sqs_msg_size(json_msg, attrs):
+
+    """
+    Compute the size of a message as counted by SQS, i.e., the size of its body
+    and its attributes.
+    Parameters
+    ----------
+    json_msg : string
+        The body of the message
+    attrs:
+        The message attributes (see send_sqs_msg)
+    Returns
+    -------
+    int
+        The size, in bytes
+    """
+
+    size = len(json_msg.encode("utf-8"))
+    for name, attr in attrs.items():
+        size += len(name.encode("utf-8")) + len(attr["DataType"].encode("utf-8"))
+        size += len(attr.get("StringValue", "").encode("utf-8"))
+
+    return size
 
 
 def send_sqs_msg(queue_name, msg, attrs):
@@ -42,14 +130,14 @@ def send_sqs_msg(queue_name, msg, attrs):
         The response from SQS to the send message operation
     """
 
-    queue_url = SQS.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    queue_url = get_queue_url(queue_name)
     queue_send_log_msg = "Send message to queue url: %s, with body: %s" % (
         queue_url,
         msg,
     )
     LOG.debug(queue_send_log_msg)
     json_msg = json.dumps(msg)
-    response = SQS.send_message(
+    response = get_client("sqs").send_message(
         QueueUrl=queue_url, MessageBody=json_msg, MessageAttributes=attrs
     )
     queue_send_log_msg_resp = "Response to message sent to queue with url %s: %s" % (
@@ -61,6 +149,94 @@ def send_sqs_msg(queue_name, msg, attrs):
     return response
 
 
+def send_sqs_msg_batch(queue_name, msgs, attrs, max_retries=3):
+
+    """
+    Send several messages to an AWS SQS queue, grouped in batches of up to
+    SQS_BATCH_SIZE messages and SQS_BATCH_BYTES bytes. The messages of a batch
+    that fail are sent again (up to max_retries times, with an exponential
+    backoff), unless the failure is caused by the message itself (e.g., an
+    invalid attribute), in which case retrying would not help.
+    Parameters
+    ----------
+    queue_name : string
+        The queue name
+    msgs: list of dictionaries
+        The messages
+    attrs:
+        Message attributes, shared by all the messages (see send_sqs_msg)
+    max_retries: int
+        Maximum number of retries of the failed messages of each batch
+    Returns
+    -------
+    List of dictionaries
+        The messages that could not be sent (empty if all were sent)
+    """
+
+    queue_url = get_queue_url(queue_name)
+
+    # group the messages in batches
+    batches = list()
+    batch = list()
+    batch_size = 0
+    failed = list()
+    for i, msg in enumerate(msgs):
+        json_msg = json.dumps(msg)
+        size = sqs_msg_size(json_msg, attrs)
+
+        if size > SQS_BATCH_BYTES:
+            LOG.error("Message too large to be sent to queue %s: %s", queue_url, msg)
+            failed.append(msg)
+            continue
+
+        if len(batch) == SQS_BATCH_SIZE or batch_size + size > SQS_BATCH_BYTES:
+            batches.append(batch)
+            batch = list()
+            batch_size = 0
+
+        batch.append(
+            {"Id": str(i), "MessageBody": json_msg, "MessageAttributes": attrs}
+        )
+        batch_size += size
+
+    if len(batch) > 0:
+        batches.append(batch)
+
+    for batch in batches:
+        for attempt in range(max_retries + 1):
+            with METRICS.timer("sqs_send"):
+                response = get_client("sqs").send_message_batch(
+                    QueueUrl=queue_url, Entries=batch
+                )
+            METRICS.count("sqs_messages", len(response.get("Successful", list())))
+            LOG.info(
+                "Sent %d messages to queue url %s, %d failed",
+                len(response.get("Successful", list())),
+                queue_url,
+                len(response.get("Failed", list())),
+            )
+
+            # retry only the failed messages that might succeed on a retry
+            retry_ids = set()
+            for entry in response.get("Failed", list()):
+                if entry.get("SenderFault") or attempt == max_retries:
+                    LOG.error("Failed message to queue url %s: %s", queue_url, entry)
+                    failed.append(msgs[int(entry["Id"])])
+                else:
+                    retry_ids.add(entry["Id"])
+
+            batch = [entry for entry in batch if entry["Id"] in retry_ids]
+            if len(batch) == 0:
+                break
+
+            METRICS.count("sqs_retries")
+            time.sleep(0.1 * 2**attempt)
+
+    METRICS.count("sqs_failed", len(failed))
+
+    return failed
+
+
 def write_data_s3_bucket(body, bucket_name, key):
 
     """
@@ -85,7 +261,7 @@ def write_data_s3_bucket(body, bucket_name, key):
     )
     LOG.debug(send_log_msg)
     json_data = json.dumps(body)
-    response = S3.put_object(Bucket=bucket_name, Key=key, Body=json_data)
+    response = get_client("s3").put_object(Bucket=bucket_name, Key=key, Body=json_data)
 
     send_log_msg_resp = "Response to data sent to s3 bucket %s: %s" % (
         bucket_name,
@@ -2,106 +2,186 @@
 # -*- coding: utf-8 -*-
 
 import json
+from io import StringIO
 from datetime import date
 import os
+import time
 import datetime
-import pandas as pd
-
-# although not explicitely used, we need to import s3fs for pandas to interface
-# properly with AWS S3
-# pylint: disable-next=W0611
-import s3fs
-
-from download_decks import make_search_payloads, download_decks_in_search_results
-from helpers import LOG, send_sqs_msg
+from concurrent.futures import ThreadPoolExecutor
+
+from download_decks import discover_date_windows, download_decks_in_search_results
+from download_decks import DEFAULT_MAX_WINDOW_PAGES, PAYLOAD_DATE_FORMAT
+from download_decks import search_hint_key, get_list, get_session, make_deck_key
+from request_handler import DeadlineExceeded, configure_deadline
+from helpers import LOG, send_sqs_msg_batch
+from metrics import METRICS
+from data_handler import CachedDataHandlerS3, ObjectCache
+from deck_index import DeckIndex
+from payload_registry import PayloadRegistry
+from deck_bundle import BundleWriter
+from scheduler import parse_formats, interleave_payloads, DEFAULT_FORMATS
 
 # pylint: disable=W0105
 
 """
 This module provides handlers that allow using the functions of the module 
 download_decks as serverless applications in AWS Lambda.
+
+The heavy dependencies that only a handler needs are imported by the functions
+that use them, so that the cold starts of the other handler do not pay for them.
+The import time of this module is checked by the tests against a budget (see
+test_lambda_import_time).
 """
 
+# the key of the payload registry written by previous versions of the producer,
+# as a CSV file (see load_payload_registry)
+LEGACY_REGISTRY_KEY = "deck_payload_registry.csv"
+
+# the cache of the objects read from the S3 bucket (e.g., the index of known
+# decks), which is kept across the invocations of a warm Lambda function. It is
+# kept small, since it shares the memory of the function
+OBJECT_CACHE = ObjectCache(max_bytes=32 * 2**20)
+
+# the indexes of known decks, by bucket and name, which are kept across the
+# invocations of a warm Lambda function, so only the files added to them since
+# the previous invocation are read (see DeckIndex.refresh)
+_DECK_INDEXES = dict()
+
+# default maximum number of results pages downloaded concurrently by the
+# consumer, when it receives several of them in the same batch of messages. It
+# can be changed with the environment variable MAX_CONCURRENT_PAGES
+DEFAULT_MAX_CONCURRENT_PAGES = 4
+
+# default time (in seconds) left before the timeout of the consumer when it
+# stops downloading decks, so it has time to send the decks it downloaded and
+# re-enqueue the rest. It can be changed with the environment variable
+# DEADLINE_MARGIN
+DEFAULT_DEADLINE_MARGIN = 10.0
 
-def load_payload_registry(path):
+
+def load_payload_registry(data_handler, deck_format="MO"):
 
     """
-    Load the payload registry file as a DataFrame
+    Load the payload registry of a format. If the registry of Modern is empty
+    and the CSV registry written by previous versions of the producer (which
+    only crawled Modern) exists, its entries are imported first.
 
     Parameters
     ----------
-    path: string
-        The S3 path (i.e., bucket_name/key) to the file
+    data_handler: DataHandler or DataHandlerS3
+        The object used to read and write the registry
+    deck_format: string
+        The format (e.g., "MO")
 
     Returns
     -------
-    DataFrame
-        A pandas DataFrame with the loaded data
+    PayloadRegistry
+        The registry
     """
 
-    try:
-        df = pd.read_csv(path)
-        log_msg = "%s found" % path
-        LOG.info(log_msg)
-    except FileNotFoundError:
-        df = pd.DataFrame()
-        log_msg = "%s not found - creating a new one" % path
-        LOG.info(log_msg)
+    # the registry of Modern keeps the name it had when it was the only one
+    if deck_format == "MO":
+        registry = PayloadRegistry(data_handler)
+    else:
+        registry = PayloadRegistry(data_handler, "deck_payload_registry_" + deck_format)
+
+    if (
+        deck_format == "MO"
+        and registry.latest() is None
+        and data_handler.file_exists(LEGACY_REGISTRY_KEY)
+    ):
+        # another producer might be importing it at the same time, in which case
+        # only one of them does
+        if registry.import_csv(data_handler.read(LEGACY_REGISTRY_KEY)):
+            LOG.info("Imported %s into the payload registry", LEGACY_REGISTRY_KEY)
 
-    return df
+    return registry
 
 
-def udpate_payload_registry(template_payload, path, mode):
+def udpate_payload_registry(template_payload, registry, mode, after=None):
 
     """
     Update the payload registry to include a new payload. It also writes the
     date at which the operation took place and the payload creation mode.
 
+    If another producer appended an entry after the registry was read, the
+    registry is read again, and the payload is appended after that entry only
+    if it ends later, so the start of the next automatic payload never moves
+    backwards.
+
     Parameters
     ----------
     template_payload: dictionary
         The payload
-    path: string
-        The S3 path (i.e., bucket_name/key) to the file
+    registry: PayloadRegistry
+        The registry
     mode: string
         Mode of creation of the payload (e.g., automated or manual)
+    after: int
+        The sequence number of the latest entry when the registry was read (see
+        PayloadRegistry.head). If None, the payload is appended after the
+        latest entry, whichever it is
     """
 
     data = template_payload.copy()
     data["operation_time"] = datetime.date.today().strftime("%d/%m/%Y")
     data["mode"] = mode
 
-    df = load_payload_registry(path)
-    df = pd.concat([df, pd.DataFrame(data, index=[0])])
-    df.to_csv(path, index=False)
+    while True:
+        try:
+            registry.append(data, after=after)
+            break
+        except FileExistsError:
+            after, latest = registry.head()
+            date_ends = [
+                datetime.datetime.strptime(d["date_end"], PAYLOAD_DATE_FORMAT)
+                for d in (latest, data)
+            ]
+            if date_ends[0] >= date_ends[1]:
+                LOG.warning(
+                    "Payload %s not registered, another producer registered %s",
+                    template_payload,
+                    latest,
+                )
+                break
 
     return
 
 
-def generate_automatic_template_payload(path):
+def generate_automatic_template_payload(registry, deck_format="MO", head=None):
 
     """
     This function creates deck search payloads with a start date equal to the
     end date of the last automatically generated, and an end date equal to the
     current date.
 
+    Parameters
+    ----------
+    registry: PayloadRegistry
+        The payload registry of the format
+    deck_format: string
+        The format (e.g., "MO")
+    head: Tuple
+        The head of the registry (see PayloadRegistry.head), if it was already
+        read. If None, it is read
+
     Returns
     -------
     Dictionary
         The payload
     """
 
-    df = load_payload_registry(path)
+    latest = (head or registry.head())[1]
 
-    if len(df) > 0:
+    if latest is not None:
         template_payload = {
-            "format": "MO",
-            "date_start": df.iloc[-1]["date_end"],
+            "format": deck_format,
+            "date_start": latest["date_end"],
             "date_end": datetime.date.today().strftime("%d/%m/%Y"),
         }
     else:
         template_payload = {
-            "format": "MO",
+            "format": deck_format,
             "date_start": "01/01/2005",
             "date_end": datetime.date.today().strftime("%d/%m/%Y"),
         }
@@ -119,11 +199,30 @@ def deck_producer(event, context):
     that can be processed in parallel by another Lambda function that acts as
     a consumer. The created payloads are sent to an SQS queue with a name defined
     by the environment variable DECKS_CONSUMER_QUEUE.
-    If the event is an empty string, the deck search template payload passed to
-    download_decks.make_search_payloads is generated automatically with a start
-    date equal to the end date of the last automatically-generated, and an end
-    date equal to the current date. If the event is a non-empty string, the
-    string will be loaded as JSON.
+    If the event is an empty string, a deck search template payload passed to
+    download_decks.discover_date_windows is generated automatically for each
+    format of the environment variable CRAWL_FORMATS (e.g., "MO:2,LE,PI", see
+    scheduler.parse_formats), with a start date equal to the end date of the
+    last automatically-generated for the format, and an end date equal to the
+    current date. If the event is a non-empty string, the string will be loaded
+    as JSON.
+
+    The payloads of the formats are interleaved according to their weights
+    and backlogs (see scheduler.interleave_payloads) before they are sent, so
+    the formats are crawled side by side instead of one after the other.
+
+    The date range of the template payload is split into windows of at most
+    MAX_WINDOW_PAGES results pages (see download_decks.discover_date_windows),
+    so a long range (e.g., the first run, from 2005) is discovered in parallel
+    and its payloads are not shifted by the decks added during the crawl. The
+    number of results pages found for each kind of template payload, if it was
+    not split, is stored in the S3 bucket, and used as the starting point of
+    the next search.
+    The decks of the results pages downloaded during the search are sent
+    along with the payloads, so the consumer does not download them again.
+
+    The metrics of the invocation (e.g., the latency of the search requests)
+    are logged in CloudWatch Embedded Metric Format (see metrics.py).
 
     Parameters
     ----------
@@ -137,24 +236,76 @@ def deck_producer(event, context):
     Returns
     -------
     Dictionary
-        Success status code ("200")
+        Success status code ("200"), the template payloads and the number of
+        results pages and date windows found
     """
 
     LOG.debug("The input event is: %s", event)
 
+    # a warm function keeps the metrics of its previous invocation
+    METRICS.reset()
+
     bucket_name = os.environ["MTG_DATA_BUCKET"]
-    key = "deck_payload_registry.csv"
-    path_to_payload_registry = f"s3://{bucket_name}/{key}"
+    data_handler = CachedDataHandlerS3(bucket_name, OBJECT_CACHE)
 
     if event != "":
-        template_payload = json.loads(event)
+        template_payloads = [json.loads(event)]
+        weights = {template_payloads[0].get("format"): 1.0}
     else:
-        template_payload = generate_automatic_template_payload(path_to_payload_registry)
-
-    log_msg = "Template payload: %s" % template_payload
-    LOG.info(log_msg)
-
-    payload_list = make_search_payloads(template_payload)
+        weights = parse_formats(os.environ.get("CRAWL_FORMATS") or DEFAULT_FORMATS)
+        registries = {f: load_payload_registry(data_handler, f) for f in weights}
+        heads = {f: registries[f].head() for f in weights}
+        template_payloads = [
+            generate_automatic_template_payload(registries[f], f, heads[f])
+            for f in weights
+        ]
+
+    LOG.info("Template payloads: %s", template_payloads)
+
+    hints_key = "page_count_hints.json"
+    hints = dict()
+    if data_handler.file_exists(hints_key):
+        hints = json.load(data_handler.read(hints_key))
+
+    # the formats are discovered concurrently, each one split in date windows
+    max_pages = int(os.environ.get("MAX_WINDOW_PAGES") or DEFAULT_MAX_WINDOW_PAGES)
+    with ThreadPoolExecutor(max_workers=len(template_payloads)) as executor:
+        results = list(
+            executor.map(
+                lambda t: discover_date_windows(
+                    t, max_pages, hints.get(search_hint_key(t))
+                ),
+                template_payloads,
+            )
+        )
+
+    msg_lists = dict()
+    n_windows = 0
+    for template_payload, (payload_list, deck_lists, windows) in zip(
+        template_payloads, results
+    ):
+        LOG.info(
+            "Found %d results pages in %d windows for %s",
+            len(payload_list),
+            len(windows),
+            template_payload,
+        )
+        n_windows += len(windows)
+
+        # the hints are the number of pages of the searches that were not split
+        if len(windows) == 1:
+            hints[search_hint_key(template_payload)] = len(payload_list)
+
+        msg_lists[template_payload.get("format")] = [
+            dict(payload, deck_list=deck_list)
+            for payload, deck_list in zip(payload_list, deck_lists)
+        ]
+
+    data_handler.write(StringIO(json.dumps(hints)), hints_key)
+
+    # the results pages of the formats are interleaved according to their
+    # weights and backlogs, so the formats are crawled side by side
+    msgs = interleave_payloads(msg_lists, weights)
 
     queue_name = os.environ["DECKS_CONSUMER_QUEUE"]
     attrs = {
@@ -165,61 +316,120 @@ def deck_producer(event, context):
         },
     }
 
-    for payload in payload_list:
-        response = send_sqs_msg(queue_name, payload, attrs)
+    failed = send_sqs_msg_batch(queue_name, msgs, attrs)
+    if len(failed) > 0:
+        raise RuntimeError("%d payloads could not be sent" % len(failed))
 
-    # register the new payload after we know that everyhting else worked. Do
-    # it only if it was automatically generated
+    # register the new payloads after we know that everyhting else worked. Do
+    # it only if they were automatically generated. The entries are appended
+    # after the ones read at the start, so the entries of a concurrent producer
+    # are not overwritten
     if event == "":
-        udpate_payload_registry(template_payload, path_to_payload_registry, "automated")
+        for template_payload in template_payloads:
+            deck_format = template_payload["format"]
+            udpate_payload_registry(
+                template_payload,
+                registries[deck_format],
+                "automated",
+                after=heads[deck_format][0],
+            )
+
+    METRICS.count("payloads", len(msgs))
+    METRICS.emit({"function": "deck_producer"})
 
     return {
-        "template_payload": template_payload,
-        "number_result_pages": len(payload_list),
+        "template_payloads": template_payloads,
+        "number_result_pages": len(msgs),
+        "number_date_windows": n_windows,
         "statusCode": 200,
     }
 
 
-def deck_consumer(event, context):
-
-    # pylint: disable=W0612, W0613
+def consume_message(body, deck_index, time_left=None, bundle=None):
 
     """
-    This is the AWS Lambda handler for the function download_decks.download_decks_in_search_results.
-    It is meant to be triggered when the AWS SQS queue with a name defined by the
-    environment variable DECKS_CONSUMER_QUEUE has pending messages. Thus, this
-    function acts as a consumer for the jobs created by deck_producer.
-
-    Each of the jobs downloads several decks, which are sent to an S3 bucket
-    defined by the environment variable MTG_DATA_BUCKET.
+    Download the decks of a results page and send them to the SQS queue with a
+    name defined by the environment variable DECKS_DOWNLOADED_QUEUE.
+
+    If the time left runs low before all the decks are downloaded, the
+    remaining ones are sent back to the SQS queue with a name defined by the
+    environment variable DECKS_CONSUMER_QUEUE, as a job per deck (see
+    send_deck_jobs). These jobs carry the deck's entry of the results page, so
+    the consumer downloads the deck directly, without requesting the results
+    page again. If no deck was downloaded (e.g., the job started too late), the
+    whole job is sent back. If the decks are added to a bundle, the jobs are
+    returned instead, since they must be sent after the shards of the bundle
+    are written (see deck_consumer).
 
     Parameters
     ----------
-    event: string
-        A JSON-formated string
-
-    context : dictionary
-        Details about AWS Lambda runtime used during the function call (see AWS
-        Lambda for details)
+    body: string
+        The body of the SQS message, i.e., the JSON-formated payload of the
+        results page, as sent by deck_producer or by this function
+    deck_index: DeckIndex
+        The index of known decks, which are not downloaded. If None, all the
+        decks are downloaded
+    time_left: function
+        A function returning the time (in seconds) left before the timeout of
+        the consumer. If None, all the decks are downloaded
+    bundle: deck_bundle.BundleWriter
+        The writer of the shards where the decks are added. If None, each deck
+        is sent as a message to DECKS_DOWNLOADED_QUEUE
 
     Returns
     -------
-    Dictionary
-        Success status code ("200")
+    Tuple
+        The downloaded decks (list of dictionaries), and the jobs of the
+        remaining decks that were not sent (list of dictionaries, empty if
+        bundle is None)
     """
 
-    LOG.debug("The input event is: %s", event)
+    payload = json.loads(body)
 
-    # only one msg should be received, because that msg already contains data
-    # for downloading 25 decks. Thus, the SQS trigger should have batch size = 1
-    assert len(event["Records"]) == 1
-    payload = json.loads(event["Records"][0]["body"])
+    # the producer sends the decks of the results page if it already downloaded
+    # them, and the jobs per deck carry their own deck
+    deck_list = payload.pop("deck_list", None)
 
     LOG.info("Downloading decks from search page with payload: %s", payload)
 
-    deck_list = download_decks_in_search_results(payload)
+    margin = float(os.environ.get("DEADLINE_MARGIN") or DEFAULT_DEADLINE_MARGIN)
+    downloaded = dict()
+
+    def stop():
+        return time_left is not None and time_left() < margin
 
-    queue_name = os.environ["DECKS_DOWNLOADED_QUEUE"]
+    # the requests fail with DeadlineExceeded when they cannot finish before
+    # the deadline (see deck_consumer)
+    try:
+        if stop():
+            raise DeadlineExceeded("the job started after the deadline")
+        if deck_list is None:
+            deck_list = get_list(get_session(), payload)
+        download_decks_in_search_results(
+            payload,
+            skip_ids=deck_index,
+            on_deck=downloaded.__setitem__,
+            deck_list=deck_list,
+            stop=stop,
+        )
+    except DeadlineExceeded as e:
+        LOG.warning("Deadline reached with payload %s: %s", payload, e)
+
+    # the decks after the last downloaded one were left out by the deadline
+    jobs = list()
+    if deck_list is None:
+        jobs.append(payload)
+    else:
+        remaining = [
+            deck
+            for deck in deck_list[max(downloaded, default=-1) + 1 :]
+            if deck_index is None or make_deck_key(deck) not in deck_index
+        ]
+        if len(downloaded) == 0 and len(remaining) > 0:
+            jobs.append(dict(payload, deck_list=deck_list))
+        else:
+            jobs += [dict(payload, deck_list=[deck]) for deck in remaining]
+    deck_list = list(downloaded.values())
 
     attrs = {
         "msg_type": {"StringValue": "full_deck", "DataType": "String"},
@@ -231,8 +441,236 @@ def deck_consumer(event, context):
 
     for deck in deck_list:
         deck["date_download"] = datetime.date.today().strftime("%d/%m/%y")
-        response = send_sqs_msg(queue_name, deck, attrs)
+
+    # the remaining decks are re-enqueued before the downloaded ones are sent,
+    # so if the job fails here and it is retried, the decks are not sent twice.
+    # If some decks could not be sent, the job fails and it is retried (see the
+    # redrive policy of the queue)
+    if bundle is not None:
+        bundle.add_page(deck_list)
+    else:
+        send_deck_jobs(jobs)
+        jobs = list()
+        queue_name = os.environ["DECKS_DOWNLOADED_QUEUE"]
+        failed = send_sqs_msg_batch(queue_name, deck_list, attrs)
+        if len(failed) > 0:
+            raise RuntimeError("%d decks could not be sent" % len(failed))
 
     LOG.info("Finished downloading decks from search page with payload: %s", payload)
 
-    return {"statusCode": 200}
+    return deck_list, jobs
+
+
+def send_deck_jobs(jobs):
+
+    """
+    Send the jobs of the decks left out by the deadline to the SQS queue with
+    a name defined by the environment variable DECKS_CONSUMER_QUEUE.
+
+    Parameters
+    ----------
+    jobs: list of dictionaries
+        The jobs (see consume_message)
+    """
+
+    if len(jobs) == 0:
+        return
+
+    LOG.info("Time running out, re-enqueuing %d jobs", len(jobs))
+    attrs = {
+        "msg_type": {"StringValue": "deck_job", "DataType": "String"},
+        "date_added": {
+            "StringValue": date.today().strftime("%d/%m/%y"),
+            "DataType": "String",
+        },
+    }
+    failed = send_sqs_msg_batch(os.environ["DECKS_CONSUMER_QUEUE"], jobs, attrs)
+    if len(failed) > 0:
+        raise RuntimeError("%d deck jobs could not be sent" % len(failed))
+
+    return
+
+
+def send_bundle(bundle):
+
+    """
+    Write the current shard of a bundle writer, and send a message for each of
+    its shards to the SQS queue with a name defined by the environment variable
+    DECKS_DOWNLOADED_QUEUE.
+
+    Parameters
+    ----------
+    bundle: deck_bundle.BundleWriter
+        The writer
+    """
+
+    shards = bundle.close()
+
+    attrs = {
+        "msg_type": {"StringValue": "deck_bundle", "DataType": "String"},
+        "date_added": {
+            "StringValue": date.today().strftime("%d/%m/%y"),
+            "DataType": "String",
+        },
+    }
+    msgs = [
+        {"bucket": os.environ["MTG_DATA_BUCKET"], "shard": shard} for shard in shards
+    ]
+    failed = send_sqs_msg_batch(os.environ["DECKS_DOWNLOADED_QUEUE"], msgs, attrs)
+    if len(failed) > 0:
+        raise RuntimeError("%d shards could not be sent" % len(failed))
+
+    LOG.info("Wrote %d decks in %d shards", bundle.n_decks, len(shards))
+
+    return
+
+
+def deck_consumer(event, context):
+
+    # pylint: disable=W0612, W0613
+
+    """
+    This is the AWS Lambda handler for the function download_decks.download_decks_in_search_results.
+    It is meant to be triggered when the AWS SQS queue with a name defined by the
+    environment variable DECKS_CONSUMER_QUEUE has pending messages. Thus, this
+    function acts as a consumer for the jobs created by deck_producer.
+
+    Each of the jobs downloads several decks, which are sent to an S3 bucket
+    defined by the environment variable MTG_DATA_BUCKET.
+
+    If the environment variable DECK_BUNDLE_PREFIX is defined, the decks of the
+    batch are written to compressed shards with that prefix in the S3 bucket
+    (see deck_bundle), and a message per shard is sent to DECKS_DOWNLOADED_QUEUE
+    instead of a message per deck.
+
+    The event can contain a batch of several jobs, which are processed
+    concurrently (at most MAX_CONCURRENT_PAGES at a time). The jobs that fail
+    are reported in the response, so that SQS delivers again only them (the
+    event source mapping must have the function response type
+    ReportBatchItemFailures).
+
+    If the environment variable DECK_INDEX_KEY is defined, the decks listed in
+    the index of known decks stored with that name in the S3 bucket are not
+    downloaded again, and the downloaded decks are added to the index (see
+    deck_index.DeckIndex).
+
+    When the time left before the timeout runs below DEADLINE_MARGIN seconds,
+    the decks that were not downloaded yet are re-enqueued as a job per deck
+    (see consume_message), instead of letting the timeout kill the function
+    and SQS deliver the whole batch again. With DECK_BUNDLE_PREFIX, they are
+    re-enqueued after the shards are written. For the same reason, the retries of
+    the requests are not waited for past that margin (see
+    request_handler.configure_deadline).
+
+    The metrics of the invocation (e.g., the latency of each stage of the
+    downloads and the decks per second) are logged in CloudWatch Embedded
+    Metric Format (see metrics.py).
+
+    Parameters
+    ----------
+    event: string
+        A JSON-formated string
+
+    context : dictionary
+        Details about AWS Lambda runtime used during the function call (see AWS
+        Lambda for details)
+
+    Returns
+    -------
+    Dictionary
+        Success status code ("200") and the ids of the failed messages
+        ("batchItemFailures")
+    """
+
+    LOG.debug("The input event is: %s", event)
+
+    METRICS.reset()
+
+    deck_index = None
+    if os.environ.get("DECK_INDEX_KEY"):
+        index_id = (os.environ["MTG_DATA_BUCKET"], os.environ["DECK_INDEX_KEY"])
+        deck_index = _DECK_INDEXES.get(index_id)
+        if deck_index is None:
+            deck_index = DeckIndex(
+                CachedDataHandlerS3(index_id[0], OBJECT_CACHE), index_id[1]
+            )
+            _DECK_INDEXES[index_id] = deck_index
+        else:
+            deck_index.refresh()
+
+    time_left = None
+    deadline = None
+    if context is not None:
+        time_left = lambda: context.get_remaining_time_in_millis() / 1000
+        margin = float(os.environ.get("DEADLINE_MARGIN") or DEFAULT_DEADLINE_MARGIN)
+        deadline = time.time() + time_left() - margin
+
+    bundle = None
+    if os.environ.get("DECK_BUNDLE_PREFIX"):
+        bundle = BundleWriter(
+            CachedDataHandlerS3(os.environ["MTG_DATA_BUCKET"], OBJECT_CACHE),
+            os.environ["DECK_BUNDLE_PREFIX"],
+        )
+
+    # the results pages of the batch are downloaded concurrently, sharing the
+    # connections to the website and its limits (see request_handler)
+    records = event["Records"]
+    max_workers = int(
+        os.environ.get("MAX_CONCURRENT_PAGES") or DEFAULT_MAX_CONCURRENT_PAGES
+    )
+    # the retries of the requests must not outlive the function's timeout
+    configure_deadline(deadline)
+    try:
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(records)))
+        ) as executor:
+            futures = [
+                executor.submit(
+                    consume_message, record["body"], deck_index, time_left, bundle
+                )
+                for record in records
+            ]
+    finally:
+        configure_deadline(None)
+
+    # the failed messages are reported, so that only they are delivered again
+    failures = list()
+    results = dict()
+    for record, future in zip(records, futures):
+        try:
+            results[record["messageId"]] = future.result()
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Failed message %s", record["messageId"])
+            failures.append({"itemIdentifier": record["messageId"]})
+
+    # the shards are written at the end of the batch, so if they cannot be
+    # written or sent, the whole batch fails
+    if bundle is not None:
+        send_bundle(bundle)
+
+    # register the decks after they were sent, so that a failure does not leave
+    # decks registered that never reached the queue
+    if deck_index is not None:
+        deck_index.add(
+            make_deck_key(deck)
+            for deck_list, _ in results.values()
+            for deck in deck_list
+        )
+        deck_index.save()
+
+    # the remaining decks of the jobs written to the shards are re-enqueued
+    # only now, so that if the shards cannot be written, the batch is delivered
+    # again without those decks having been enqueued too. If they cannot be
+    # re-enqueued, the job is delivered again, and its decks that were written
+    # are skipped if the index of known decks is used
+    for message_id, (_, jobs) in results.items():
+        try:
+            send_deck_jobs(jobs)
+        except Exception:  # pylint: disable=W0703
+            LOG.exception("Failed message %s", message_id)
+            failures.append({"itemIdentifier": message_id})
+
+    METRICS.count("failed_jobs", len(failures))
+    METRICS.emit({"function": "deck_consumer"})
+
+    return {"statusCode": 200, "batchItemFailures": failures}
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# pylint: disable=W0105
+
+"""
+This module records metrics of the web scraper and the AWS Lambda handlers:
+counters (e.g., the number of decks or of bytes downloaded), histograms (e.g.,
+the latency of each request) and timers, which record the duration of a stage
+(e.g., the search request, the parsing of a deck's page or the SQS sends) in a
+histogram, in milliseconds.
+
+The metrics of a process are recorded in a single registry, METRICS, which can
+be used from several threads. They are emitted as JSON log records through
+helpers.LOG (see Metrics.emit). Inside AWS Lambda, the records follow the
+CloudWatch Embedded Metric Format (EMF), so CloudWatch extracts the metrics
+from the logs without any extra request:
+
+    {
+    "_aws": {"Timestamp": 1633000000000, "CloudWatchMetrics": [{
+        "Namespace": "MTGDeckDownloader",
+        "Dimensions": [["function"]],
+        "Metrics": [{"Name": "decks", "Unit": "Count"}, ...]}]},
+    "function": "deck_consumer",
+    "decks": 25,
+    "search_request": [412.5, 380.1],
+    ...
+    }
+
+Elsewhere (e.g., in the command-line interface), a summary of each histogram
+(count, mean, percentiles...) is logged instead of its values.
+"""
+
+# the namespace of the metrics in CloudWatch
+NAMESPACE = "MTGDeckDownloader"
+
+# maximum number of values of a metric in an EMF record
+EMF_MAX_VALUES = 100
+
+# the percentiles of the histograms in the summaries
+PERCENTILES = (50, 95, 99)
+
+# the root logger, i.e., helpers.LOG. It is not imported from helpers, which
+# records metrics itself
+LOG = logging.getLogger()
+
+
+def in_lambda():
+
+    """
+    Check if the code runs inside AWS Lambda.
+
+    Returns
+    -------
+    bool
+        True if it runs inside AWS Lambda
+    """
+
+    return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
+
+
+def percentile(values, p):
+
+    """
+    Compute a percentile of some values (nearest rank).
+
+    Parameters
+    ----------
+    values: list of floats
+        The values, sorted
+    p: float
+        The percentile, between 0 and 100
+
+    Returns
+    -------
+    float
+        The percentile, or None if there are no values
+    """
+
+    if len(values) == 0:
+        return None
+
+    rank = max(int(round(p / 100 * len(values))), 1)
+
+    return values[min(rank, len(values)) - 1]
+
+
+class Metrics:
+
+    """
+    This class holds the counters and histograms of a process (see the
+    module's documentation). The time elapsed since the object was created (or
+    reset) is used to compute the throughput of the counters, e.g., the decks
+    per second.
+    """
+
+    def __init__(self):
+
+        """
+        Initialize the object.
+        """
+
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.units = dict()
+        self.start = time.time()
+
+    def __reduce__(self):
+
+        # the registry is unique to each process, so it is pickled by
+        # reference (e.g., with the functions of the command-line interface,
+        # which joblib pickles by value to send them to the worker processes)
+        return "METRICS"
+
+    def count(self, name, value=1, unit="Count"):
+
+        """
+        Increase a counter.
+
+        Parameters
+        ----------
+        name: string
+            The name of the counter
+        value: int or float
+            The increment
+        unit: string
+            The CloudWatch unit of the counter (e.g., "Count" or "Bytes")
+        """
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.units[name] = unit
+
+        return
+
+    def observe(self, name, value, unit="None"):
+
+        """
+        Add a value to a histogram.
+
+        Parameters
+        ----------
+        name: string
+            The name of the histogram
+        value: float
+            The value
+        unit: string
+            The CloudWatch unit of the values (e.g., "Milliseconds")
+        """
+
+        with self.lock:
+            self.histograms.setdefault(name, list()).append(value)
+            self.units[name] = unit
+
+        return
+
+    @contextmanager
+    def timer(self, name):
+
+        """
+        Context manager that records the duration of its block, in
+        milliseconds, in a histogram. The duration is recorded even if the
+        block raises an exception.
+
+        Parameters
+        ----------
+        name: string
+            The name of the histogram
+        """
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - t0) * 1000, "Milliseconds")
+
+    def drain(self):
+
+        """
+        Get the metrics recorded so far and reset them (e.g., to send the
+        metrics of a worker process to the parent process, see merge).
+
+        Returns
+        -------
+        dictionary
+            The counters, histograms and units
+        """
+
+        with self.lock:
+            snapshot = {
+                "counters": self.counters,
+                "histograms": self.histograms,
+                "units": self.units,
+            }
+            self.counters = dict()
+            self.histograms = dict()
+            self.units = dict()
+
+        return snapshot
+
+    def merge(self, snapshot):
+
+        """
+        Add the metrics of another registry (see drain).
+
+        Parameters
+        ----------
+        snapshot: dictionary
+            The metrics, as returned by drain
+        """
+
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, values in snapshot["histograms"].items():
+                self.histograms.setdefault(name, list()).extend(values)
+            self.units.update(snapshot["units"])
+
+        return
+
+    def reset(self):
+
+        """
+        Reset the metrics and the start time (e.g., at the start of an
+        invocation of a warm Lambda function).
+        """
+
+        self.drain()
+        with self.lock:
+            self.start = time.time()
+
+        return
+
+    def summary(self):
+
+        """
+        Summarize the metrics.
+
+        Returns
+        -------
+        dictionary
+            The counters, their rate per second (e.g., "decks_per_second"),
+            the elapsed time and, for each histogram, its count, sum, mean,
+            minimum, maximum and percentiles (see PERCENTILES)
+        """
+
+        with self.lock:
+            elapsed = time.time() - self.start
+            summary = {"elapsed_seconds": round(elapsed, 3)}
+
+            for name, value in sorted(self.counters.items()):
+                summary[name] = value
+                summary[name + "_per_second"] = round(value / max(elapsed, 1e-9), 3)
+
+            for name, values in sorted(self.histograms.items()):
+                values = sorted(values)
+                stats = {
+                    "count": len(values),
+                    "sum": sum(values),
+                    "mean": sum(values) / len(values),
+                    "min": values[0],
+                    "max": values[-1],
+                }
+                for p in PERCENTILES:
+                    stats["p{}".format(p)] = percentile(values, p)
+                summary[name] = {k: round(v, 3) for k, v in stats.items()}
+
+        return summary
+
+    def emf_records(self, dimensions=None, namespace=NAMESPACE):
+
+        """
+        Format the metrics as CloudWatch EMF records. A metric can have at most
+        EMF_MAX_VALUES values per record, so the histograms with more values are
+        spread over several records. The counters and their rates go in the
+        first one.
+
+        Parameters
+        ----------
+        dimensions: dictionary
+            The dimensions of the metrics (e.g., {"function": "deck_consumer"})
+        namespace: string
+            The CloudWatch namespace
+
+        Returns
+        -------
+        list of dictionaries
+            The records
+        """
+
+        dimensions = dimensions or dict()
+
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-9)
+            chunks = [dict()]
+            units = dict()
+
+            for name, value in self.counters.items():
+                chunks[0][name] = value
+                chunks[0][name + "_per_second"] = value / elapsed
+                units[name] = self.units[name]
+                units[name + "_per_second"] = self.units[name] + "/Second"
+
+            for name, values in self.histograms.items():
+                for i in range(0, len(values), EMF_MAX_VALUES):
+                    if i // EMF_MAX_VALUES == len(chunks):
+                        chunks.append(dict())
+                    chunks[i // EMF_MAX_VALUES][name] = values[i : i + EMF_MAX_VALUES]
+                units[name] = self.units[name]
+
+        timestamp = int(time.time() * 1000)
+        records = list()
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            directive = {
+                "Namespace": namespace,
+                "Dimensions": [sorted(dimensions)],
+                "Metrics": [{"Name": n, "Unit": units[n]} for n in sorted(chunk)],
+            }
+            record = {
+                "_aws": {"Timestamp": timestamp, "CloudWatchMetrics": [directive]}
+            }
+            record.update(dimensions)
+            record.update(chunk)
+            records.append(record)
+
+        return records
+
+    def emit(self, dimensions=None, reset=True):
+
+        """
+        Log the metrics: as EMF records inside AWS Lambda, or as a summary
+        elsewhere (see the module's documentation).
+
+        Parameters
+        ----------
+        dimensions: dictionary
+            The dimensions of the metrics (e.g., {"function": "deck_consumer"}),
+            which are added to the summary too
+        reset: bool
+            If True, the metrics are reset after they are logged
+        """
+
+        if in_lambda():
+            for record in self.emf_records(dimensions):
+                LOG.info("metrics", extra=record)
+        else:
+            LOG.info(
+                "metrics summary", extra=dict(dimensions or dict(), **self.summary())
+            )
+
+        if reset:
+            self.reset()
+
+        return
+
+
+# the metrics of the process
+METRICS = Metrics()
+
+
+def with_metrics(function, *args, **kwargs):
+
+    """
+    Call a function and collect the metrics it records, e.g., in a worker
+    process, whose metrics would be lost otherwise. The metrics recorded by
+    the process before the call are collected too.
+
+    Parameters
+    ----------
+    function: function
+        The function
+    args, kwargs:
+        The arguments of the function
+
+    Returns
+    -------
+    Tuple
+        The result of the function and its metrics, which are added to the
+        metrics of the parent process with METRICS.merge
+    """
+
+    result = function(*args, **kwargs)
+
+    return result, METRICS.drain()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+# pylint: disable=W0105, I1101
+
+"""
+This module defines the parsers that extract the data of the decks from the
+html pages of www.mtgtop8.com. All of them produce the same output, but they
+differ in speed: SoupParser builds a full BeautifulSoup tree and searches it,
+while LxmlParser extracts the fields in a single pass with compiled XPath
+expressions over an lxml tree.
+
+The parser is selected with the environment variable MTGTOP8_PARSER ("bs4" or
+"lxml", "bs4" if unset), so it is inherited by the joblib workers too. The
+libraries of each parser are imported only when it is first used, which keeps
+short the start of the processes that do not parse pages (e.g., the AWS Lambda
+producer when the page counts are known).
+"""
+
+
+def _has_class(name):
+
+    # XPath condition equivalent to BeautifulSoup's {"class": name}, which
+    # matches any element with name among its classes
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+
+class SoupParser:
+
+    """
+    This class implements the parser based on BeautifulSoup.
+    """
+
+    def __init__(self):
+
+        from bs4 import BeautifulSoup
+
+        self.soup = BeautifulSoup
+
+    def parse_list(self, content):
+
+        """
+        Parse the list of decks returned by the search engine.
+
+        Parameters
+        ----------
+        content : bytes
+            The html response of the search engine
+
+        Returns
+        -------
+        List of dictionaries
+            The metadata of each deck, with the relative link to its page (key
+            "rel_link") and the keys "result", "date", "player", "event" and
+            "name"
+        """
+
+        # parse the html reponse
+        deck_list_soup = self.soup(content, features="lxml")
+
+        # main table with the deck list
+        table = deck_list_soup.find_all("tr", {"class": "hover_tr"})
+
+        # relative links to the decks
+        rel_links = [
+            td.find_all("td", {"class": "S12"})[0].find("a")["href"] for td in table
+        ]
+
+        # name of the decks
+        names = [
+            td.find_all("td", {"class": "S12"})[0].find("a").getText() for td in table
+        ]
+
+        # name of the player
+        players = [td.find("td", {"class": "G12"}).getText() for td in table]
+
+        # name of the event
+        events = [td.find("td", {"class": "S11"}).getText() for td in table]
+
+        # results of the decks in the competitions
+        results = [td.find_all("td", {"class": "S12"})[1].getText() for td in table]
+
+        # date of the competition in which the deck was played
+        dates = [td.find_all("td", {"class": "S11"})[1].getText() for td in table]
+
+        return [
+            {
+                "rel_link": x[0],
+                "result": x[1],
+                "date": x[2],
+                "player": x[3],
+                "event": x[4],
+                "name": x[5],
+            }
+            for x in zip(rel_links, results, dates, players, events, names)
+        ]
+
+    def parse_deck_page(self, content):
+
+        """
+        Parse a deck's page to find the link to the MTGO file with the cards and
+        the deck's type.
+
+        Parameters
+        ----------
+        content : bytes
+            The html response of the deck's page
+
+        Returns
+        -------
+        Tuple
+            The relative link to the MTGO file and the deck type (None if the
+            deck type could not be parsed)
+        """
+
+        # parse the html reponse
+        deck_web_soup = self.soup(content, features="lxml")
+
+        # the div with the download link has ' MTGO' on its text, and the next div
+        # is the one with the deck type. We create a generator of divs to find
+        # the one with the text, and then get and keep the next one
+        div_list = (d for d in deck_web_soup.find_all("div", {"class": "S14"}))
+        div = None
+
+        for div in div_list:
+            if " MTGO" in div.getText():
+                break
+
+        assert div is not None
+        download_rel_link = div.find("a")["href"]
+
+        try:
+            div_type = next(div_list)
+            deck_type = div_type.find("a").getText().replace(" decks", "")
+
+        except StopIteration:
+            deck_type = None
+
+        return download_rel_link, deck_type
+
+
+class LxmlParser:
+
+    """
+    This class implements the parser based on compiled XPath expressions over
+    an lxml tree. The html is decoded in the same way as BeautifulSoup does, so
+    that both parsers produce the same output.
+    """
+
+    def __init__(self):
+
+        from bs4.dammit import UnicodeDammit
+        import lxml.html
+        from lxml import etree
+
+        self.dammit = UnicodeDammit
+        self.document_fromstring = lxml.html.document_fromstring
+
+        self.rows = etree.XPath("//tr[{}]".format(_has_class("hover_tr")))
+        self.s12_cells = etree.XPath(".//td[{}]".format(_has_class("S12")))
+        self.s11_cells = etree.XPath(".//td[{}]".format(_has_class("S11")))
+        self.g12_cells = etree.XPath(".//td[{}]".format(_has_class("G12")))
+        self.s14_divs = etree.XPath("//div[{}]".format(_has_class("S14")))
+        self.links = etree.XPath(".//a")
+
+    def _parse(self, content):
+
+        markup = self.dammit(content, is_html=True).unicode_markup
+        return self.document_fromstring(markup)
+
+    def parse_list(self, content):
+
+        """
+        Parse the list of decks returned by the search engine (see
+        SoupParser.parse_list).
+        """
+
+        deck_list = list()
+
+        for row in self.rows(self._parse(content)):
+            s12 = self.s12_cells(row)
+            s11 = self.s11_cells(row)
+            link = self.links(s12[0])[0]
+
+            deck_list.append(
+                {
+                    "rel_link": link.get("href"),
+                    "result": s12[1].text_content(),
+                    "date": s11[1].text_content(),
+                    "player": self.g12_cells(row)[0].text_content(),
+                    "event": s11[0].text_content(),
+                    "name": link.text_content(),
+                }
+            )
+
+        return deck_list
+
+    def parse_deck_page(self, content):
+
+        """
+        Parse a deck's page to find the link to the MTGO file with the cards and
+        the deck's type (see SoupParser.parse_deck_page).
+        """
+
+        div_list = iter(self.s14_divs(self._parse(content)))
+        div = None
+
+        for div in div_list:
+            if " MTGO" in div.text_content():
+                break
+
+        assert div is not None
+        download_rel_link = self.links(div)[0].get("href")
+
+        try:
+            div_type = next(div_list)
+            deck_type = self.links(div_type)[0].text_content().replace(" decks", "")
+
+        except StopIteration:
+            deck_type = None
+
+        return download_rel_link, deck_type
+
+
+PARSERS = {"bs4": SoupParser, "lxml": LxmlParser}
+
+# the parser objects, created on their first use
+_PARSER_INSTANCES = dict()
+
+
+def configure_parser(name):
+
+    """
+    Select the parser used by this process and by the child processes started
+    afterwards.
+
+    Parameters
+    ----------
+    name: string
+        The parser name ("bs4" or "lxml")
+    """
+
+    assert name in PARSERS
+    os.environ["MTGTOP8_PARSER"] = name
+
+    return
+
+
+def get_parser():
+
+    """
+    Get the selected parser, creating it on the first call.
+
+    Returns
+    -------
+    SoupParser or LxmlParser
+        The parser
+    """
+
+    name = os.environ.get("MTGTOP8_PARSER") or "bs4"
+    if name not in _PARSER_INSTANCES:
+        _PARSER_INSTANCES[name] = PARSERS[name]()
+
+    return _PARSER_INSTANCES[name]
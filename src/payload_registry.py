@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+from io import StringIO
+
+# pylint: disable=W0105
+
+"""
+This module defines the registry of the search payloads processed by the AWS
+Lambda producer (see lambda_handlers.deck_producer). It is an append-only log
+stored through the classes of the module data_handler, so it can be kept in the
+local file system or in an AWS S3 bucket.
+"""
+
+
+class PayloadRegistry:
+
+    """
+    This class provides methods to append entries to the registry and to read
+    them.
+
+    Each entry is stored in its own file, <name>-<sequence number>.json, which
+    is written with a conditional write (see DataHandler.write_new). Thus,
+    appending an entry never rewrites the previous ones, and two producers
+    appending at the same time cannot overwrite each other's entry: the second
+    one finds the file taken and moves to the next sequence number.
+
+    The sequence number and the content of the latest entry are also kept in
+    the file <name>-HEAD.json, the watermark, so the latest entry is read with
+    a constant number of requests however long the registry is. The watermark
+    is updated after each append, and it might lag behind if a producer stops
+    in between, so the entries after it are looked up when it is read.
+
+    The file of an entry can also hold a batch of entries, as a list, which are
+    appended at once (see import_csv). The latest entry of a batch is its last
+    one.
+    """
+
+    def __init__(self, data_handler, name="deck_payload_registry"):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        data_handler: DataHandler or DataHandlerS3
+            The object used to read and write the registry
+        name: string
+            The prefix of the registry files (or of the keys of the objects if
+            it is stored in S3)
+        """
+
+        self.data_handler = data_handler
+        self.name = name
+
+    def _entry_file(self, seq):
+
+        return "{}-{:08d}.json".format(self.name, seq)
+
+    def _head_file(self):
+
+        return "{}-HEAD.json".format(self.name)
+
+    def _read_entries(self, seq):
+
+        entries = json.load(self.data_handler.read(self._entry_file(seq)))
+
+        return entries if isinstance(entries, list) else [entries]
+
+    def head(self):
+
+        """
+        Get the latest entry of the registry.
+
+        Returns
+        -------
+        Tuple
+            The sequence number of the latest entry (-1 if the registry is
+            empty) and the entry (None if the registry is empty)
+        """
+
+        seq, entry = -1, None
+        if self.data_handler.file_exists(self._head_file()):
+            head = json.load(self.data_handler.read(self._head_file()))
+            seq, entry = head["seq"], head["entry"]
+
+        # the entries appended after the watermark was last updated
+        while self.data_handler.file_exists(self._entry_file(seq + 1)):
+            seq += 1
+            entry = self._read_entries(seq)[-1]
+
+        return seq, entry
+
+    def latest(self):
+
+        """
+        Get the latest entry of the registry.
+
+        Returns
+        -------
+        dictionary
+            The entry, or None if the registry is empty
+        """
+
+        return self.head()[1]
+
+    def append(self, entry, after=None):
+
+        """
+        Append an entry to the registry.
+
+        Parameters
+        ----------
+        entry: dictionary
+            The entry
+        after: int
+            The sequence number of the latest entry when the caller read the
+            registry (see head). If given, the entry is appended only if no
+            other entry was appended since then. If None, the entry is
+            appended after the latest one, whichever it is
+
+        Returns
+        -------
+        int
+            The sequence number of the entry
+
+        Raises
+        ------
+        FileExistsError
+            If after is given and another entry was appended after it
+        """
+
+        seq = (self.head()[0] if after is None else after) + 1
+
+        while True:
+            try:
+                self.data_handler.write_new(
+                    StringIO(json.dumps(entry)), self._entry_file(seq)
+                )
+                break
+            except FileExistsError:
+                if after is not None:
+                    raise
+                seq += 1
+
+        # the watermark is not updated if another producer already moved it
+        # past this entry
+        if self.head()[0] == seq:
+            self.data_handler.write(
+                StringIO(json.dumps({"seq": seq, "entry": entry})), self._head_file()
+            )
+
+        return seq
+
+    def entries(self):
+
+        """
+        Read all the entries of the registry, in the order they were appended.
+
+        Returns
+        -------
+        list of dictionaries
+            The entries
+        """
+
+        seq = 0
+        entries = list()
+        while self.data_handler.file_exists(self._entry_file(seq)):
+            entries += self._read_entries(seq)
+            seq += 1
+
+        return entries
+
+    def import_csv(self, iostr):
+
+        """
+        Import the rows of a registry stored as a CSV file with a header line
+        (e.g., the registry of previous versions of the producer) into an
+        empty registry. The rows are written as a single batch with a
+        conditional write, so if several producers import the file at the
+        same time, only one of them does.
+
+        Parameters
+        ----------
+        iostr: StringIO
+            The string stream with the CSV file
+
+        Returns
+        -------
+        bool
+            Whether the rows were imported, i.e., False if the registry was not
+            empty (e.g., another producer imported them)
+        """
+
+        rows = list(csv.DictReader(iostr))
+        if len(rows) == 0:
+            return False
+
+        try:
+            self.data_handler.write_new(StringIO(json.dumps(rows)), self._entry_file(0))
+        except FileExistsError:
+            return False
+
+        if self.head()[0] == 0:
+            self.data_handler.write(
+                StringIO(json.dumps({"seq": 0, "entry": rows[-1]})), self._head_file()
+            )
+
+        return True
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import gzip
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# pylint: disable=W0105
+
+"""
+This module implements a local stand-in for www.mtgtop8.com, which serves
+generated search results pages, deck pages and MTGO files with the same
+structure as the real ones. It allows testing and load-testing the web
+scraper without accessing the real website. The latency, the rate of errors and
+the number of results pages are configurable. Like the real website, it keeps
+the connections alive (HTTP/1.1) and compresses the responses with gzip when the
+client accepts it.
+
+It can be used from the command line, e.g.:
+
+    python src/replay_server.py --port 8080 --pages 400 --latency 0.2
+
+and then the web scraper can be pointed to it with --base-url, e.g.:
+
+    python src/download_decks.py --base-url http://localhost:8080/ -p '{"format": "MO"}'
+"""
+
+SEARCH_ROW = """<tr class="hover_tr">
+<td class="L14"><input type="checkbox" name="d[]" value="{deck}"></td>
+<td class="S12"><a href="event?e={event}&amp;d={deck}&amp;f={format}">{name}</a></td>
+<td class="G12"><a href="search?player={player}">{player}</a></td>
+<td class="S11"><a href="event?e={event}&amp;f={format}">{event_name}</a></td>
+<td align="center"><img src="/graph/star.png"></td>
+<td class="S12" align="center">{result}</td>
+<td class="S11" align="center">{date}</td>
+</tr>
+"""
+
+SEARCH_PAGE = """<html>
+<head><title>MTGTOP8 - Search</title></head>
+<body>
+<form name="compare_decks" action="compare" method="POST">
+<table class="Stable" width="100%">
+<tr class="w_title">
+<td></td><td>Deck</td><td>Player</td><td>Event</td><td>Level</td><td>Rank</td><td>Date</td>
+</tr>
+{rows}</table>
+</form>
+</body>
+</html>
+"""
+
+DECK_PAGE = """<html>
+<head><title>{event_name} @ mtgtop8.com</title></head>
+<body>
+<div class="event_title">{event_name}</div>
+<div class="S14">32 players - {date}</div>
+<div class="S14">Export : <a href="mtgo?d={deck}&amp;f={name}">MTGO</a> - <a href="dec?d={deck}">Cockatrice</a></div>
+<div class="S14"><a href="archetype?a={archetype}&amp;f={format}">{deck_type} decks</a></div>
+</body>
+</html>
+"""
+
+DECK_TYPES = ["Burn", "Hammer Time", "Izzet Murktide", "Living End", "Amulet Titan"]
+
+CARDS = [
+    "Lightning Bolt",
+    "Counterspell",
+    "Ragavan, Nimble Pilferer",
+    "Fire/Ice",
+    "Steam Vents",
+    "Island",
+    "Mountain",
+    "Blood Moon",
+]
+
+
+class ReplayServer:
+
+    """
+    This class implements the server. The decks are generated deterministically
+    from their results page and position, so the same request always gets the
+    same response (except for the injected errors).
+    """
+
+    def __init__(
+        self,
+        port=0,
+        n_pages=10,
+        decks_per_page=25,
+        latency=0.0,
+        error_rate=0.0,
+        seed=None,
+        connect_latency=0.0,
+    ):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        port: int
+            The port. If 0, a free port is chosen (see the attribute url)
+        n_pages: int
+            Number of non-empty search results pages
+        decks_per_page: int
+            Number of decks in each search results page
+        latency: float
+            Mean time in seconds to wait before sending each response. The
+            actual times are uniformly distributed between 0.5 and 1.5 times it
+        error_rate: float
+            Probability of answering a request with an HTTP error 503
+        seed: int
+            Seed of the random number generator of the latencies and errors
+        connect_latency: float
+            Time in seconds to wait before answering the first request of each
+            connection, which emulates the TCP and TLS handshakes with a remote
+            server
+        """
+
+        self.n_pages = n_pages
+        self.decks_per_page = decks_per_page
+        self.latency = latency
+        self.error_rate = error_rate
+        self.connect_latency = connect_latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_connections = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # pylint: disable=C0103
+
+            protocol_version = "HTTP/1.1"
+
+            # the headers and the body are sent in separate writes, which
+            # would be delayed on kept-alive connections otherwise
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.n_connections += 1
+                time.sleep(server.connect_latency)
+
+            def do_GET(self):
+                server.handle(self, parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                server.handle(self, parse_qs(body))
+
+            def log_message(self, format, *args):
+                # pylint: disable=W0622
+                return
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+
+        """
+        The URL of the server.
+        """
+
+        return "http://127.0.0.1:{}/".format(self.httpd.server_address[1])
+
+    def deck(self, page, position, deck_format="MO"):
+
+        """
+        Generate the data of a deck.
+
+        Parameters
+        ----------
+        page: int
+            The search results page
+        position: int
+            The position of the deck within the page
+        deck_format: string
+            The format of the deck
+
+        Returns
+        -------
+        dictionary
+            The fields of the html pages of the deck
+        """
+
+        deck = page * 1000 + position
+        event = deck // 8
+
+        return {
+            "deck": deck,
+            "event": event,
+            "format": deck_format,
+            "name": DECK_TYPES[deck % len(DECK_TYPES)],
+            "player": "Player{}".format(deck),
+            "event_name": "MTGO {} Challenge #{}".format(deck_format, event),
+            "result": str(1 + deck % 8),
+            "date": "{:02d}/{:02d}/21".format(1 + event % 28, 1 + event % 12),
+            "deck_type": DECK_TYPES[deck % len(DECK_TYPES)],
+            "archetype": deck % len(DECK_TYPES),
+        }
+
+    def search_page(self, query):
+
+        page = int(query.get("current_page", ["1"])[0])
+        deck_format = query.get("format", ["MO"])[0]
+
+        rows = ""
+        if 1 <= page <= self.n_pages:
+            rows = "".join(
+                SEARCH_ROW.format(**self.deck(page, i, deck_format))
+                for i in range(self.decks_per_page)
+            )
+
+        return SEARCH_PAGE.format(rows=rows)
+
+    def deck_page(self, query):
+
+        deck = int(query["d"][0])
+        data = self.deck(deck // 1000, deck % 1000, query.get("f", ["MO"])[0])
+
+        return DECK_PAGE.format(**data)
+
+    @staticmethod
+    def mtgo_file(query):
+
+        deck = int(query["d"][0])
+        lines = ["{} {}".format(1 + (deck + i) % 4, c) for i, c in enumerate(CARDS)]
+        lines = lines[:6] + ["Sideboard"] + lines[6:]
+
+        return "\r\n".join(lines) + "\r\n"
+
+    def handle(self, request, query):
+
+        """
+        Answer a request.
+
+        Parameters
+        ----------
+        request: BaseHTTPRequestHandler
+            The request
+        query: dictionary
+            The parameters of the query string (GET) or the form (POST)
+        """
+
+        with self.lock:
+            self.n_requests += 1
+            latency = self.latency * self.random.uniform(0.5, 1.5)
+            error = self.random.random() < self.error_rate
+
+        time.sleep(latency)
+
+        path = urlparse(request.path).path
+        if error:
+            status, body = 503, "Service Unavailable"
+        elif path == "/search" and request.command == "POST":
+            status, body = 200, self.search_page(query)
+        elif path == "/event":
+            status, body = 200, self.deck_page(query)
+        elif path == "/mtgo":
+            status, body = 200, self.mtgo_file(query)
+        else:
+            status, body = 404, "Not Found"
+
+        content = body.encode("ISO-8859-1" if path == "/mtgo" else "utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "text/html; charset=utf-8")
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content)
+            request.send_header("Content-Encoding", "gzip")
+        request.send_header("Content-Length", str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+        return
+
+    def start(self):
+
+        """
+        Start serving in a background thread.
+        """
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+        return
+
+    def stop(self):
+
+        """
+        Stop serving.
+        """
+
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+        return
+
+
+def main():
+
+    """
+    Run the replay server.
+
+    Command-line interface:
+
+      -h, --help            show this help message and exit
+      --port PORT           Port of the server
+      --pages PAGES         Number of non-empty search results pages
+      --decks-per-page DECKS_PER_PAGE
+                            Number of decks in each search results page
+      --latency LATENCY     Mean time in seconds to wait before each response
+      --error-rate ERROR_RATE
+                            Probability of answering with an HTTP error 503
+      --connect-latency CONNECT_LATENCY
+                            Time in seconds to wait before answering the first
+                            request of each connection
+    """
+
+    parser = argparse.ArgumentParser(description="Local stand-in for www.mtgtop8.com")
+    parser.add_argument("--port", type=int, help="Port of the server", default=8080)
+    parser.add_argument(
+        "--pages", type=int, help="Number of non-empty search results pages", default=10
+    )
+    parser.add_argument(
+        "--decks-per-page",
+        type=int,
+        help="Number of decks in each search results page",
+        default=25,
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        help="Mean time in seconds to wait before each response",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        help="Probability of answering with an HTTP error 503",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--connect-latency",
+        type=float,
+        help="Time in seconds to wait before answering the first request of each connection",
+        default=0.0,
+    )
+    args = vars(parser.parse_args())
+
+    server = ReplayServer(
+        args["port"],
+        args["pages"],
+        args["decks_per_page"],
+        args["latency"],
+        args["error_rate"],
+        connect_latency=args["connect_latency"],
+    )
+    print("Serving on {}".format(server.url))
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+    return
+
+
+if __name__ == "__main__":
+    main()
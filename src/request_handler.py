@@ -0,0 +1,1127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import json
+import random
+import hashlib
+import tempfile
+import threading
+import fcntl
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+from helpers import LOG
+from metrics import METRICS
+
+# pylint: disable=W0105
+
+"""
+This module defines the single entry point through which the web scraper sends
+its HTTP requests to www.mtgtop8.com, so that policies common to all of them
+(e.g., rate limiting, caching and retrying) are applied in one place.
+
+The rate limit is configured with the environment variables MTGTOP8_RATE_LIMIT
+(requests per second, no limit if unset or 0), MTGTOP8_RATE_BURST (maximum
+number of requests sent in a burst) and MTGTOP8_RATE_LIMIT_FILE (the file
+holding the state shared by all the threads and processes of the host). Since
+child processes inherit the environment, the limit is shared by the joblib
+workers too.
+
+In the same way, the on-disk response cache is configured with the environment
+variables MTGTOP8_CACHE_DIR (no cache if unset) and MTGTOP8_CACHE_SIZE (maximum
+size of the cache in MB).
+
+The failed requests (connection errors, timeouts and the HTTP errors in
+RETRY_STATUS) are retried with a jittered exponential backoff. Besides, the
+number of concurrent requests sent to each host by the threads of a process
+is adapted to the health of the server (see AIMDController), and all of them
+are paused when the server keeps failing (see CircuitBreaker). These policies
+are configured with configure_resilience, or with the environment variables
+MTGTOP8_MAX_RETRIES, MTGTOP8_RETRY_BACKOFF, MTGTOP8_MAX_BACKOFF,
+MTGTOP8_MAX_CONCURRENCY, MTGTOP8_LATENCY_TARGET, MTGTOP8_BREAKER_THRESHOLD,
+MTGTOP8_BREAKER_TIMEOUT and MTGTOP8_TIMEOUT.
+
+The requests are sent through a single session per process (see get_session),
+whose connection pools keep the connections to each host alive across results
+pages, so they are not established again for each page. The URLs of
+www.mtgtop8.com are normalized to a canonical scheme and host (see
+canonical_url), so that all the requests use the same connections and cache
+entries.
+"""
+
+# default file holding the state of the token bucket shared across processes
+DEFAULT_RATE_LIMIT_FILE = os.path.join(tempfile.gettempdir(), "mtgtop8_rate_limit")
+
+# default maximum size of the response cache, in MB
+DEFAULT_CACHE_SIZE = 1024
+
+# default time to live of the cached responses of each class of URL, in
+# seconds (None means that they never expire). The search results change as new
+# decks are added, but the deck pages and their MTGO files never change
+DEFAULT_CACHE_TTLS = {"search": 3600, "deck": None}
+
+_RATE_LIMITER = None
+_RATE_LIMITER_LOADED = False
+_RATE_LIMITER_LOCK = threading.Lock()
+
+# HTTP status codes of the failed responses that are retried
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# default values of the settings of the retries, the concurrency controller and
+# the circuit breaker (see configure_resilience)
+DEFAULT_RESILIENCE = {
+    "max_retries": 4,
+    "retry_backoff": 1.0,
+    "max_backoff": 60.0,
+    "max_concurrency": 8,
+    "latency_target": 10.0,
+    "breaker_threshold": 10,
+    "breaker_timeout": 30.0,
+    "timeout": 30.0,
+}
+
+_CACHE = None
+_CACHE_LOADED = False
+_CACHE_LOCK = threading.Lock()
+
+_RESILIENCE = None
+_CONTROLLERS = dict()
+_BREAKER = None
+_RESILIENCE_LOCK = threading.Lock()
+
+# the time (as returned by time.time()) after which the requests are not sent
+# or retried (see configure_deadline)
+_DEADLINE = None
+
+# the scheme and host of the URLs of each host name of the website. The website
+# is served from both http://mtgtop8.com and https://www.mtgtop8.com, and its
+# links mix them
+CANONICAL_HOSTS = {
+    "mtgtop8.com": ("https", "www.mtgtop8.com"),
+    "www.mtgtop8.com": ("https", "www.mtgtop8.com"),
+}
+
+_SESSION = None
+_SESSION_PID = None
+_SESSION_LOCK = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+
+    """
+    Raised by send_request when a request cannot be sent or retried before the
+    deadline of the process (see configure_deadline).
+    """
+
+
+class TokenBucket:
+
+    """
+    This class implements a token bucket that limits the rate at which requests
+    are sent. The bucket is refilled with rate tokens per second up to burst
+    tokens, and each request takes one token. If the bucket is empty, the
+    request waits until a token becomes available.
+
+    If a file is given, the state of the bucket is kept in it and protected with
+    an exclusive lock, so that the bucket is shared by all the processes using
+    the same file. Otherwise, it is shared only by the threads of the process.
+    """
+
+    def __init__(self, rate, burst=1, path=None):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        rate: float
+            Number of requests per second
+        burst: int
+            Maximum number of requests that can be sent in a burst
+        path: string
+            The file with the state of the bucket. If None, the state is kept in memory
+        """
+
+        assert rate > 0 and burst >= 1
+
+        self.rate = rate
+        self.burst = burst
+        self.path = path
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+        self.timestamp = time.time()
+
+    def _reserve(self, tokens, timestamp):
+
+        # refill the bucket and take one token. The number of tokens becomes
+        # negative if the bucket is empty, which reserves the token for the
+        # caller, who must wait until the bucket is refilled with it
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - timestamp) * self.rate) - 1
+        wait = max(0.0, -tokens / self.rate)
+
+        return tokens, now, wait
+
+    def _reserve_shared(self):
+
+        with open(self.path, "a+", encoding="utf-8") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                state = state_file.read().split()
+                if len(state) == 2:
+                    tokens, timestamp = float(state[0]), float(state[1])
+                else:
+                    tokens, timestamp = float(self.burst), time.time()
+
+                tokens, timestamp, wait = self._reserve(tokens, timestamp)
+
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write("{} {}".format(tokens, timestamp))
+                state_file.flush()
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+
+        return wait
+
+    def acquire(self):
+
+        """
+        Take a token from the bucket, blocking until it is available.
+
+        Returns
+        -------
+        float
+            The time waited, in seconds
+        """
+
+        with self.lock:
+            if self.path is not None:
+                wait = self._reserve_shared()
+            else:
+                self.tokens, self.timestamp, wait = self._reserve(
+                    self.tokens, self.timestamp
+                )
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+
+class ResponseCache:
+
+    """
+    This class implements a persistent cache of HTTP responses in the local file
+    system. The responses are identified by the HTTP method, the URL and the
+    body of the request, and expire according to the time to live of their
+    class of URL. When the cache exceeds its maximum size, the least recently
+    used responses are evicted.
+
+    Each response is stored in its own file, written atomically, so the cache
+    can be shared by several processes.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE * 2**20, ttls=None):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        directory: string
+            The directory where the responses are stored
+        max_bytes: int
+            The maximum size of the cache, in bytes
+        ttls: dictionary
+            Time to live in seconds of each class of URL ("search" and "deck").
+            If None, DEFAULT_CACHE_TTLS is used
+        """
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_CACHE_TTLS, **(ttls or dict()))
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def url_class(url):
+
+        """
+        Get the class of a URL, which defines the time to live of its responses.
+
+        Parameters
+        ----------
+        url: string
+            The URL
+
+        Returns
+        -------
+        string
+            "search" for the search engine, "deck" for the rest
+        """
+
+        if urlparse(url).path.rstrip("/").endswith("/search"):
+            return "search"
+
+        return "deck"
+
+    @staticmethod
+    def make_key(method, url, data=None):
+
+        """
+        Compute the key identifying a request.
+
+        Parameters
+        ----------
+        method: string
+            The HTTP method
+        url: string
+            The URL
+        data: dictionary
+            The body of the request
+
+        Returns
+        -------
+        string
+            The key
+        """
+
+        body = json.dumps(data, sort_keys=True, default=str)
+        request_str = "{}|{}|{}".format(method.upper(), url, body)
+
+        return hashlib.sha256(str.encode(request_str)).hexdigest()
+
+    def _path(self, key):
+
+        return os.path.join(self.directory, key[:2], key)
+
+    def _entries(self):
+
+        # (path, last access time, size) of each cached response
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                # skip the responses being written by other threads or processes
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def get(self, method, url, data=None):
+
+        """
+        Get a cached response.
+
+        Parameters
+        ----------
+        method: string
+            The HTTP method
+        url: string
+            The URL
+        data: dictionary
+            The body of the request
+
+        Returns
+        -------
+        requests.Response object
+            The cached response, or None if it is not cached or it has expired
+        """
+
+        path = self._path(self.make_key(method, url, data))
+
+        try:
+            with open(path, "rb") as infile:
+                meta = json.loads(infile.readline())
+                content = infile.read()
+        except (FileNotFoundError, ValueError):
+            return None
+
+        ttl = self.ttls[self.url_class(url)]
+        if ttl is not None and time.time() - meta["time"] > ttl:
+            return None
+
+        # the modification time keeps track of the last access for the LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        response = requests.Response()
+        response.url = meta["url"]
+        response.status_code = meta["status_code"]
+        response.headers.update(meta["headers"])
+        # pylint: disable-next=W0212
+        response._content = content
+
+        return response
+
+    def put(self, method, url, data, response):
+
+        """
+        Store a response. Only successful responses are stored.
+
+        Parameters
+        ----------
+        method: string
+            The HTTP method
+        url: string
+            The URL
+        data: dictionary
+            The body of the request
+        response: requests.Response object
+            The response
+        """
+
+        if response.status_code != 200:
+            return
+
+        path = self._path(self.make_key(method, url, data))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        meta = {
+            "url": response.url,
+            "status_code": response.status_code,
+            "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+            "time": time.time(),
+        }
+
+        # write to a temporary file and move it, so other processes never read
+        # a partially written response
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(str.encode(json.dumps(meta) + "\n"))
+            outfile.write(response.content)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.size += size
+            if self.size > self.max_bytes:
+                self.evict()
+
+        return
+
+    def evict(self):
+
+        """
+        Remove the least recently used responses until the cache takes less than
+        90% of its maximum size.
+        """
+
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.size = sum(size for _, _, size in entries)
+
+        for path, _, size in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+        return
+
+
+class AIMDController:
+
+    """
+    This class adapts the number of concurrent requests sent to a host with an
+    additive increase, multiplicative decrease (AIMD) policy. The limit grows by
+    one every limit successful requests, while it is fully used, and it is
+    multiplied by a factor < 1 when a request fails or its latency exceeds the
+    target. The decreases are spaced by at least the target latency, so a burst
+    of failures of requests sent at the same time counts only once.
+    """
+
+    def __init__(self, max_limit, latency_target, min_limit=1, decrease_factor=0.5):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        max_limit: int
+            Maximum (and initial) number of concurrent requests
+        latency_target: float
+            Latency in seconds above which the server is considered overloaded
+        min_limit: int
+            Minimum number of concurrent requests
+        decrease_factor: float
+            Factor applied to the limit when the server is overloaded
+        """
+
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.limit = float(max_limit)
+        self.active = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+
+        """
+        Wait until a request can be sent.
+
+        Returns
+        -------
+        Bool
+            Whether the request uses the last available slot, i.e., whether the
+            limit is binding
+        """
+
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+            return self.active >= int(self.limit)
+
+    def release(self, success, latency, binding):
+
+        """
+        Record the outcome of a request and free its slot.
+
+        Parameters
+        ----------
+        success: bool
+            Whether the request succeeded
+        latency: float
+            The latency of the request, in seconds
+        binding: bool
+            The value returned by acquire for the request
+        """
+
+        with self.condition:
+            self.active -= 1
+            now = time.time()
+
+            if not success or latency > self.latency_target:
+                if now - self.last_decrease > self.latency_target:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+            elif binding:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+        return
+
+
+class CircuitBreaker:
+
+    """
+    This class stops sending requests when the server keeps failing. After a
+    number of consecutive failed requests, the breaker opens and all the
+    requests of the process wait until it closes again, after a timeout. If the
+    first requests sent after the timeout fail too, it opens again.
+    """
+
+    def __init__(self, threshold, timeout):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        threshold: int
+            Number of consecutive failed requests that open the breaker
+        timeout: float
+            Time in seconds during which the breaker stays open
+        """
+
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self, max_wait=None):
+
+        """
+        Wait until the breaker is closed.
+
+        Parameters
+        ----------
+        max_wait: float
+            The maximum time to wait, in seconds. If None, there is no maximum
+
+        Returns
+        -------
+        float
+            The time waited, in seconds
+        """
+
+        with self.lock:
+            wait = max(0.0, self.open_until - time.time())
+        if max_wait is not None:
+            wait = min(wait, max_wait)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+    def record(self, success):
+
+        """
+        Record the outcome of a request.
+
+        Parameters
+        ----------
+        success: bool
+            Whether the request succeeded
+        """
+
+        with self.lock:
+            if success:
+                self.failures = 0
+                return
+
+            self.failures += 1
+            now = time.time()
+            if self.failures >= self.threshold and now >= self.open_until:
+                self.open_until = now + self.timeout
+                LOG.warning(
+                    "%d consecutive failed requests, pausing requests for %.1f s",
+                    self.failures,
+                    self.timeout,
+                )
+
+        return
+
+
+def configure_rate_limit(rate, burst=1, path=DEFAULT_RATE_LIMIT_FILE):
+
+    """
+    Configure the rate limit of the requests sent by this process and by the
+    child processes started afterwards.
+
+    Parameters
+    ----------
+    rate: float
+        Number of requests per second. If None or 0, the requests are not limited
+    burst: int
+        Maximum number of requests that can be sent in a burst
+    path: string
+        The file with the state shared by all the processes. If None, the
+        limit applies only within each process
+    """
+
+    # pylint: disable=W0603
+    global _RATE_LIMITER_LOADED
+
+    with _RATE_LIMITER_LOCK:
+        os.environ["MTGTOP8_RATE_LIMIT"] = str(rate or 0)
+        os.environ["MTGTOP8_RATE_BURST"] = str(burst)
+        os.environ["MTGTOP8_RATE_LIMIT_FILE"] = path or ""
+        _RATE_LIMITER_LOADED = False
+
+    return
+
+
+def configure_deadline(deadline):
+
+    """
+    Configure the deadline of the requests sent by the threads of this process
+    (e.g., by the AWS Lambda consumer, which must finish before its timeout).
+    The waits of the retries and of the circuit breaker, and the timeouts of
+    the requests, are capped at the time left before the deadline, and after
+    it the requests fail with DeadlineExceeded. Unlike the other settings, it
+    is not inherited by the child processes.
+
+    Parameters
+    ----------
+    deadline: float
+        The deadline, as returned by time.time(). If None, there is no deadline
+    """
+
+    # pylint: disable=W0603
+    global _DEADLINE
+
+    _DEADLINE = deadline
+
+    return
+
+
+def time_to_deadline():
+
+    """
+    Get the time left before the deadline of the process (see
+    configure_deadline).
+
+    Returns
+    -------
+    float
+        The time left, in seconds, or None if there is no deadline
+
+    Raises
+    ------
+    DeadlineExceeded
+        If the deadline has passed
+    """
+
+    if _DEADLINE is None:
+        return None
+
+    time_left = _DEADLINE - time.time()
+    if time_left <= 0:
+        raise DeadlineExceeded("the deadline of the requests has passed")
+
+    return time_left
+
+
+def get_rate_limiter():
+
+    """
+    Get the rate limiter of the process, creating it from the environment
+    variables on the first call.
+
+    Returns
+    -------
+    TokenBucket
+        The rate limiter, or None if the requests are not limited
+    """
+
+    # pylint: disable=W0603
+    global _RATE_LIMITER, _RATE_LIMITER_LOADED
+
+    with _RATE_LIMITER_LOCK:
+        if not _RATE_LIMITER_LOADED:
+            _RATE_LIMITER = None
+            rate = float(os.environ.get("MTGTOP8_RATE_LIMIT") or 0)
+            if rate > 0:
+                _RATE_LIMITER = TokenBucket(
+                    rate,
+                    int(os.environ.get("MTGTOP8_RATE_BURST") or 1),
+                    os.environ.get("MTGTOP8_RATE_LIMIT_FILE", DEFAULT_RATE_LIMIT_FILE)
+                    or None,
+                )
+            _RATE_LIMITER_LOADED = True
+
+        return _RATE_LIMITER
+
+
+def configure_cache(directory, max_size=DEFAULT_CACHE_SIZE):
+
+    """
+    Configure the response cache of the requests sent by this process and by
+    the child processes started afterwards.
+
+    Parameters
+    ----------
+    directory: string
+        The directory of the cache. If None, the responses are not cached
+    max_size: float
+        The maximum size of the cache, in MB
+    """
+
+    # pylint: disable=W0603
+    global _CACHE_LOADED
+
+    with _CACHE_LOCK:
+        os.environ["MTGTOP8_CACHE_DIR"] = directory or ""
+        os.environ["MTGTOP8_CACHE_SIZE"] = str(max_size)
+        _CACHE_LOADED = False
+
+    return
+
+
+def get_cache():
+
+    """
+    Get the response cache of the process, creating it from the environment
+    variables on the first call.
+
+    Returns
+    -------
+    ResponseCache
+        The response cache, or None if the responses are not cached
+    """
+
+    # pylint: disable=W0603
+    global _CACHE, _CACHE_LOADED
+
+    with _CACHE_LOCK:
+        if not _CACHE_LOADED:
+            _CACHE = None
+            directory = os.environ.get("MTGTOP8_CACHE_DIR")
+            if directory:
+                max_size = float(
+                    os.environ.get("MTGTOP8_CACHE_SIZE") or DEFAULT_CACHE_SIZE
+                )
+                _CACHE = ResponseCache(directory, int(max_size * 2**20))
+            _CACHE_LOADED = True
+
+        return _CACHE
+
+
+def configure_resilience(**settings):
+
+    """
+    Configure the retries, the concurrency controller and the circuit breaker
+    of the requests sent by this process and by the child processes started
+    afterwards.
+
+    Parameters
+    ----------
+    settings:
+        Any of max_retries (number of retries of a failed request), retry_backoff
+        (base time in seconds of the exponential backoff), max_backoff
+        (maximum backoff time), max_concurrency (maximum number of concurrent
+        requests per host), latency_target (latency in seconds above which the
+        server is considered overloaded), breaker_threshold (consecutive failed
+        requests that pause all the requests) and breaker_timeout (time in
+        seconds during which the requests are paused) and timeout (time in
+        seconds to wait for the connection and for each read of the response,
+        after which the request fails and is retried). See DEFAULT_RESILIENCE
+    """
+
+    # pylint: disable=W0603
+    global _RESILIENCE, _BREAKER
+
+    with _RESILIENCE_LOCK:
+        for k, v in settings.items():
+            assert k in DEFAULT_RESILIENCE
+            os.environ["MTGTOP8_" + k.upper()] = str(v)
+        _RESILIENCE = None
+        _BREAKER = None
+        _CONTROLLERS.clear()
+
+    # the size of the connection pools depends on the settings
+    close_session()
+
+    return
+
+
+def get_resilience():
+
+    """
+    Get the settings of the retries, the concurrency controller and the circuit
+    breaker, loading them from the environment variables on the first call.
+
+    Returns
+    -------
+    dictionary
+        The settings (see configure_resilience)
+    """
+
+    # pylint: disable=W0603
+    global _RESILIENCE
+
+    with _RESILIENCE_LOCK:
+        if _RESILIENCE is None:
+            _RESILIENCE = {
+                k: type(v)(os.environ.get("MTGTOP8_" + k.upper()) or v)
+                for k, v in DEFAULT_RESILIENCE.items()
+            }
+
+        return _RESILIENCE
+
+
+def get_circuit_breaker():
+
+    """
+    Get the circuit breaker of the process.
+
+    Returns
+    -------
+    CircuitBreaker
+        The circuit breaker
+    """
+
+    # pylint: disable=W0603
+    global _BREAKER
+
+    settings = get_resilience()
+
+    with _RESILIENCE_LOCK:
+        if _BREAKER is None:
+            _BREAKER = CircuitBreaker(
+                settings["breaker_threshold"], settings["breaker_timeout"]
+            )
+
+        return _BREAKER
+
+
+def get_concurrency_controller(url):
+
+    """
+    Get the concurrency controller of the host of a URL.
+
+    Parameters
+    ----------
+    url: string
+        The URL
+
+    Returns
+    -------
+    AIMDController
+        The concurrency controller
+    """
+
+    settings = get_resilience()
+    host = urlparse(url).netloc
+
+    with _RESILIENCE_LOCK:
+        if host not in _CONTROLLERS:
+            _CONTROLLERS[host] = AIMDController(
+                settings["max_concurrency"], settings["latency_target"]
+            )
+
+        return _CONTROLLERS[host]
+
+
+def retry_delay(attempt, response, settings):
+
+    """
+    Compute the time to wait before retrying a failed request, with a jittered
+    exponential backoff. If the server sent a Retry-After header (in seconds),
+    it is respected.
+
+    Parameters
+    ----------
+    attempt: int
+        The number of the failed attempt, starting at 0
+    response: requests.Response object
+        The response of the failed attempt, or None if there was no response
+    settings: dictionary
+        The settings of the retries (see configure_resilience)
+
+    Returns
+    -------
+    float
+        The time to wait, in seconds
+    """
+
+    delay = random.uniform(
+        0, min(settings["max_backoff"], settings["retry_backoff"] * 2**attempt)
+    )
+
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = max(delay, min(settings["max_backoff"], float(retry_after)))
+
+    return delay
+
+
+def cap_timeout(timeout, time_left):
+
+    """
+    Cap the timeout of a request at the time left before the deadline.
+
+    Parameters
+    ----------
+    timeout: float or tuple
+        The timeout, as accepted by requests: a number of seconds, a tuple
+        (connect timeout, read timeout) or None (no timeout)
+    time_left: float
+        The time left before the deadline, in seconds
+
+    Returns
+    -------
+    float or tuple
+        The capped timeout, in the same form
+    """
+
+    if isinstance(timeout, tuple):
+        return tuple(cap_timeout(t, time_left) for t in timeout)
+
+    if timeout is None:
+        return time_left
+
+    return min(timeout, time_left)
+
+
+def canonical_url(url):
+
+    """
+    Normalize the scheme and host of a URL of the website (see CANONICAL_HOSTS).
+    Other URLs are returned unchanged.
+
+    Parameters
+    ----------
+    url: string
+        The URL
+
+    Returns
+    -------
+    string
+        The canonical URL
+    """
+
+    parsed = urlparse(url)
+    if parsed.netloc not in CANONICAL_HOSTS:
+        return url
+
+    scheme, netloc = CANONICAL_HOSTS[parsed.netloc]
+
+    return parsed._replace(scheme=scheme, netloc=netloc).geturl()
+
+
+def get_session():
+
+    """
+    Get the session of the process, creating it on the first call. Its
+    connection pools hold as many connections per host as the maximum number of
+    concurrent requests per host (see configure_resilience), so the connections
+    are reused by all the threads of the process. A new session is created in
+    child processes, since connections cannot be shared with the parent.
+
+    Returns
+    -------
+    requests.Session object
+        The session
+    """
+
+    # pylint: disable=W0603
+    global _SESSION, _SESSION_PID
+
+    pool_size = get_resilience()["max_concurrency"]
+
+    with _SESSION_LOCK:
+        if _SESSION is None or _SESSION_PID != os.getpid():
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            _SESSION = requests.Session()
+            _SESSION.mount("http://", adapter)
+            _SESSION.mount("https://", adapter)
+            _SESSION_PID = os.getpid()
+
+        return _SESSION
+
+
+def close_session():
+
+    """
+    Close the session of the process, if it was created, and its connections.
+    The next call to get_session creates a new one.
+    """
+
+    # pylint: disable=W0603
+    global _SESSION
+
+    with _SESSION_LOCK:
+        if _SESSION is not None and _SESSION_PID == os.getpid():
+            _SESSION.close()
+        _SESSION = None
+
+    return
+
+
+def send_request(session_requests, method, url, **kwargs):
+
+    """
+    Send an HTTP request, waiting first for the rate limiter if there is one,
+    the concurrency controller of the host and the circuit breaker. The failed
+    requests are retried (see the module's documentation). If the response
+    cache is enabled, cached responses are returned without sending the request.
+
+    Parameters
+    ----------
+    session_requests : requests.Session object
+        A Session objects from the requests module
+    method: string
+        The HTTP method
+    url: string
+        The URL
+    kwargs:
+        Extra arguments for requests.Session.request
+
+    Returns
+    -------
+    requests.Response object
+        The response. If all the attempts failed, the response of the last one
+        (or the exception raised by it, if there was no response)
+
+    Raises
+    ------
+    DeadlineExceeded
+        If the request could not be sent, or retried, before the deadline of
+        the process (see configure_deadline)
+    """
+
+    url = canonical_url(url)
+
+    settings = get_resilience()
+
+    # without a timeout, a hung connection would keep its slot of the
+    # concurrency controller forever
+    kwargs.setdefault("timeout", settings["timeout"])
+
+    cache = get_cache()
+    if cache is not None:
+        response = cache.get(method, url, kwargs.get("data"))
+        if response is not None:
+            METRICS.count("cache_hits")
+            return response
+
+    rate_limiter = get_rate_limiter()
+    breaker = get_circuit_breaker()
+    controller = get_concurrency_controller(url)
+
+    for attempt in range(settings["max_retries"] + 1):
+        breaker.wait(time_to_deadline())
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        # the request must not outlive the deadline
+        time_left = time_to_deadline()
+        if time_left is not None:
+            kwargs["timeout"] = cap_timeout(kwargs["timeout"], time_left)
+
+        response = None
+        error = None
+        binding = controller.acquire()
+        t0 = time.time()
+        try:
+            response = session_requests.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = e
+        finally:
+            success = response is not None and response.status_code not in RETRY_STATUS
+            latency = time.time() - t0
+            controller.release(success, latency, binding)
+            breaker.record(success)
+            METRICS.count("requests")
+            METRICS.observe("request_latency", latency * 1000, "Milliseconds")
+
+        if success:
+            METRICS.count("bytes_downloaded", len(response.content), "Bytes")
+            break
+
+        if attempt == settings["max_retries"]:
+            if error is not None:
+                raise error
+            break
+
+        delay = retry_delay(attempt, response, settings)
+        time_left = time_to_deadline()
+        if time_left is not None:
+            delay = min(delay, time_left)
+        LOG.warning(
+            "Request %s %s failed (%s), retrying in %.1f s",
+            method,
+            url,
+            error if error is not None else response.status_code,
+            delay,
+        )
+        METRICS.count("retries")
+        time.sleep(delay)
+
+    if cache is not None:
+        cache.put(method, url, kwargs.get("data"), response)
+
+    return response
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import deque
+
+# pylint: disable=W0105
+
+"""
+This module defines how the budget of requests is split between several
+formats (e.g., Modern, Legacy and Pioneer) when their results pages are crawled
+together. The results pages are taken one at a time from a FormatScheduler,
+which gives each format a share of the requests proportional to its weight and
+to its backlog (the number of its results pages to crawl), so the formats with
+the largest backlogs get the most requests, and the shares are kept on the
+requests that the pages actually need.
+
+The command-line interface takes the results pages from the scheduler while it
+downloads them, and charges each page the requests it needed (see
+FormatScheduler.done). The AWS Lambda producer cannot do that, since it sends
+all the results pages to the queue of jobs at once, so it sends them in the
+order the scheduler would take them if every page needed the same requests
+(see interleave_payloads).
+
+The formats are given as a string "format[:weight],...", e.g., "MO:2,LE,PI"
+gives Modern twice the share of Legacy and Pioneer for the same backlog.
+"""
+
+# the format crawled if none is given
+DEFAULT_FORMATS = "MO"
+
+# the expected number of requests of a results page until the cost of some
+# pages is known: the search request and the two requests of each of its decks
+DEFAULT_PAGE_COST = 51
+
+
+def parse_formats(formats):
+
+    """
+    Parse the formats to crawl and their weights.
+
+    Parameters
+    ----------
+    formats: string
+        The formats, as "format[:weight],..." (e.g., "MO:2,LE,PI"). The weight
+        is 1 if it is not given
+
+    Returns
+    -------
+    dictionary
+        The weight of each format
+    """
+
+    weights = dict()
+    for item in formats.split(","):
+        deck_format, _, weight = item.strip().partition(":")
+        weights[deck_format] = float(weight) if weight else 1.0
+        if weights[deck_format] <= 0:
+            raise ValueError("the weight of {} must be positive".format(deck_format))
+
+    return weights
+
+
+class FormatScheduler:
+
+    """
+    This class splits the budget of requests between formats with deficit
+    round-robin. The budget is given in rounds: in each round, every format with
+    results pages left gets a quantum of requests proportional to its weight
+    times its backlog when the object was created (its current backlog would
+    cancel the weights as the pages of the heavier formats are taken), the
+    largest quantum being the expected cost of a page.
+    Taking a page spends its expected cost from the budget of its format (the
+    mean cost of the finished pages), and the difference with its actual cost
+    is charged when it is finished. The next page is taken from the format with
+    the largest backlog among those whose budget covers a page, and a new round
+    starts when none does. The budget left is kept for the next rounds.
+
+    Thus, the formats get a share of the requests proportional to their weights
+    and backlogs, also when their pages cost different numbers of requests
+    (e.g., because some decks were already downloaded or some pages were
+    already probed), and the formats without pages left leave their share to
+    the others. The pages of each format are taken in their order. The object
+    can be used from several threads.
+    """
+
+    def __init__(self, payload_lists, weights=None):
+
+        """
+        Initialize the object.
+
+        Parameters
+        ----------
+        payload_lists: dictionary
+            The payloads of the results pages of each format (see
+            download_decks.discover_search_pages), whose key "format" must be
+            the format they are listed under
+        weights: dictionary
+            The weight of each format (see parse_formats). If None, all the
+            formats have the same weight
+        """
+
+        self.weights = weights or dict()
+        self.backlogs = {f: deque(p) for f, p in payload_lists.items() if len(p) > 0}
+        self.shares = {f: self._weight(f) * len(p) for f, p in self.backlogs.items()}
+        self.deficits = {f: 0.0 for f in self.backlogs}
+        self.lock = threading.Lock()
+        # the costs charged to the pages taken and not finished, by format
+        self.charged = {f: deque() for f in self.backlogs}
+        # the requests of the finished pages, by format
+        self.requests = {f: 0 for f in self.backlogs}
+        self.cost_sum = 0
+        self.n_done = 0
+
+    def _weight(self, deck_format):
+
+        return self.weights.get(deck_format, 1.0)
+
+    def _expected_cost(self):
+
+        if self.n_done == 0:
+            return DEFAULT_PAGE_COST
+
+        return max(self.cost_sum / self.n_done, 1.0)
+
+    def _new_round(self, formats):
+
+        largest = max(self.shares[f] for f in formats)
+        for f in formats:
+            self.deficits[f] += self._expected_cost() * self.shares[f] / largest
+
+        return
+
+    def take(self):
+
+        """
+        Take the next results page to download.
+
+        Returns
+        -------
+        dictionary
+            The payload of the results page, or None if there are no pages left
+        """
+
+        with self.lock:
+            formats = [f for f, backlog in self.backlogs.items() if len(backlog) > 0]
+            if len(formats) == 0:
+                return None
+
+            cost = self._expected_cost()
+            while all(self.deficits[f] < cost for f in formats):
+                self._new_round(formats)
+
+            deck_format = max(
+                (f for f in formats if self.deficits[f] >= cost),
+                key=lambda f: (len(self.backlogs[f]), self._weight(f)),
+            )
+            self.deficits[deck_format] -= cost
+            self.charged[deck_format].append(cost)
+
+            return self.backlogs[deck_format].popleft()
+
+    def done(self, payload, cost):
+
+        """
+        Charge a finished results page the requests it needed.
+
+        Parameters
+        ----------
+        payload: dictionary
+            The payload of the results page, as returned by take
+        cost: int
+            The number of requests of the page
+        """
+
+        with self.lock:
+            deck_format = payload.get("format")
+            # the page was charged its expected cost when it was taken
+            self.deficits[deck_format] -= cost - self.charged[deck_format].popleft()
+            self.requests[deck_format] += cost
+            self.cost_sum += cost
+            self.n_done += 1
+
+        return
+
+
+def interleave_payloads(payload_lists, weights=None):
+
+    """
+    Interleave the payloads of the results pages of several formats in the
+    order they would be taken from a FormatScheduler if all the pages needed
+    the same number of requests. The order of the payloads of each format is
+    kept.
+
+    Parameters
+    ----------
+    payload_lists: dictionary
+        The payloads of the results pages of each format (see FormatScheduler)
+    weights: dictionary
+        The weight of each format (see parse_formats). If None, all the formats
+        have the same weight
+
+    Returns
+    -------
+    list of dictionaries
+        The payloads of all the formats, in the order they must be sent
+    """
+
+    return list(iter(FormatScheduler(payload_lists, weights).take, None))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import tracemalloc
+import pytest
+import requests
+
+from conftest import path_to_validation_data
+import download_decks
+import parsers
+
+# pylint: disable=W0613, W0621
+
+# These benchmarks time the CPU-bound steps of the web scraper against the
+# offline copies of the mtgtop8.com pages stored in the validation data
+# directory, and the download of decks from a local replay server, so they can
+# be run without network access as
+#
+#   pytest --benchmark-only ./test
+#
+# Besides the timings, each benchmark records the number of items processed
+# per call, the throughput in items per second and the peak memory allocated
+# by a call (in extra_info, see pytest-benchmark's --benchmark-json).
+
+
+def read_validation_file(filename):
+
+    with open(path_to_validation_data + filename, "rb") as infile:
+        return infile.read()
+
+
+def run_benchmark(benchmark, n_items, func, *args):
+
+    # the peak memory is measured in a separate call, since tracing the memory
+    # allocations slows down the timed calls
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = benchmark(func, *args)
+
+    benchmark.extra_info["items"] = n_items
+    benchmark.extra_info["peak_memory_kb"] = peak / 1024
+    if benchmark.stats is not None:
+        benchmark.extra_info["items_per_second"] = n_items / benchmark.stats.stats.mean
+
+    return result
+
+
+@pytest.fixture(params=sorted(parsers.PARSERS))
+def parser_name(request, monkeypatch):
+
+    monkeypatch.setenv("MTGTOP8_PARSER", request.param)
+
+    return request.param
+
+
+@pytest.fixture
+def tdecks():
+
+    # the decks of a full results page, with the cards of a full MTGO file
+    content = read_validation_file("test_search_page_full.html")
+    cards = read_validation_file("test_deck_mtgo_full.txt")
+
+    deck_list = download_decks.parse_list(content)
+    for deck in deck_list:
+        download_decks.update_deck(deck, cards, "Izzet Murktide")
+
+    return deck_list
+
+
+def test_benchmark_parse_list(benchmark, parser_name):
+
+    content = read_validation_file("test_search_page_full.html")
+
+    deck_list = run_benchmark(benchmark, 25, download_decks.parse_list, content)
+
+    assert len(deck_list) == 25
+
+
+def test_benchmark_parse_deck_page(benchmark, parser_name):
+
+    content = read_validation_file("test_deck_page.html")
+
+    link, deck_type = run_benchmark(
+        benchmark, 1, download_decks.parse_deck_page, content
+    )
+
+    assert link.startswith("mtgo?") and deck_type == "Red Deck Wins"
+
+
+def test_benchmark_update_deck(benchmark):
+
+    cards = read_validation_file("test_deck_mtgo_full.txt")
+
+    deck = run_benchmark(
+        benchmark, 1, download_decks.update_deck, dict(), cards, "Izzet Murktide"
+    )
+
+    assert "Fire//Ice" in deck["cards"]
+
+
+def test_benchmark_make_deck_hash(benchmark, tdecks):
+
+    def hash_decks(deck_list):
+        return [download_decks.make_deck_hash(deck) for deck in deck_list]
+
+    ids = run_benchmark(benchmark, len(tdecks), hash_decks, tdecks)
+
+    assert ids == [deck["id"] for deck in tdecks]
+
+
+def test_benchmark_serialize_decks(benchmark, tdecks):
+
+    # the output of a crawl of 40 results pages
+    deck_double_list = [tdecks] * 40
+
+    output = run_benchmark(
+        benchmark, 40 * len(tdecks), download_decks.serialize_decks, deck_double_list
+    )
+
+    assert len(json.loads(output)) == 40 * len(tdecks)
+
+
+@pytest.mark.parametrize("session", ["fresh", "pooled"])
+def test_benchmark_download_decks(
+    benchmark, session, tpayloads, treplay_server, monkeypatch
+):
+
+    # the decks of 3 results pages, with a new session for each page (i.e.,
+    # new connections) or with the shared session of the process. Setting up a
+    # connection costs 10 ms, as with a nearby remote server
+    treplay_server.connect_latency = 0.01
+    if session == "fresh":
+        monkeypatch.setattr(download_decks, "get_session", requests.session)
+
+    payload_list = [
+        dict(tpayloads["template_payload"], current_page=page) for page in (1, 2, 3)
+    ]
+
+    def download(payload_list):
+        return [
+            download_decks.download_decks_in_search_results(payload)
+            for payload in payload_list
+        ]
+
+    deck_double_list = run_benchmark(benchmark, 3 * 5, download, payload_list)
+
+    assert sum(len(deck_list) for deck_list in deck_double_list) == 3 * 5
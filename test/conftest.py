@@ -2,14 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import pytest
+import io
 import os
 import sys
 import json
+import hashlib
+import time
+import threading
+import requests
+from botocore.response import StreamingBody
+from botocore.exceptions import ClientError
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 import data_handler
+import replay_server
+import request_handler
 
-# pylint: disable=W0612, W0613, E0401
+# pylint: disable=W0612, W0613, W0212, E0401
 
 # _______________________________________________________________
 # To use the local filesystem as the storage for test data
@@ -127,3 +136,227 @@ def tdeck():
         "deck": deck,
         "payload": payload,
     }
+
+
+class FakeSession:
+
+    # stand-in for requests.Session that serves the offline copies of the
+    # mtgtop8.com pages stored in the validation data directory
+
+    pages = {
+        "/search": "test_search_page.html",
+        "/event": "test_deck_page.html",
+        "/mtgo": "test_deck_mtgo.txt",
+    }
+
+    def __init__(self, n_pages=None, n_timeouts=0, latency=0.0):
+        # if n_pages is given, the search results pages after it are empty. It
+        # can be a function of the search payload. The first n_timeouts
+        # requests time out. Each request takes latency seconds, and the
+        # maximum number of concurrent requests is recorded
+        self.n_pages = n_pages
+        self.n_timeouts = n_timeouts
+        self.latency = latency
+        self.calls = list()
+        self.timeouts = list()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def request(self, method, url, **kwargs):
+
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            return self._request(method, url, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _request(self, method, url, **kwargs):
+
+        self.calls.append((method, url))
+        self.timeouts.append(kwargs.get("timeout"))
+        if len(self.calls) <= self.n_timeouts:
+            raise requests.exceptions.Timeout("read timed out")
+
+        path = requests.utils.urlparse(url).path
+        filename = self.pages[path]
+        if path == "/search" and self.n_pages is not None:
+            n_pages = self.n_pages
+            if callable(n_pages):
+                n_pages = n_pages(kwargs["data"])
+            if kwargs["data"].get("current_page", 1) > n_pages:
+                filename = "test_search_page_empty.html"
+
+        response = requests.Response()
+        response.url = url
+        response.status_code = 200
+        with open(path_to_validation_data + filename, "rb") as infile:
+            response._content = infile.read()
+
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class FakeContext:
+
+    # stand-in for the context of an AWS Lambda invocation. The successive
+    # calls return the given times left before the timeout (in ms), and the
+    # last one is repeated
+
+    def __init__(self, times):
+        self.times = list(times)
+
+    def get_remaining_time_in_millis(self):
+        return self.times.pop(0) if len(self.times) > 1 else self.times[0]
+
+
+class FakeSQS:
+
+    # stand-in for the boto3 SQS client, which records the sent messages. The
+    # messages whose body contains "transient" fail the first time they are
+    # sent, and those containing "invalid" always fail
+
+    def __init__(self):
+        self.calls = list()
+        self.sent = list()
+        self.failed_once = set()
+
+    def get_queue_url(self, QueueName):
+        self.calls.append(("get_queue_url", QueueName))
+        return {"QueueUrl": "https://sqs/" + QueueName}
+
+    def send_message_batch(self, QueueUrl, Entries):
+
+        self.calls.append(("send_message_batch", len(Entries)))
+        assert len(Entries) <= 10
+        assert sum(len(e["MessageBody"]) for e in Entries) <= 256 * 1024
+
+        response = {"Successful": list(), "Failed": list()}
+        for entry in Entries:
+            body = entry["MessageBody"]
+            if "invalid" in body:
+                response["Failed"].append({"Id": entry["Id"], "SenderFault": True})
+            elif "transient" in body and body not in self.failed_once:
+                self.failed_once.add(body)
+                response["Failed"].append({"Id": entry["Id"], "SenderFault": False})
+            else:
+                self.sent.append(json.loads(body))
+                response["Successful"].append({"Id": entry["Id"]})
+
+        return response
+
+
+class FakeS3:
+
+    # stand-in for the boto3 S3 client, which keeps the objects in memory. The
+    # listings return at most two keys per request, so they are paginated, the
+    # ETags are the MD5 hashes of the objects, and the conditional writes fail
+    # if the object exists
+
+    def __init__(self):
+        self.calls = list()
+        self.objects = dict()
+        self.uploads = dict()
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None):
+        self.calls.append("put_object")
+        if IfNoneMatch == "*" and Key in self.objects:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        self.objects[Key] = Body.encode() if isinstance(Body, str) else bytes(Body)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, Range=None):
+        self.calls.append("get_object")
+        body = self.objects[Key]
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if IfNoneMatch == etag:
+            self.calls.append("not_modified")
+            raise ClientError({"Error": {"Code": "304"}}, "GetObject")
+        if Range is not None:
+            start, end = Range[len("bytes=") :].split("-")
+            body = body[int(start) : int(end) + 1]
+        return {
+            "Body": StreamingBody(io.BytesIO(body), len(body)),
+            "ContentLength": len(body),
+            "ETag": etag,
+        }
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append("create_multipart_upload")
+        upload_id = "upload-%d" % len(self.uploads)
+        self.uploads[upload_id] = dict()
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append("upload_part")
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": "etag-%d" % PartNumber}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append("complete_multipart_upload")
+        parts = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        self.objects[Key] = b"".join(parts[n] for n in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append("abort_multipart_upload")
+        del self.uploads[UploadId]
+
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=None):
+        self.calls.append("list_objects_v2")
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        res = {"Contents": [{"Key": k} for k in keys[start : start + 2]]}
+        res["IsTruncated"] = start + 2 < len(keys)
+        if res["IsTruncated"]:
+            res["NextContinuationToken"] = str(start + 2)
+        return res
+
+
+@pytest.fixture
+def tlive(monkeypatch):
+
+    # the tests that request the real website fail fast when it cannot be
+    # reached, instead of waiting for the retries and the circuit breaker
+    monkeypatch.setenv("MTGTOP8_MAX_RETRIES", "0")
+    monkeypatch.setenv("MTGTOP8_BREAKER_TIMEOUT", "0")
+    monkeypatch.setenv("MTGTOP8_TIMEOUT", "10")
+    request_handler.configure_resilience()
+
+    yield
+
+    request_handler.configure_resilience()
+
+
+@pytest.fixture
+def tsession():
+
+    return FakeSession()
+
+
+@pytest.fixture
+def treplay_server(monkeypatch):
+
+    # a local stand-in for mtgtop8.com, used by the web scraper instead of the
+    # real website during the test
+    server = replay_server.ReplayServer(n_pages=7, decks_per_page=5, seed=0)
+    server.start()
+    monkeypatch.setenv("MTGTOP8_BASE_URL", server.url)
+
+    # short delays, so the tests with injected errors are fast
+    monkeypatch.setenv("MTGTOP8_RETRY_BACKOFF", "0.01")
+    monkeypatch.setenv("MTGTOP8_BREAKER_TIMEOUT", "0.1")
+    request_handler.configure_resilience()
+
+    yield server
+
+    server.stop()
+    request_handler.configure_resilience()
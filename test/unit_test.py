@@ -1,13 +1,44 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import subprocess
+import pytest
 import requests
 import requests.exceptions
 import json
+import asyncio
+import time
+import datetime
+import threading
+import pickle
+from unittest.mock import ANY
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 
 from conftest import path_to_validation_data
+from conftest import path_to_tmp_data
 from conftest import DataHandlerType
 import download_decks
+import request_handler
+import checkpoint
+import deck_index
+import data_handler
+import deck_bundle
+import scheduler
+import metrics
+import parsers
+import card_list
+import columnar_export
+import replay_server
+import helpers
+import payload_registry
+import lambda_handlers
+from conftest import FakeSession
+from conftest import FakeSQS
+from conftest import FakeContext
+from conftest import FakeS3
 
 
 def server_is_up(url):
@@ -40,6 +71,7 @@ def test_mtgtop8():
     return
 
 
+@pytest.mark.usefixtures("tlive")
 def test_get_list(tdeck):
 
     session_requests = requests.session()
@@ -55,6 +87,7 @@ def test_get_list(tdeck):
     return
 
 
+@pytest.mark.usefixtures("tlive")
 def test_make_search_payloads(tpayloads):
 
     payload_list = download_decks.make_search_payloads(tpayloads["template_payload"])
@@ -64,6 +97,7 @@ def test_make_search_payloads(tpayloads):
     ]
 
 
+@pytest.mark.usefixtures("tlive")
 def test_get_composition(tdeck):
 
     # get deck type and cards out of the deck. Those will be written again
@@ -83,6 +117,7 @@ def test_get_composition(tdeck):
     return
 
 
+@pytest.mark.usefixtures("tlive")
 def test_download_decks_in_search_results(tdeck):
 
     deck_list = download_decks.download_decks_in_search_results(tdeck["payload"])
@@ -94,3 +129,1253 @@ def test_download_decks_in_search_results(tdeck):
     assert deck == json.load(dh_val.read(tdeck["filename"]))
 
     return
+
+
+def test_async_download_decks_in_search_results(tdeck, tsession):
+
+    deck_list = asyncio.run(
+        download_decks.async_download_decks_in_search_results(
+            tdeck["payload"], session_requests=tsession
+        )
+    )
+
+    assert len(deck_list) == 1
+    assert deck_list[0] == tdeck["deck"]
+
+    # one search page, one deck page and one MTGO file
+    assert [c[0] for c in tsession.calls] == ["POST", "GET", "GET"]
+
+    return
+
+
+def test_async_download_decks(tdeck, tsession, monkeypatch):
+
+    monkeypatch.setattr(download_decks, "get_session", lambda: tsession)
+
+    payload_list = [dict(tdeck["payload"], current_page=n) for n in range(1, 4)]
+    deck_double_list = asyncio.run(
+        download_decks.async_download_decks(payload_list, max_per_host=2)
+    )
+
+    assert deck_double_list == [[tdeck["deck"]]] * 3
+
+    # the decks are passed to on_page as soon as each page is downloaded
+    pages = list()
+    assert (
+        asyncio.run(
+            download_decks.async_download_decks(payload_list, on_page=pages.append)
+        )
+        is None
+    )
+    assert pages == [[tdeck["deck"]]] * 3
+
+    return
+
+
+@pytest.mark.parametrize("max_concurrency", [None, 12])
+def test_async_concurrency(tdeck, max_concurrency, monkeypatch):
+
+    tsession = FakeSession(latency=0.05)
+    monkeypatch.setattr(download_decks, "get_session", lambda: tsession)
+    if max_concurrency is not None:
+        monkeypatch.setenv("MTGTOP8_MAX_CONCURRENCY", str(max_concurrency))
+    request_handler.configure_resilience()
+
+    # the requests of many pages are bounded by the limit per host, unless the
+    # concurrency controller allows fewer requests
+    payload_list = [dict(tdeck["payload"], current_page=n) for n in range(1, 31)]
+    try:
+        asyncio.run(download_decks.async_download_decks(payload_list, max_per_host=12))
+    finally:
+        monkeypatch.delenv("MTGTOP8_MAX_CONCURRENCY", raising=False)
+        request_handler.configure_resilience()
+
+    expected = request_handler.DEFAULT_RESILIENCE["max_concurrency"]
+    assert tsession.max_active == (expected if max_concurrency is None else 12)
+    assert len(tsession.calls) == 3 * 30
+
+    return
+
+
+def test_token_bucket():
+
+    rate = 20
+    burst = 2
+    path = path_to_tmp_data + "rate_limit"
+
+    # two threads with their own bucket sharing the state through the file
+    buckets = [request_handler.TokenBucket(rate, burst, path) for _ in range(2)]
+    threads = [
+        threading.Thread(target=lambda b=b: [b.acquire() for _ in range(3)])
+        for b in buckets
+    ]
+
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # the first requests go in a burst, the rest wait for the bucket to refill
+    assert time.time() - t0 >= (6 - burst) / rate * 0.95
+
+    return
+
+
+def test_response_cache(tdeck, tsession):
+
+    cache = request_handler.ResponseCache(path_to_tmp_data + "cache", 2**20)
+    search_url = "http://mtgtop8.com/search"
+
+    assert cache.get("POST", search_url, tdeck["payload"]) is None
+
+    response = tsession.post(search_url, data=tdeck["payload"])
+    cache.put("POST", search_url, tdeck["payload"], response)
+
+    cached = cache.get("POST", search_url, tdeck["payload"])
+    assert cached.content == response.content
+    assert download_decks.parse_list(cached.content) == download_decks.parse_list(
+        response.content
+    )
+
+    # the cache key includes the body of the request
+    other_payload = dict(tdeck["payload"], current_page=2)
+    assert cache.get("POST", search_url, other_payload) is None
+
+    # the search results expire, the deck pages do not
+    deck_response = tsession.get(tdeck["deck"]["link"])
+    cache.put("GET", tdeck["deck"]["link"], None, deck_response)
+    cache.ttls["search"] = 0
+    time.sleep(0.01)
+    assert cache.get("POST", search_url, tdeck["payload"]) is None
+    assert cache.get("GET", tdeck["deck"]["link"]) is not None
+
+    # the least recently used responses are evicted first
+    cache.max_bytes = len(deck_response.content) + 1024
+    time.sleep(0.01)
+    cache.get("GET", tdeck["deck"]["link"])
+    cache.evict()
+    assert cache.get("GET", tdeck["deck"]["link"]) is not None
+    cache.ttls["search"] = None
+    assert cache.get("POST", search_url, tdeck["payload"]) is None
+
+    return
+
+
+def test_adaptive_concurrency():
+
+    controller = request_handler.AIMDController(4, latency_target=1.0)
+
+    # the limit is halved when a request fails, but only once for a burst of
+    # failed requests
+    bindings = [controller.acquire() for _ in range(4)]
+    assert bindings == [False, False, False, True]
+    for binding in bindings:
+        controller.release(False, 0.1, binding)
+    assert controller.limit == 2
+
+    # it grows back while the limit is used and the requests succeed
+    for _ in range(10):
+        bindings = [controller.acquire() for _ in range(int(controller.limit))]
+        for binding in bindings:
+            controller.release(True, 0.1, binding)
+    assert controller.limit == 4
+
+    # the breaker opens after the threshold of consecutive failures
+    breaker = request_handler.CircuitBreaker(3, 0.05)
+    for success in [False, False, True, False, False]:
+        breaker.record(success)
+    assert breaker.wait() == 0
+    breaker.record(False)
+    assert breaker.wait() > 0
+    assert breaker.wait() == 0
+
+    return
+
+
+def test_request_timeout(tdeck, monkeypatch):
+
+    monkeypatch.setenv("MTGTOP8_TIMEOUT", "5")
+    monkeypatch.setenv("MTGTOP8_RETRY_BACKOFF", "0.01")
+    monkeypatch.setattr(request_handler, "_RESILIENCE", None)
+    monkeypatch.setattr(request_handler, "_BREAKER", None)
+    monkeypatch.setattr(request_handler, "_CONTROLLERS", dict())
+
+    # the requests that time out are retried, and all of them have a timeout
+    session = FakeSession(n_timeouts=2)
+    response = request_handler.send_request(session, "GET", tdeck["deck"]["link"])
+    assert response.status_code == 200
+    assert len(session.calls) == 3
+    assert session.timeouts == [5.0] * 3
+
+    # the timeout is raised when the retries run out
+    monkeypatch.setenv("MTGTOP8_MAX_RETRIES", "1")
+    monkeypatch.setattr(request_handler, "_RESILIENCE", None)
+    with pytest.raises(requests.exceptions.Timeout):
+        request_handler.send_request(
+            FakeSession(n_timeouts=2), "GET", tdeck["deck"]["link"]
+        )
+
+    # the retries are not waited for past the deadline
+    monkeypatch.setenv("MTGTOP8_RETRY_BACKOFF", "10")
+    monkeypatch.setenv("MTGTOP8_MAX_RETRIES", "10")
+    monkeypatch.setattr(request_handler, "_RESILIENCE", None)
+    monkeypatch.setattr(request_handler, "_DEADLINE", time.time() + 0.2)
+    session = FakeSession(n_timeouts=10)
+    t0 = time.time()
+    with pytest.raises(request_handler.DeadlineExceeded):
+        request_handler.send_request(session, "GET", tdeck["deck"]["link"])
+    assert time.time() - t0 < 1
+    assert max(session.timeouts) <= 0.2
+
+    # the tuples (connect timeout, read timeout) are capped element-wise
+    monkeypatch.setattr(request_handler, "_DEADLINE", time.time() + 5)
+    session = FakeSession()
+    request_handler.send_request(
+        session, "GET", tdeck["deck"]["link"], timeout=(3.05, 27)
+    )
+    connect_timeout, read_timeout = session.timeouts[0]
+    assert connect_timeout == 3.05 and 4 < read_timeout <= 5
+
+    return
+
+
+def test_canonical_url():
+
+    for url in [
+        "http://mtgtop8.com/event?e=1&d=2",
+        "https://mtgtop8.com/event?e=1&d=2",
+        "http://www.mtgtop8.com/event?e=1&d=2",
+    ]:
+        assert (
+            request_handler.canonical_url(url)
+            == "https://www.mtgtop8.com/event?e=1&d=2"
+        )
+
+    # other hosts are not modified
+    url = "http://127.0.0.1:8080/event?e=1&d=2"
+    assert request_handler.canonical_url(url) == url
+
+    return
+
+
+def test_card_list(tdeck):
+
+    card_table = card_list.CardTable()
+    cards = card_list.parse_cards(tdeck["deck"]["cards"], card_table)
+
+    assert len(cards["main"]) == 18 and len(cards["side"]) == 5
+    assert cards["main"][0] == (4, card_table.ids["Eidolon of the Great Revel"])
+
+    # the text is recovered from the structured cards, and the MTGO file is
+    # parsed in the same way, reusing the same pairs
+    assert card_list.format_cards(cards, card_table) == tdeck["deck"]["cards"]
+    with open(path_to_validation_data + "test_deck_mtgo.txt", "rb") as infile:
+        cards_mtgo = card_list.parse_cards(infile.read(), card_table)
+    assert cards_mtgo == cards
+    assert all(x is y for x, y in zip(cards_mtgo["main"], cards["main"]))
+
+    # only the new cards are added to the table, and the output is smaller
+    deck_list = [dict(tdeck["deck"]) for _ in range(10)]
+    text_size = len(json.dumps(deck_list))
+    assert card_list.structure_decks(deck_list, card_table) == list()
+    assert all(deck["cards"] == cards for deck in deck_list)
+    assert len(download_decks.serialize_decks([deck_list], card_table)) < text_size
+
+    return
+
+
+def test_checkpoint_journal(tdeck, tsession, monkeypatch):
+
+    monkeypatch.setattr(download_decks, "get_session", lambda: tsession)
+
+    journal = checkpoint.CheckpointJournal(path_to_tmp_data + "journal")
+    payload_list = [dict(tdeck["payload"], current_page=n) for n in (1, 2)]
+    # a page with the same number in another format is a different page
+    payload_list.append(dict(payload_list[0], format="LE"))
+    keys = [checkpoint.page_key(payload) for payload in payload_list]
+    assert len(set(keys)) == 3
+    assert checkpoint.page_key(dict(reversed(payload_list[0].items()))) == keys[0]
+    journal.start(payload_list)
+
+    download_decks.download_decks_with_journal(payload_list[0], journal)
+
+    # simulate a crawl interrupted while writing a record
+    with open(journal.path, "a", encoding="utf-8") as journal_file:
+        journal_file.write('{"type": "deck", "pa')
+
+    loaded_payloads, pages, decks = journal.load()
+    assert loaded_payloads == payload_list
+    assert pages == {keys[0]}
+    assert decks == {keys[0]: {0: tdeck["deck"]}}
+
+    # when resuming, the decks already recorded are not downloaded again
+    n_calls = len(tsession.calls)
+    deck_list = download_decks.download_decks_with_journal(
+        payload_list[1], journal, {download_decks.make_deck_key(tdeck["deck"])}
+    )
+    assert deck_list == []
+    assert len(tsession.calls) == n_calls + 1
+
+    _, pages, decks = journal.load()
+    assert pages == {keys[0], keys[1]}
+    assert decks == {keys[0]: {0: tdeck["deck"]}}
+
+    return
+
+
+def test_deck_index(tdeck, tsession, monkeypatch):
+
+    monkeypatch.setattr(download_decks, "get_session", lambda: tsession)
+
+    # the decks are keyed by their id in mtgtop8.com, not by their short hash
+    deck = dict(tdeck["deck"])
+    assert download_decks.make_deck_key(deck) == "d447967"
+    deck["link"] = "https://www.mtgtop8.com/event?e=1"
+    assert len(download_decks.make_deck_key(deck)) == 56
+
+    dh_tmp = DataHandlerType(path_to_tmp_data)
+    index = deck_index.DeckIndex(dh_tmp, "known_decks")
+    assert len(index) == 0
+
+    deck_list = download_decks.download_decks_in_search_results(
+        tdeck["payload"], skip_ids=index
+    )
+    assert deck_list == [tdeck["deck"]]
+
+    # two concurrent writers of the index keep each other's decks
+    other = deck_index.DeckIndex(dh_tmp, "known_decks")
+    index.add(download_decks.make_deck_key(deck) for deck in deck_list)
+    index.save()
+    other.add(["d1", "d2"])
+    other.save()
+    other.save()
+    assert len(dh_tmp.list_files("known_decks-")) == 2
+    index.refresh()
+    assert len(index) == 3
+
+    # the known decks are not downloaded again, only the search page is
+    index = deck_index.DeckIndex(dh_tmp, "known_decks")
+    assert download_decks.make_deck_key(tdeck["deck"]) in index
+    assert len(index) == 3
+
+    n_calls = len(tsession.calls)
+    deck_list = download_decks.download_decks_in_search_results(
+        tdeck["payload"], skip_ids=index
+    )
+    assert deck_list == []
+    assert len(tsession.calls) == n_calls + 1
+
+    return
+
+
+def test_payload_registry(tpayloads):
+
+    dh_tmp = DataHandlerType(path_to_tmp_data)
+    registry = payload_registry.PayloadRegistry(dh_tmp, "registry")
+    assert registry.head() == (-1, None)
+
+    # the automatic payloads start where the last one ended
+    template_payload = lambda_handlers.generate_automatic_template_payload(registry)
+    assert template_payload["date_start"] == "01/01/2005"
+    for i in range(3):
+        payload = dict(tpayloads["template_payload"], date_end="0{}/10/2021".format(i))
+        lambda_handlers.udpate_payload_registry(payload, registry, "automated")
+    template_payload = lambda_handlers.generate_automatic_template_payload(registry)
+    assert template_payload["date_start"] == "02/10/2021"
+
+    # an append conditioned on a stale read fails instead of overwriting
+    seq, _ = registry.head()
+    registry.append({"date_end": "03/10/2021"}, after=seq)
+    with pytest.raises(FileExistsError):
+        registry.append({"date_end": "04/10/2021"}, after=seq)
+    assert registry.append({"date_end": "04/10/2021"}) == seq + 2
+
+    # a lagging watermark is caught up with the entries appended after it
+    dh_tmp.write_new(
+        StringIO(json.dumps({"date_end": "05/10/2021"})), "registry-00000005.json"
+    )
+    assert registry.head() == (5, {"date_end": "05/10/2021"})
+    assert len(registry.entries()) == 6
+
+    # when another producer registered a payload since the registry was read,
+    # a payload is registered only if it ends later
+    seq, _ = registry.head()
+    registry.append({"date_end": "10/10/2021"})
+    payload = dict(tpayloads["template_payload"], date_end="08/10/2021")
+    lambda_handlers.udpate_payload_registry(payload, registry, "automated", seq)
+    assert registry.head() == (seq + 1, {"date_end": "10/10/2021"})
+    payload["date_end"] = "12/10/2021"
+    lambda_handlers.udpate_payload_registry(payload, registry, "automated", seq)
+    assert registry.head()[0] == seq + 2
+    assert registry.latest()["date_end"] == "12/10/2021"
+
+    # the CSV registry of previous versions is imported once, also by
+    # producers importing it at the same time
+    registry = payload_registry.PayloadRegistry(dh_tmp, "registry_csv")
+    legacy = "format,date_start,date_end\n" + "".join(
+        "MO,01/{0:02d}/2005,01/{1:02d}/2005\n".format(i, i + 1) for i in range(1, 4)
+    )
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        imported = list(
+            executor.map(lambda _: registry.import_csv(StringIO(legacy)), range(4))
+        )
+    assert sorted(imported) == [False, False, False, True]
+    assert registry.latest() == {
+        "format": "MO",
+        "date_start": "01/03/2005",
+        "date_end": "01/04/2005",
+    }
+    assert [entry["date_end"] for entry in registry.entries()] == [
+        "01/02/2005",
+        "01/03/2005",
+        "01/04/2005",
+    ]
+    registry.append({"date_end": "01/05/2005"})
+    assert registry.head() == (1, {"date_end": "01/05/2005"})
+    assert len(registry.entries()) == 4
+
+    return
+
+
+def test_discover_search_pages(tpayloads, monkeypatch):
+
+    n_pages = 37
+    session = FakeSession(n_pages)
+    monkeypatch.setattr(download_decks, "get_session", lambda: session)
+
+    payload_list, deck_lists = download_decks.discover_search_pages(
+        tpayloads["template_payload"], n_probes=4
+    )
+
+    assert [p["current_page"] for p in payload_list] == list(range(1, n_pages + 1))
+    for p in payload_list:
+        assert "current_page" not in tpayloads["template_payload"]
+        assert p == dict(tpayloads["template_payload"], current_page=p["current_page"])
+
+    # the probed pages that are not empty are returned
+    assert 0 < len(deck_lists) < len(session.calls)
+    assert all(len(deck_list) == 1 for deck_list in deck_lists.values())
+    assert 1 in deck_lists and n_pages in deck_lists
+
+    # with the right hint, a single round of probes is enough
+    session.calls.clear()
+    payload_list_hint, _ = download_decks.discover_search_pages(
+        tpayloads["template_payload"], hint=n_pages, n_probes=4
+    )
+    assert payload_list_hint == payload_list
+    assert len(session.calls) <= 4
+
+    return
+
+
+def test_discover_date_windows(monkeypatch):
+
+    # a results page per 4 days of the date range
+    def days(payload):
+        start, end = [
+            datetime.datetime.strptime(payload[k], "%d/%m/%Y")
+            for k in ("date_start", "date_end")
+        ]
+        return (end - start).days + 1
+
+    session = FakeSession(lambda payload: days(payload) // 4)
+    monkeypatch.setattr(download_decks, "get_session", lambda: session)
+
+    template_payload = {
+        "format": "MO",
+        "date_start": "01/01/2021",
+        "date_end": "31/12/2021",
+    }
+    payload_list, deck_lists, windows = download_decks.discover_date_windows(
+        template_payload, max_pages=10, hint=91
+    )
+
+    # the windows cover the date range without overlapping, with at most
+    # max_pages results pages each
+    assert len(windows) > 1
+    assert windows[0]["date_start"] == "01/01/2021"
+    assert windows[-1]["date_end"] == "31/12/2021"
+    assert sum(days(w) for w in windows) == 365
+    for w, next_w in zip(windows[:-1], windows[1:]):
+        start = datetime.datetime.strptime(next_w["date_start"], "%d/%m/%Y")
+        end = datetime.datetime.strptime(w["date_end"], "%d/%m/%Y")
+        assert start - end == datetime.timedelta(days=1)
+
+    # the payloads of each window, with the decks probed during the search
+    assert len(payload_list) == len(deck_lists) == sum(days(w) // 4 for w in windows)
+    for w in windows:
+        pages = [
+            p["current_page"]
+            for p in payload_list
+            if p["date_start"] == w["date_start"]
+        ]
+        assert pages == list(range(1, days(w) // 4 + 1))
+        assert len(pages) <= 10
+    assert all(d is None or len(d) == 1 for d in deck_lists)
+
+    # a short date range is not split
+    template_payload["date_start"] = "01/12/2021"
+    payload_list, _, windows = download_decks.discover_date_windows(
+        template_payload, max_pages=10
+    )
+    assert windows == [template_payload] and len(payload_list) == 7
+
+    return
+
+
+def test_format_scheduler():
+
+    weights = scheduler.parse_formats("MO:2, LE,PI:0.5")
+    assert weights == {"MO": 2.0, "LE": 1.0, "PI": 0.5}
+    with pytest.raises(ValueError):
+        scheduler.parse_formats("MO:0")
+
+    payload_lists = {
+        f: [{"format": f, "current_page": i} for i in range(1, n + 1)]
+        for f, n in [("MO", 6), ("LE", 6), ("PI", 1), ("ST", 0)]
+    }
+    interleaved = scheduler.interleave_payloads(payload_lists, weights)
+    formats = "".join(p["format"][0] for p in interleaved)
+
+    # MO gets twice the pages of LE while both have pages left, PI (with a
+    # small weight and backlog) waits until its share covers a page, and LE
+    # takes the rest once MO is finished
+    assert formats == "MLMMLMMLMLLLP"
+    for f, payload_list in payload_lists.items():
+        assert [p for p in interleaved if p["format"] == f] == payload_list
+
+    # without weights, the shares follow the backlogs
+    payload_lists = {
+        f: [{"format": f, "current_page": i} for i in range(1, n + 1)]
+        for f, n in [("MO", 30), ("LE", 10)]
+    }
+    interleaved = scheduler.interleave_payloads(payload_lists)
+    assert "".join(p["format"][0] for p in interleaved[:8]) == "MMMLMMML"
+
+    # at runtime, the requests are split between the formats, not the pages:
+    # the pages of MO cost twice the requests, so it gets half the pages
+    format_scheduler = scheduler.FormatScheduler(
+        {"MO": payload_lists["MO"][:10], "LE": payload_lists["LE"]}
+    )
+    formats = ""
+    for payload in iter(format_scheduler.take, None):
+        formats += payload["format"][0]
+        format_scheduler.done(payload, 100 if payload["format"] == "MO" else 50)
+        if len(formats) == 12:
+            break
+    assert formats.count("L") == 2 * formats.count("M")
+    assert format_scheduler.requests == {"MO": 400, "LE": 400}
+
+    return
+
+
+def test_metrics(monkeypatch):
+
+    registry = metrics.Metrics()
+    registry.count("decks", 3)
+    registry.count("bytes_downloaded", 2048, "Bytes")
+    for latency in range(1, 151):
+        registry.observe("request_latency", latency, "Milliseconds")
+    with registry.timer("parse_list"):
+        pass
+
+    summary = registry.summary()
+    assert summary["decks"] == 3 and summary["decks_per_second"] > 0
+    assert summary["request_latency"]["count"] == 150
+    assert summary["request_latency"]["p50"] == 75
+    assert summary["request_latency"]["max"] == 150
+    assert summary["parse_list"]["count"] == 1
+
+    # a histogram with more values than fit in an EMF record is spread over
+    # several records, and the counters go in the first one
+    records = registry.emf_records({"function": "deck_consumer"})
+    assert len(records) == 2
+    directive = records[0]["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Dimensions"] == [["function"]]
+    assert {"Name": "bytes_downloaded", "Unit": "Bytes"} in directive["Metrics"]
+    assert records[0]["function"] == records[1]["function"] == "deck_consumer"
+    assert records[0]["decks"] == 3 and "decks" not in records[1]
+    assert records[1]["request_latency"] == list(range(101, 151))
+
+    # the metrics of the worker processes are merged into the parent's
+    snapshot = registry.drain()
+    assert registry.counters == dict() and registry.histograms == dict()
+    registry.merge(snapshot)
+    registry.merge(snapshot)
+    assert registry.counters["decks"] == 6
+    assert len(registry.histograms["request_latency"]) == 300
+
+    # the registry of the process is pickled by reference
+    assert pickle.loads(pickle.dumps(metrics.METRICS)) is metrics.METRICS
+
+    # inside AWS Lambda, the metrics are logged as EMF records
+    logged = list()
+    monkeypatch.setattr(metrics.LOG, "info", lambda msg, extra: logged.append(extra))
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "deck_consumer")
+    registry.emit({"function": "deck_consumer"})
+    assert len(logged) == 3 and all("_aws" in record for record in logged)
+    assert registry.counters == dict()
+
+    return
+
+
+@pytest.mark.parametrize(
+    "filename",
+    [
+        "test_search_page.html",
+        "test_search_page_full.html",
+        "test_search_page_empty.html",
+    ],
+)
+def test_parsers_list(filename):
+
+    with open(path_to_validation_data + filename, "rb") as infile:
+        content = infile.read()
+
+    deck_list = parsers.SoupParser().parse_list(content)
+    assert parsers.LxmlParser().parse_list(content) == deck_list
+
+    return
+
+
+@pytest.mark.parametrize(
+    "filename", ["test_deck_page.html", "test_deck_page_no_type.html"]
+)
+def test_parsers_deck_page(filename):
+
+    with open(path_to_validation_data + filename, "rb") as infile:
+        content = infile.read()
+
+    parsed = parsers.SoupParser().parse_deck_page(content)
+    assert parsers.LxmlParser().parse_deck_page(content) == parsed
+
+    return
+
+
+def test_select_parser(tdeck, tsession, monkeypatch):
+
+    outputs = list()
+
+    for name in parsers.PARSERS:
+        monkeypatch.setenv("MTGTOP8_PARSER", name)
+        assert isinstance(parsers.get_parser(), parsers.PARSERS[name])
+
+        deck_list = download_decks.get_list(tsession, tdeck["payload"])
+        deck = download_decks.get_composition(tsession, deck_list[0])
+        assert deck == tdeck["deck"]
+        outputs.append(json.dumps(deck))
+
+    # the output is the same, including the order of the keys
+    assert len(set(outputs)) == 1
+
+    return
+
+
+def test_replay_server(tpayloads, treplay_server):
+
+    payload_list = download_decks.make_search_payloads(tpayloads["template_payload"])
+    assert [p["current_page"] for p in payload_list] == list(range(1, 8))
+
+    deck_double_list = [
+        download_decks.download_decks_in_search_results(payload)
+        for payload in payload_list
+    ]
+
+    decks = [deck for deck_list in deck_double_list for deck in deck_list]
+    assert len(decks) == 7 * 5
+    assert len({deck["id"] for deck in decks}) == len(decks)
+    assert all(deck["link"].startswith(treplay_server.url) for deck in decks)
+    assert all("Fire//Ice" in deck["cards"] for deck in decks)
+
+    # the connection is kept alive across the results pages
+    assert treplay_server.n_connections == 1
+
+    # the asyncio engine and the faster discovery produce the same decks
+    payload_list_fast, _ = download_decks.discover_search_pages(
+        tpayloads["template_payload"]
+    )
+    assert payload_list_fast == payload_list
+    assert (
+        asyncio.run(download_decks.async_download_decks(payload_list, 2))
+        == deck_double_list
+    )
+
+    return
+
+
+def test_retry(tpayloads, treplay_server, monkeypatch):
+
+    treplay_server.error_rate = 0.3
+
+    payload_list = download_decks.make_search_payloads(tpayloads["template_payload"])
+    deck_double_list = [
+        download_decks.download_decks_in_search_results(payload)
+        for payload in payload_list
+    ]
+
+    # all the decks are downloaded despite the errors
+    assert sum(len(deck_list) for deck_list in deck_double_list) == 7 * 5
+    assert treplay_server.n_requests > 7 * (1 + 5 * 2) + 1
+
+    # the errors are returned when the retries run out
+    treplay_server.error_rate = 1.0
+    monkeypatch.setenv("MTGTOP8_MAX_RETRIES", "1")
+    request_handler.configure_resilience()
+    with pytest.raises(requests.exceptions.HTTPError):
+        download_decks.get_list(requests.Session(), payload_list[0])
+
+    return
+
+
+@pytest.mark.parametrize("engine", [["-n", "2"], ["-c", "4"]])
+def test_cli_ndjson(tpayloads, treplay_server, engine):
+
+    # the decks are printed a line each as the results pages are downloaded,
+    # by the worker processes (-n) or by the asyncio engine (-c)
+    output = subprocess.run(
+        [sys.executable, "download_decks.py", "--format", "ndjson"]
+        + ["-p", json.dumps(tpayloads["template_payload"])]
+        + engine,
+        cwd=os.path.dirname(download_decks.__file__),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    decks = [json.loads(line) for line in output.stdout.splitlines()]
+    assert len(decks) == len({deck["id"] for deck in decks}) == 7 * 5
+    assert all(deck["link"].startswith(treplay_server.url) for deck in decks)
+    assert all("Fire//Ice" in deck["cards"] for deck in decks)
+
+    # the metrics of the run are logged to stderr
+    assert '"decks": 35' in output.stderr
+
+    return
+
+
+@pytest.mark.parametrize("engine", [["-n", "2"], ["-c", "4"]])
+def test_cli_formats(tpayloads, treplay_server, engine):
+
+    def run(args):
+        n_requests = treplay_server.n_requests
+        output = subprocess.run(
+            [sys.executable, "download_decks.py", "--format", "ndjson"]
+            + ["-p", json.dumps(tpayloads["template_payload"])]
+            + engine
+            + args,
+            cwd=os.path.dirname(download_decks.__file__),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        decks = [json.loads(line) for line in output.stdout.splitlines()]
+        return decks, treplay_server.n_requests - n_requests
+
+    # the decks of a single format, to count its requests
+    decks, n_requests = run(list())
+    assert len(decks) == 7 * 5
+
+    # the formats are crawled together, with the probed pages reused, and
+    # recorded in a single journal
+    journal = path_to_tmp_data + "journal-formats" + engine[0]
+    decks, n_requests_formats = run(["--formats", "MO:2,LE", "--journal", journal])
+    assert len(decks) == len({deck["id"] for deck in decks}) == 2 * 7 * 5
+    assert {deck["link"][-2:] for deck in decks} == {"MO", "LE"}
+    assert n_requests_formats == 2 * n_requests
+
+    # the finished crawl is resumed without any request
+    decks, n_requests = run(["--formats", "MO:2,LE", "--journal", journal, "--resume"])
+    assert len(decks) == 2 * 7 * 5
+    assert n_requests == 0
+
+    return
+
+
+@pytest.mark.parametrize("suffix", ["", ".gz", ".zst"])
+def test_data_handler_streams(suffix):
+
+    if suffix == ".zst":
+        pytest.importorskip("zstandard")
+
+    dh_tmp = DataHandlerType(path_to_tmp_data)
+    directory = "streams" + suffix.replace(".", "_")
+    os.makedirs(path_to_tmp_data + directory, exist_ok=True)
+    filename = directory + "/decks.ndjson" + suffix
+
+    # the lines are written as they are generated, and compressed by suffix
+    lines = ['{"id": "%d", "name": "D\u00e9ck"}\n' % i for i in range(1000)]
+    dh_tmp.write((line for line in lines), filename)
+    assert dh_tmp.read(filename).getvalue() == "".join(lines)
+    with dh_tmp.open_read(filename, "r") as infile:
+        assert list(infile) == lines
+
+    with open(path_to_tmp_data + filename, "rb") as infile:
+        raw = infile.read()
+    assert dh_tmp.read(filename, binary=True).getvalue() == "".join(lines).encode()
+    assert (len(raw) < len("".join(lines))) == (suffix != "")
+
+    # a write that fails leaves the previous file
+    with pytest.raises(RuntimeError):
+        with dh_tmp.open_write(filename, "w") as outfile:
+            outfile.write("partial")
+            raise RuntimeError()
+    assert dh_tmp.read(filename).getvalue() == "".join(lines)
+
+    files = {"%s/part-%d%s" % (directory, i, suffix): b"%d" % i for i in range(5)}
+    dh_tmp.write_many(files)
+    assert dh_tmp.list_files(directory + "/part-") == sorted(files)
+    streams = dh_tmp.read_many(sorted(files), binary=True)
+    assert {k: v.getvalue() for k, v in streams.items()} == files
+
+    return
+
+
+def test_data_handler_s3_multipart(monkeypatch):
+
+    s3 = FakeS3()
+    dh_s3 = data_handler.DataHandlerS3("bucket", client=s3, max_workers=4)
+
+    # large objects are uploaded in parts as they are written
+    chunk = b"x" * 2**20
+    size = 2 * data_handler.MULTIPART_CHUNK_SIZE + 3 * len(chunk)
+    dh_s3.write((chunk for _ in range(size // len(chunk))), "big.bin")
+    assert s3.calls.count("upload_part") == 3
+    assert len(dh_s3.read("big.bin", binary=True).getvalue()) == size
+
+    # small objects are written with a single request, and failed multipart
+    # uploads are aborted
+    s3.calls.clear()
+    dh_s3.write_many({"small-%d.json.gz" % i: '{"id": %d}' % i for i in range(5)})
+    assert s3.calls == ["put_object"] * 5
+    with pytest.raises(RuntimeError):
+        with dh_s3.open_write("big.bin") as outfile:
+            outfile.write(chunk * 10)
+            raise RuntimeError()
+    assert s3.calls[-1] == "abort_multipart_upload"
+    assert len(dh_s3.read("big.bin", binary=True).getvalue()) == size
+
+    # so are the uploads that fail when the streams are closed
+    def complete_multipart_upload(**kwargs):
+        raise RuntimeError()
+
+    monkeypatch.setattr(s3, "complete_multipart_upload", complete_multipart_upload)
+    with pytest.raises(RuntimeError):
+        with dh_s3.open_write("big.bin.gz") as outfile:
+            outfile.write(os.urandom(10 * len(chunk)))
+    assert s3.calls[-1] == "abort_multipart_upload"
+    assert s3.uploads == dict()
+    assert "big.bin.gz" not in s3.objects
+
+    keys = dh_s3.list_files("small-")
+    assert keys == ["small-%d.json.gz" % i for i in range(5)]
+    streams = dh_s3.read_many(keys)
+    assert [json.load(streams[k])["id"] for k in keys] == list(range(5))
+
+    return
+
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_cached_data_handler_s3(in_memory):
+
+    s3 = FakeS3()
+    directory = None if in_memory else path_to_tmp_data + "object_cache"
+    cache = data_handler.ObjectCache(directory, max_bytes=2500)
+    dh_s3 = data_handler.CachedDataHandlerS3("bucket", cache, client=s3)
+    dh_s3.write_many({"obj-%d" % i: "%d" % i * 1000 for i in range(3)})
+
+    # the cached objects are revalidated without downloading them again
+    assert dh_s3.read("obj-0").getvalue() == "0" * 1000
+    assert dh_s3.read("obj-0").getvalue() == "0" * 1000
+    assert s3.calls[-2:] == ["get_object", "not_modified"]
+
+    # the writes invalidate the cached object, and the changes made by others
+    # are detected by the revalidation
+    size = cache.size
+    dh_s3.write("changed", "obj-0")
+    assert cache.get("bucket", "obj-0") is None
+    assert cache.size < size
+    assert dh_s3.read("obj-0").getvalue() == "changed"
+    s3.put_object(Bucket="bucket", Key="obj-0", Body=b"changed again")
+    assert dh_s3.read("obj-0").getvalue() == "changed again"
+
+    # the least recently used objects are evicted
+    s3.put_object(Bucket="bucket", Key="obj-0", Body=b"0" * 1000)
+    dh_s3.read("obj-1")
+    dh_s3.read("obj-0")
+    dh_s3.read("obj-2")
+    assert cache.get("bucket", "obj-1") is None
+    assert cache.get("bucket", "obj-0") is not None
+    assert cache.size <= cache.max_bytes
+
+    # the size is kept in step with the cached objects when they are replaced
+    # or invalidated
+    cache.put("bucket", "obj-2", "etag", b"2" * 500)
+    cache.invalidate("bucket", "obj-0")
+    cache.invalidate("bucket", "obj-0")
+    if in_memory:
+        assert cache.size == 500
+    else:
+        assert cache.size == data_handler.ObjectCache(directory).size
+
+    return
+
+
+@pytest.mark.parametrize("compression", ["zstd", "gzip"])
+def test_deck_bundle(tdeck, compression):
+
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+
+    s3 = FakeS3()
+    dh_s3 = data_handler.DataHandlerS3("bucket", client=s3)
+    decks = [dict(tdeck["deck"], id="deck-%d" % i) for i in range(250)]
+
+    bundle = deck_bundle.BundleWriter(
+        dh_s3, "bundles", compression, max_decks=100, block_bytes=16 * 1024
+    )
+    bundle.add_page(decks[:120])
+    bundle.add_page(None)
+    bundle.add_page(decks[120:])
+    shards = bundle.close()
+
+    # the shards are regular compressed NDJSON files, with their index
+    assert len(shards) == 3
+    assert dh_s3.list_files("bundles/") == sorted(
+        shards + [deck_bundle.index_name(shard) for shard in shards]
+    )
+    with dh_s3.open_read(shards[0], "r") as infile:
+        assert [json.loads(line) for line in infile] == decks[:100]
+
+    # a deck is read with a ranged request of its block
+    index = json.load(dh_s3.read(deck_bundle.index_name(shards[1])))
+    assert index["n_decks"] == 100 and len(index["blocks"]) > 1
+    s3.calls.clear()
+    deck = deck_bundle.read_deck(dh_s3, shards[1], "deck-142", index)
+    assert deck == decks[142]
+    assert s3.calls == ["get_object"]
+
+    block = index["blocks"][index["decks"]["deck-142"][0]]
+    assert block[1] < sum(b[1] for b in index["blocks"]) / 2
+
+    return
+
+
+@pytest.mark.usefixtures("treplay_server")
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_columnar_export(tpayloads, file_format):
+
+    pa_dataset = pytest.importorskip("pyarrow.dataset")
+    pa_parquet = pytest.importorskip("pyarrow.parquet")
+    pa_ipc = pytest.importorskip("pyarrow.ipc")
+
+    root = path_to_tmp_data + "export_" + file_format
+    sink = columnar_export.ColumnarSink(root, file_format)
+    deck_double_list = list()
+    for page in range(1, 4):
+        payload = dict(tpayloads["template_payload"], current_page=page)
+        deck_double_list.append(
+            download_decks.download_decks_in_search_results(payload)
+        )
+        sink.add_page(deck_double_list[-1])
+    sink.add_page(None)
+
+    def filenames():
+        return [os.path.join(d, f) for d, _, files in os.walk(root) for f in files]
+
+    # the files are hidden from the readers until they are closed
+    assert all(os.path.basename(f).startswith(".") for f in filenames())
+    sink.close()
+    assert not any(os.path.basename(f).startswith(".") for f in filenames())
+
+    # the pages of a partition are buffered into a single row group
+    for filename in filenames():
+        if file_format == "parquet":
+            n_groups = pa_parquet.ParquetFile(filename).num_row_groups
+        else:
+            n_groups = pa_ipc.open_file(filename).num_record_batches
+        assert n_groups == 1
+
+    decks = [deck for deck_list in deck_double_list for deck in deck_list]
+    partitions = {columnar_export.deck_partition(deck) for deck in decks}
+    ds_format = "ipc" if file_format == "arrow" else file_format
+
+    deck_table = pa_dataset.dataset(
+        root + "/decks", format=ds_format, partitioning="hive"
+    ).to_table()
+    assert sorted(deck_table.column("id").to_pylist()) == sorted(
+        deck["id"] for deck in decks
+    )
+    assert set(deck_table.column("format").to_pylist()) == {"MO"}
+    assert len(set(deck_table.column("month").to_pylist())) == len(partitions)
+
+    # a row per card, readable by partition and column
+    cards = pa_dataset.dataset(root + "/cards", format=ds_format, partitioning="hive")
+    month = sorted(partitions)[0][1]
+    table = cards.to_table(
+        columns=["deck_id", "count", "card"], filter=pa_dataset.field("month") == month
+    )
+    deck_ids = {
+        deck["id"] for deck in decks if columnar_export.deck_partition(deck)[1] == month
+    }
+    assert set(table.column("deck_id").to_pylist()) == deck_ids
+    assert "Fire//Ice" in table.column("card").to_pylist()
+    assert table.num_rows == len(deck_ids) * len(replay_server.CARDS)
+
+    # the card ids are shared by all the partitions, and the card table maps
+    # them to the card names
+    card_table = pa_dataset.dataset(root + "/card_table", format=ds_format).to_table()
+    names = dict(zip(*[card_table.column(c).to_pylist() for c in ["card_id", "card"]]))
+    assert len(names) == len(replay_server.CARDS)
+    table = cards.to_table(columns=["card_id", "card"])
+    assert set(table.column("card_id").to_pylist()) == set(names)
+    assert [names[i] for i in table.column("card_id").to_pylist()] == table.column(
+        "card"
+    ).to_pylist()
+
+    return
+
+
+def test_send_sqs_msg_batch(monkeypatch):
+
+    sqs = FakeSQS()
+    monkeypatch.setattr(helpers, "get_client", lambda service: sqs)
+    monkeypatch.setattr(helpers, "_QUEUE_URLS", dict())
+    attrs = {"msg_type": {"StringValue": "full_deck", "DataType": "String"}}
+
+    # 25 small messages and 3 large ones, which do not all fit in a batch
+    msgs = [{"id": i} for i in range(25)]
+    msgs += [{"id": i, "cards": "x" * 100000} for i in range(25, 28)]
+    assert helpers.send_sqs_msg_batch("decks", msgs, attrs) == list()
+    assert sqs.sent == msgs
+    assert [c[1] for c in sqs.calls[1:]] == [10, 10, 7, 1]
+
+    # only the failed messages are retried, unless the failure is their fault
+    sqs.calls.clear()
+    msgs = [{"id": 0}, {"id": 1, "transient": True}, {"id": 2, "invalid": True}]
+    assert helpers.send_sqs_msg_batch("decks", msgs, attrs) == [msgs[2]]
+    assert sqs.sent[-2:] == msgs[:2]
+
+    # the queue URL is requested only once
+    assert sqs.calls == [("send_message_batch", 3), ("send_message_batch", 1)]
+
+    return
+
+
+def test_get_client(monkeypatch):
+
+    import boto3
+
+    # a slow client creation, during which the other threads ask for the
+    # client too
+    created = list()
+
+    def client(service, region_name):
+        created.append((service, region_name))
+        time.sleep(0.05)
+        return object()
+
+    monkeypatch.setattr(boto3, "client", client)
+    monkeypatch.setattr(helpers, "_CLIENTS", dict())
+
+    n_threads = 16
+    barrier = threading.Barrier(n_threads)
+    clients = list()
+
+    def get_client():
+        barrier.wait()
+        clients.append(helpers.get_client("sqs"))
+
+    threads = [threading.Thread(target=get_client) for _ in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # the client is created once and shared by all the threads
+    assert created == [("sqs", helpers.REGION)]
+    assert len(clients) == n_threads
+    assert all(c is clients[0] for c in clients)
+
+    return
+
+
+@pytest.mark.usefixtures("treplay_server")
+@pytest.mark.parametrize("bundle", [False, True])
+def test_deck_consumer_batch(tpayloads, bundle, monkeypatch):
+
+    sqs = FakeSQS()
+    monkeypatch.setattr(helpers, "get_client", lambda service: sqs)
+    monkeypatch.setattr(helpers, "_QUEUE_URLS", dict())
+    monkeypatch.setenv("DECKS_DOWNLOADED_QUEUE", "decks")
+    monkeypatch.delenv("DECK_INDEX_KEY", raising=False)
+
+    # with bundles, the decks are written to shards in S3
+    s3 = FakeS3()
+    dh_s3 = data_handler.DataHandlerS3("bucket", client=s3)
+    if bundle:
+        pytest.importorskip("zstandard")
+        monkeypatch.setenv("MTG_DATA_BUCKET", "bucket")
+        monkeypatch.setenv("DECK_BUNDLE_PREFIX", "bundles")
+        monkeypatch.setattr(lambda_handlers, "CachedDataHandlerS3", lambda *args: dh_s3)
+    else:
+        monkeypatch.delenv("DECK_BUNDLE_PREFIX", raising=False)
+
+    # a batch of three results pages and a malformed message
+    records = [
+        {
+            "messageId": "msg-%d" % page,
+            "body": json.dumps(dict(tpayloads["template_payload"], current_page=page)),
+        }
+        for page in range(1, 4)
+    ]
+    records.insert(1, {"messageId": "msg-bad", "body": "{"})
+
+    response = lambda_handlers.deck_consumer({"Records": records}, None)
+
+    # only the malformed message is delivered again
+    assert response["batchItemFailures"] == [{"itemIdentifier": "msg-bad"}]
+    decks = sqs.sent
+    if bundle:
+        assert sqs.sent == [{"bucket": "bucket", "shard": ANY}]
+        with dh_s3.open_read(sqs.sent[0]["shard"], "r") as infile:
+            decks = [json.loads(line) for line in infile]
+    deck_ids = {deck["id"] for deck in decks}
+    assert len(deck_ids) == len(decks) == 15
+
+    return
+
+
+def test_deck_consumer_deadline(tpayloads, treplay_server, monkeypatch):
+
+    sqs = FakeSQS()
+    monkeypatch.setattr(helpers, "get_client", lambda service: sqs)
+    monkeypatch.setattr(helpers, "_QUEUE_URLS", dict())
+    monkeypatch.setenv("DECKS_DOWNLOADED_QUEUE", "decks")
+    monkeypatch.setenv("DECKS_CONSUMER_QUEUE", "jobs")
+    monkeypatch.delenv("DECK_INDEX_KEY", raising=False)
+
+    payload = dict(tpayloads["template_payload"], current_page=1)
+    event = {"Records": [{"messageId": "msg", "body": json.dumps(payload)}]}
+
+    # a job that starts after the deadline is re-enqueued whole, without
+    # sending any request
+    n_requests = treplay_server.n_requests
+    response = lambda_handlers.deck_consumer(event, FakeContext([5000]))
+    assert response["batchItemFailures"] == list()
+    assert sqs.sent == [payload]
+    assert treplay_server.n_requests == n_requests
+    sqs.sent.clear()
+
+    # the time left drops below the margin after the third deck of the page
+    # is downloaded (the first calls are for the deadline of the requests and
+    # the start of the job)
+    context = FakeContext([60000, 60000, 60000, 30000, 30000, 5000])
+    response = lambda_handlers.deck_consumer(event, context)
+    assert response["batchItemFailures"] == list()
+
+    # the downloaded decks are sent, and the rest are enqueued as a job each
+    decks = [msg for msg in sqs.sent if "deck_list" not in msg]
+    jobs = [msg for msg in sqs.sent if "deck_list" in msg]
+    assert len(decks) == 3
+    assert [len(job["deck_list"]) for job in jobs] == [1, 1]
+
+    # the jobs per deck do not request the results page again
+    n_requests = treplay_server.n_requests
+    sqs.sent.clear()
+    records = [{"messageId": str(i), "body": json.dumps(j)} for i, j in enumerate(jobs)]
+    response = lambda_handlers.deck_consumer({"Records": records}, None)
+    assert response["batchItemFailures"] == list()
+    assert treplay_server.n_requests - n_requests == 2 * len(jobs)
+
+    deck_ids = [deck["id"] for deck in decks + sqs.sent]
+    assert sorted(deck_ids) == sorted(set(deck_ids))
+    assert len(deck_ids) == treplay_server.decks_per_page
+
+    return
+
+
+def test_deck_consumer_requeue_failure(tpayloads, treplay_server, monkeypatch):
+
+    pytest.importorskip("zstandard")
+
+    sqs = FakeSQS()
+    monkeypatch.setattr(helpers, "get_client", lambda service: sqs)
+    monkeypatch.setattr(helpers, "_QUEUE_URLS", dict())
+    monkeypatch.setenv("DECKS_DOWNLOADED_QUEUE", "decks")
+    monkeypatch.setenv("DECKS_CONSUMER_QUEUE", "jobs")
+    monkeypatch.setenv("MTG_DATA_BUCKET", "bucket")
+    monkeypatch.setenv("DECK_BUNDLE_PREFIX", "bundles")
+    monkeypatch.setenv("DECK_INDEX_KEY", "index")
+    monkeypatch.setattr(lambda_handlers, "_DECK_INDEXES", dict())
+    dh_s3 = data_handler.DataHandlerS3("bucket", client=FakeS3())
+    monkeypatch.setattr(lambda_handlers, "CachedDataHandlerS3", lambda *args: dh_s3)
+
+    # the messages cannot be sent to the given queue
+    send_sqs_msg_batch = lambda_handlers.send_sqs_msg_batch
+    failing_queues = set()
+
+    def failing_send(queue_name, msgs, attrs):
+        if queue_name in failing_queues:
+            return msgs
+        return send_sqs_msg_batch(queue_name, msgs, attrs)
+
+    monkeypatch.setattr(lambda_handlers, "send_sqs_msg_batch", failing_send)
+
+    # the time left drops below the margin after the first deck
+    payload = dict(tpayloads["template_payload"], current_page=1)
+    event = {"Records": [{"messageId": "msg", "body": json.dumps(payload)}]}
+    times = [60000, 60000, 60000, 5000]
+
+    # if the shards cannot be sent, the whole batch fails before the remaining
+    # decks are re-enqueued, so they are not downloaded twice when the batch
+    # is delivered again
+    failing_queues.add("decks")
+    with pytest.raises(RuntimeError):
+        lambda_handlers.deck_consumer(event, FakeContext(times))
+    assert sqs.sent == list()
+
+    # if the remaining decks cannot be re-enqueued, the job fails after its
+    # deck was written, and the deck is skipped when the job is delivered again
+    failing_queues.clear()
+    failing_queues.add("jobs")
+    response = lambda_handlers.deck_consumer(event, FakeContext(times))
+    assert response["batchItemFailures"] == [{"itemIdentifier": "msg"}]
+    assert [sorted(msg) for msg in sqs.sent] == [["bucket", "shard"]]
+
+    failing_queues.clear()
+    n_requests = treplay_server.n_requests
+    response = lambda_handlers.deck_consumer(event, None)
+    assert response["batchItemFailures"] == list()
+    assert all("deck_list" not in msg for msg in sqs.sent)
+    n_decks = treplay_server.decks_per_page - 1
+    assert treplay_server.n_requests - n_requests == 1 + 2 * n_decks
+
+    return
+
+
+def test_lambda_import_time():
+
+    # the import time of the module of the AWS Lambda handlers is a large part
+    # of their cold starts, so it is kept within a budget. The heavy
+    # dependencies that the consumer does not need must not be imported
+    budget = 0.5
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import lambda_handlers"],
+        cwd=os.path.dirname(download_decks.__file__),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+
+    # lines as "import time: self [us] | cumulative | imported package"
+    times = dict()
+    for line in output.splitlines()[1:]:
+        _, cumulative, module = line.split("|")
+        times[module.strip()] = int(cumulative) / 1e6
+
+    assert times["lambda_handlers"] < budget
+    for module in ["pandas", "s3fs", "pyarrow", "joblib", "boto3", "bs4", "lxml"]:
+        assert module not in times
+
+    return